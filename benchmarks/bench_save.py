@@ -0,0 +1,276 @@
+"""Benchmark saving pictures to PDF.
+
+Usage:
+    python benchmarks/bench_save.py [--full] [--json FILE] [--compare FILE]
+
+A synthetic corpus of JPEG, PNG, transparent PNG and opaque PNG (with
+an alpha channel that is 255 everywhere) pictures is generated (once,
+in the corpus directory) and saved to PDF with every combination of the
+selected formats, resolutions, counts, layouts, modes and compression
+levels. Each case runs in a fresh process, so that its peak RSS is
+measured separately.
+
+For every case, pictures/sec, MB/sec (of picture files read), peak RSS and
+the output size are reported. Results saved with --json can be passed to
+--compare in a later run to show the change in throughput.
+"""
+
+import argparse
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from PIL import Image
+
+FORMATS = {'jpeg': '.jpg', 'png': '.png', 'png-alpha': '.png',
+           'png-opaque': '.png'}
+MODES = {
+    'default': {},
+    'streaming': {'streaming': True},
+    'workers': {'workers': os.cpu_count()},
+    'jpeg': {'reencode': 'jpeg'},
+}
+
+COMPRESSIONS = ['none', 'fast', 'default', 'max']
+
+QUICK = {
+    'formats': list(FORMATS),
+    'sizes': ['640x480', '1920x1080'],
+    'counts': [10, 100],
+    'layouts': ['1x1', '6x8'],
+    'modes': ['default'],
+    'compressions': ['default'],
+}
+FULL = {
+    'formats': list(FORMATS),
+    'sizes': ['640x480', '1920x1080', '4000x3000'],
+    'counts': [10, 100, 1000, 10000],
+    'layouts': ['1x1', '2x3', '4x4', '6x8', 'auto'],
+    'modes': list(MODES),
+    'compressions': COMPRESSIONS,
+}
+
+DEFAULT_CORPUS_DIR = Path(tempfile.gettempdir()) / 'pictureshow-bench-corpus'
+COLUMNS = ('format', 'size', 'count', 'layout', 'mode', 'compression')
+
+
+def base_picture(fmt, size):
+    """Return encoded picture of given format and size: gradients
+    with noise, so that it compresses like a photograph.
+    """
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.effect_noise(size, 64)
+    blue = Image.radial_gradient('L').resize(size)
+    buffer = BytesIO()
+    if fmt == 'png-alpha':
+        alpha = Image.radial_gradient('L').resize(size).transpose(
+            Image.FLIP_LEFT_RIGHT
+        )
+        Image.merge('RGBA', (red, green, blue, alpha)).save(buffer, 'PNG')
+    elif fmt == 'png-opaque':
+        # like screenshots and exported plots
+        alpha = Image.new('L', size, 255)
+        Image.merge('RGBA', (red, green, blue, alpha)).save(buffer, 'PNG')
+    elif fmt == 'png':
+        Image.merge('RGB', (red, green, blue)).save(buffer, 'PNG')
+    else:
+        Image.merge('RGB', (red, green, blue)).save(buffer, 'JPEG',
+                                                    quality=90)
+    return buffer.getvalue()
+
+
+def variant(data, index):
+    """Return copy of encoded picture made unique by a comment, so that
+    the pictures of the corpus are not recognized as duplicates.
+    """
+    text = f'pictureshow benchmark {index}'.encode('ascii')
+    if data.startswith(b'\xff\xd8'):
+        # COM segment right after SOI
+        return (data[:2] + b'\xff\xfe' + struct.pack('>H', len(text) + 2)
+                + text + data[2:])
+    # tEXt chunk right after IHDR
+    chunk = b'tEXt' + b'Comment\0' + text
+    ihdr_end = 8 + 25
+    return (data[:ihdr_end] + struct.pack('>I', len(chunk) - 4) + chunk
+            + struct.pack('>I', zlib.crc32(chunk)) + data[ihdr_end:])
+
+
+def make_corpus(corpus_dir, fmt, size, count):
+    """Generate missing pictures of the corpus, return their paths."""
+    directory = Path(corpus_dir) / f'{fmt}-{size}'
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = [directory / f'{index:05d}{FORMATS[fmt]}'
+             for index in range(count)]
+    missing = [path for path in paths if not path.exists()]
+    if missing:
+        data = base_picture(fmt, parse_size(size))
+        for path in missing:
+            path.write_bytes(variant(data, int(path.stem)))
+    return paths
+
+
+def parse_size(size):
+    width, height = size.split('x')
+    return int(width), int(height)
+
+
+def peak_rss():
+    """Return peak RSS of this process and its children, in bytes."""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(case, corpus_dir):
+    """Save the corpus of the case to PDF, return measurements."""
+    from pictureshow import pictures_to_pdf
+
+    paths = make_corpus(corpus_dir, case['format'], case['size'],
+                        case['count'])
+    input_bytes = sum(path.stat().st_size for path in paths)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_file = os.path.join(temp_dir, 'bench.pdf')
+        start = time.perf_counter()
+        result = pictures_to_pdf(*paths, pdf_file=pdf_file,
+                                 layout=case['layout'],
+                                 compression=case['compression'],
+                                 **MODES[case['mode']])
+        seconds = time.perf_counter() - start
+        output_bytes = sum(
+            os.path.getsize(shard.pdf_file) for shard in result.shards
+        )
+    return {
+        **case,
+        'seconds': seconds,
+        'pictures_per_sec': result.num_ok / seconds,
+        'mb_per_sec': input_bytes / seconds / 2 ** 20,
+        'peak_rss': peak_rss(),
+        'output_bytes': output_bytes,
+        'errors': len(result.errors),
+    }
+
+
+def run_in_process(case, corpus_dir):
+    """Run case in a fresh interpreter, return its measurements."""
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--corpus-dir', str(corpus_dir),
+         '--run-case', json.dumps(case)]
+    )
+    return json.loads(output)
+
+
+def cases(options):
+    for fmt in options.formats:
+        for size in options.sizes:
+            for count in options.counts:
+                for layout in options.layouts:
+                    for mode in options.modes:
+                        for compression in options.compressions:
+                            yield {'format': fmt, 'size': size,
+                                   'count': count, 'layout': layout,
+                                   'mode': mode, 'compression': compression}
+
+
+def case_key(case):
+    # results saved before compression levels were added used the default
+    return tuple(case.get(column, 'default') for column in COLUMNS)
+
+
+def print_header(compare=False):
+    header = ('format     size        count layout mode      compress'
+              '   pics/s    MB/s  RSS MB   out MB')
+    if compare:
+        header += '   change'
+    print(header)
+
+
+def print_result(result, previous=None):
+    rss = result['peak_rss']
+    line = (
+        f'{result["format"]:10} {result["size"]:11}'
+        f' {result["count"]:5} {result["layout"]:6}'
+        f' {result["mode"]:9} {result["compression"]:8}'
+        f' {result["pictures_per_sec"]:8.1f}'
+        f' {result["mb_per_sec"]:7.1f}'
+        f' {"-" if rss is None else f"{rss / 2 ** 20:.0f}":>7}'
+        f' {result["output_bytes"] / 2 ** 20:8.1f}'
+    )
+    if previous is not None:
+        change = result['pictures_per_sec'] / previous['pictures_per_sec'] - 1
+        line += f' {change:+8.1%}'
+    if result['errors']:
+        line += f'  ({result["errors"]} errors)'
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark saving pictures to PDF.'
+    )
+    parser.add_argument('--full', action='store_true',
+                        help='run the full matrix (takes hours)')
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS))
+    parser.add_argument('--sizes', nargs='+', metavar='WxH')
+    parser.add_argument('--counts', nargs='+', type=int, metavar='N')
+    parser.add_argument('--layouts', nargs='+', metavar='LAYOUT')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES))
+    parser.add_argument('--compressions', nargs='+', choices=COMPRESSIONS)
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR,
+                        help='directory of the generated pictures,'
+                             ' reused between runs')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare pictures/sec with results saved'
+                             ' to FILE')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run_case:
+        result = run_case(json.loads(options.run_case), options.corpus_dir)
+        print(json.dumps(result))
+        return
+
+    matrix = FULL if options.full else QUICK
+    for name, default in matrix.items():
+        if getattr(options, name) is None:
+            setattr(options, name, default)
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)}
+
+    print_header(compare=bool(baseline))
+    results = []
+    for case in cases(options):
+        # generate the corpus beforehand, so that it is not measured
+        make_corpus(options.corpus_dir, case['format'], case['size'],
+                    case['count'])
+        result = run_in_process(case, options.corpus_dir)
+        print_result(result, baseline.get(case_key(result)))
+        results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
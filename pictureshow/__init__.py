@@ -1,7 +1,34 @@
+import sys
+
 from pictureshow.exceptions import PageSizeError, MarginError, LayoutError
-from pictureshow.core import PictureShow, pictures_to_pdf
+from pictureshow.hooks import Hooks
 
 __version__ = '0.6.4'
 
 __all__ = ['__version__', 'PictureShow', 'pictures_to_pdf',
-           'PageSizeError', 'MarginError', 'LayoutError']
+           'pictures_to_pdf_async', 'Hooks', 'PageSizeError', 'MarginError',
+           'LayoutError']
+
+# imported from pictureshow.core on first use, so that importing the
+# package (e.g. to print the version) does not import PIL and reportlab
+_CORE_NAMES = ('PictureShow', 'pictures_to_pdf', 'pictures_to_pdf_async')
+
+if sys.version_info < (3, 7):
+    # module __getattr__ is not supported
+    from pictureshow.core import (
+        PictureShow, pictures_to_pdf, pictures_to_pdf_async
+    )
+else:
+    def __getattr__(name):
+        if name not in _CORE_NAMES:
+            raise AttributeError(
+                f'module {__name__!r} has no attribute {name!r}'
+            )
+        from pictureshow import core
+
+        value = getattr(core, name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted({*globals(), *_CORE_NAMES})
@@ -0,0 +1,123 @@
+"""Run many jobs saving pictures to PDF in one process pool.
+
+Jobs are read from a manifest, one JSON object per line, e.g.
+
+    {"pic_files": ["a.png", "b/*.jpg"], "pdf_file": "ab.pdf", "layout": "2x2"}
+    {"input_dirs": ["album"], "pdf_file": "album.pdf", "max_dpi": 150}
+
+Each job is saved as a whole in one of the worker processes, so that
+the cost of starting the interpreter and importing the libraries is
+paid once per worker, not once per job.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+
+from pictureshow.inputs import PICTURE_EXTENSIONS, expand_pattern, scan_dir
+
+# keyword arguments of save_pdf which may be specified for a job
+JOB_OPTIONS = ('page_size', 'landscape', 'margin', 'layout', 'stretch_small',
+               'force_overwrite', 'max_dpi', 'streaming',
+               'max_pages_per_file', 'max_bytes_per_file', 'cache_dir',
+               'cache_size', 'append', 'memory_budget', 'compression',
+               'reencode', 'jpeg_quality', 'min_saving')
+JOB_INPUTS = ('pic_files', 'input_dirs', 'extensions')
+
+Job = namedtuple('Job', 'pdf_file pic_files input_dirs extensions options')
+JobResult = namedtuple('JobResult', 'job result error')
+
+
+def read_manifest(lines):
+    """Return list of Jobs read from an iterable of lines, e.g. a file
+    object, each a JSON object with the target "pdf_file", input
+    "pic_files" (paths or glob patterns), "input_dirs" and their
+    "extensions", and options of save_pdf. Blank lines are skipped.
+
+    Raise ValueError if a line is not a valid job, or if the target
+    of a job is the same as the target of another.
+    """
+    jobs = []
+    targets = {}
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            job = parse_job(line)
+        except ValueError as err:
+            raise ValueError(f'line {line_number}: {err}') from None
+        target = os.path.abspath(job.pdf_file)
+        if target in targets:
+            raise ValueError(
+                f'line {line_number}: pdf_file {job.pdf_file!r} is also'
+                f' the target of line {targets[target]}'
+            )
+        targets[target] = line_number
+        jobs.append(job)
+    return jobs
+
+
+def run_batch(jobs, workers=None):
+    """Save the jobs in a pool of worker processes (as many as CPUs
+    by default). Yield a JobResult for each job as it is finished,
+    holding either the result returned by save_pdf or the error raised.
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as err:
+                yield JobResult(job, None, err)
+            else:
+                yield JobResult(job, result, None)
+
+
+def parse_job(text, target_required=True):
+    """Return Job parsed from JSON text. Raise ValueError if it is not
+    a valid job. Unless target_required is true, pdf_file may be
+    missing (None).
+    """
+    try:
+        fields = json.loads(text)
+    except json.JSONDecodeError as err:
+        raise ValueError(f'invalid JSON, {err}') from None
+    if not isinstance(fields, dict):
+        raise ValueError('JSON object expected')
+    unknown = set(fields) - {'pdf_file', *JOB_INPUTS, *JOB_OPTIONS}
+    if unknown:
+        raise ValueError(f'unknown key {sorted(unknown)[0]!r}')
+    if not (isinstance(fields.get('pdf_file'), str)
+            or 'pdf_file' not in fields and not target_required):
+        raise ValueError('pdf_file path expected')
+    for key in JOB_INPUTS:
+        if not isinstance(fields.get(key, []), list):
+            raise ValueError(f'{key} must be a list')
+    if not (fields.get('pic_files') or fields.get('input_dirs')):
+        raise ValueError('no pictures specified,'
+                         ' pic_files or input_dirs required')
+    return Job(
+        fields.get('pdf_file'),
+        fields.get('pic_files', []),
+        fields.get('input_dirs', []),
+        fields.get('extensions', PICTURE_EXTENSIONS),
+        {key: value for key, value in fields.items() if key in JOB_OPTIONS}
+    )
+
+
+def job_paths(job):
+    """Yield picture file paths of the job, lazily."""
+    for pic_file in job.pic_files:
+        yield from expand_pattern(pic_file)
+    for directory in job.input_dirs:
+        yield from scan_dir(directory, job.extensions)
+
+
+def run_job(job):
+    """Save pictures of the job to PDF, return the result of save_pdf."""
+    from pictureshow.core import PictureShow
+
+    pic_show = PictureShow.from_iterable(job_paths(job))
+    return pic_show.save_pdf(job.pdf_file, **job.options)
@@ -0,0 +1,92 @@
+import os
+from pathlib import Path
+import pickle
+import tempfile
+
+# bump when the format of cached pictures changes
+CACHE_VERSION = 4
+CACHE_SIZE = 2 ** 30
+SUFFIX = '.picture'
+
+
+class PictureCache:
+    """Directory of pictures prepared in previous runs.
+
+    Entries are keyed by the digest of the picture file contents and
+    the options the picture was prepared with. Reading an entry marks
+    it as recently used; trim() removes the least recently used entries
+    until the total size is within max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=CACHE_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, digest, prepare_options):
+        """Return cached picture, or None if there is no valid entry."""
+        path = self._path(digest, prepare_options)
+        try:
+            with open(path, 'rb') as f:
+                picture = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # unreadable or corrupt entry
+            self._remove(path)
+            return None
+        return picture
+
+    def put(self, digest, prepare_options, picture):
+        """Store picture, replacing the entry atomically, so that
+        concurrent runs never read a partially written one.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(picture, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(digest, prepare_options))
+        except OSError:
+            # caching is best effort
+            self._remove(temp_path)
+
+    def trim(self):
+        """Remove least recently used entries exceeding max_size."""
+        entries = []
+        for path in self.cache_dir.glob(f'*{SUFFIX}'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # removed by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _path(self, digest, prepare_options):
+        # imported here, so that importing CACHE_SIZE does not import
+        # reportlab
+        from reportlab.lib.utils import _digester
+
+        # area size and stretching only matter when downsampling
+        if prepare_options.get('max_dpi') is None:
+            options = sorted(
+                (name, value) for name, value in prepare_options.items()
+                if name not in ('area_size', 'stretch_small', 'max_dpi')
+            )
+        else:
+            options = sorted(prepare_options.items())
+        key = _digester(f'{CACHE_VERSION} {digest} {options}')
+        return self.cache_dir / f'{key}{SUFFIX}'
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,12 +1,32 @@
 import argparse
+from contextlib import redirect_stdout
+import json
+import signal
+import sys
 
 import pictureshow
+from pictureshow.cache import CACHE_SIZE
+from pictureshow.inputs import (
+    GLOB_CHARS, PICTURE_EXTENSIONS, expand_pattern, read_list, scan_dir
+)
+from pictureshow.stats import PHASES
 
 
 def get_args(parser):
-    parser.add_argument('PIC', nargs='+',
-                        help='one or more input picture file paths')
-    parser.add_argument('PDF', help='target PDF file path')
+    parser.add_argument('PIC', nargs='*',
+                        help='input picture file paths, glob patterns,'
+                             ' or @FILE to read paths from FILE')
+    parser.add_argument('PDF', help="target PDF file path, or '-' for stdout")
+    parser.add_argument('-d', '--input-dir', action='append', metavar='DIR',
+                        help='add pictures found in DIR and its'
+                             ' subdirectories; can be repeated')
+    parser.add_argument('-e', '--extensions', metavar='EXT[,EXT...]',
+                        help='file extensions of pictures searched in'
+                             ' input directories; default is'
+                             f' {",".join(PICTURE_EXTENSIONS)}')
+    parser.add_argument('--from-stdin', action='store_true',
+                        help='read picture file paths from stdin,'
+                             ' one per line')
     parser.add_argument('-p', '--page-size', default='A4', metavar='SIZE',
                         help='specify page size; default is A4')
     parser.add_argument('-L', '--landscape', action='store_true',
@@ -16,24 +36,199 @@ def get_args(parser):
                              ' default is 72 (72 points = 1 inch)')
     parser.add_argument('-l', '--layout', default='1x1',
                         help='specify grid layout of pictures on page,'
-                             ' e.g. 2x3 or 2,3; default is 1x1')
+                             ' e.g. 2x3 or 2,3, or auto to pack pictures'
+                             ' in rows by aspect ratio; default is 1x1')
     parser.add_argument('-s', '--stretch-small', action='store_true',
                         help='scale small pictures up to fit drawing area')
     parser.add_argument('-f', '--force-overwrite', action='store_true',
                         help='save target file even if filename exists')
+    parser.add_argument('-a', '--append', action='store_true',
+                        help='add pictures to the end of existing target file')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='prepare pictures in N parallel processes')
+    parser.add_argument('--memory-budget', type=int, metavar='SIZE',
+                        help='prepare pictures ahead of drawing them, using'
+                             ' at most about SIZE bytes of memory')
+    parser.add_argument('--max-dpi', type=float, metavar='DPI',
+                        help='downsample pictures to at most DPI dots per inch'
+                             ' of their size on page')
+    parser.add_argument('--compression', default='default',
+                        choices=('none', 'fast', 'default', 'max'),
+                        metavar='LEVEL',
+                        help='compress decoded pictures and pages at LEVEL:'
+                             ' none, fast, default or max; default is'
+                             ' default')
+    parser.add_argument('--reencode', choices=('jpeg',), metavar='FORMAT',
+                        help='re-encode PNG, TIFF and other pictures'
+                             ' without transparency to FORMAT: jpeg')
+    parser.add_argument('--jpeg-quality', type=int, default=85,
+                        metavar='Q',
+                        help='re-encode at JPEG quality Q, from 1 to 95;'
+                             ' default is 85')
+    parser.add_argument('--min-saving', type=float, metavar='PERCENT',
+                        help='re-encode only pictures made smaller by at'
+                             ' least PERCENT')
+    parser.add_argument('--streaming', action='store_true',
+                        help='write each page to file as soon as it is'
+                             ' complete, to save memory on large batches')
+    parser.add_argument('--max-pages', type=int, metavar='N',
+                        help='split output into numbered files'
+                             ' of at most N pages')
+    parser.add_argument('--max-bytes', type=int, metavar='SIZE',
+                        help='split output into numbered files'
+                             ' of at most about SIZE bytes')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='reuse pictures prepared in previous runs,'
+                             ' cached in DIR')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        metavar='SIZE',
+                        help='remove least recently used pictures from cache'
+                             ' to keep it under SIZE bytes; default is 1 GiB')
+    parser.add_argument('--progress', action='store_true',
+                        help='show progress on stderr')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report pages that would be saved, reading'
+                             ' only picture headers and writing nothing')
+    parser.add_argument('--plan-json', action='store_true',
+                        help='with --dry-run, print placements of pictures'
+                             ' on pages as JSON')
 
     verbosity_group = parser.add_mutually_exclusive_group()
     verbosity_group.add_argument('-q', '--quiet', action='store_true',
                                  help='suppress printing to stdout')
     verbosity_group.add_argument('-v', '--verbose', action='store_true',
-                                 help='provide details on files skipped due to error')
+                                 help='provide details on files skipped due to error'
+                                      ' and on time spent')
 
     parser.add_argument('-V', '--version', action='version')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not (args.PIC or args.input_dir or args.from_stdin):
+        parser.error('no pictures specified,'
+                     ' PIC, --input-dir or --from-stdin required')
+    if args.plan_json and not args.dry_run:
+        parser.error('--plan-json requires --dry-run')
+    return args
 
 
-def report_results(result, target_path, verbose=False):
+def get_batch_args(parser, argv):
+    parser.add_argument('MANIFEST',
+                        help="manifest file path, or '-' for stdin;"
+                             ' one JSON object per line, specifying'
+                             ' pdf_file, pic_files and/or input_dirs,'
+                             ' and save_pdf options of a job')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='run jobs in N parallel processes;'
+                             ' default is number of CPUs')
+
+    verbosity_group = parser.add_mutually_exclusive_group()
+    verbosity_group.add_argument('-q', '--quiet', action='store_true',
+                                 help='suppress printing to stdout')
+    verbosity_group.add_argument('-v', '--verbose', action='store_true',
+                                 help='provide details on each job and on'
+                                      ' files skipped due to error')
+
+    return parser.parse_args(argv)
+
+
+def get_serve_args(parser, argv):
+    address_group = parser.add_mutually_exclusive_group()
+    address_group.add_argument('--port', type=int, default=8000,
+                               help='listen on localhost PORT;'
+                                    ' default is 8000')
+    address_group.add_argument('--socket', metavar='PATH',
+                               help='listen on Unix socket PATH')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='run at most N jobs at a time, in N worker'
+                             ' processes; default is number of CPUs')
+    parser.add_argument('--queue-size', type=int, metavar='N',
+                        help='let at most N more jobs wait, refuse others;'
+                             ' default is 16')
+    parser.add_argument('--allow-files', action='store_true',
+                        help='let jobs save to pdf_file on the server,'
+                             ' overwrite and append to files, and use'
+                             ' cache_dir')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not log requests to stderr')
+
+    return parser.parse_args(argv)
+
+
+def input_paths(args):
+    """Yield picture file paths from all inputs specified, lazily."""
+    for arg in args.PIC:
+        if arg.startswith('@'):
+            with open(arg[1:]) as f:
+                yield from read_list(f)
+        else:
+            yield from expand_pattern(arg)
+    if args.extensions is None:
+        extensions = PICTURE_EXTENSIONS
+    else:
+        extensions = args.extensions.split(',')
+    for directory in args.input_dir or ():
+        yield from scan_dir(directory, extensions)
+    if args.from_stdin:
+        yield from read_list(sys.stdin)
+
+
+def _num_inputs(args):
+    """Return number of picture files specified, or None if it is
+    not known before they are enumerated.
+    """
+    if args.input_dir or args.from_stdin or any(
+            arg.startswith('@') or any(char in arg for char in GLOB_CHARS)
+            for arg in args.PIC):
+        return None
+    return len(args.PIC)
+
+
+class Progress(pictureshow.Hooks):
+    """Show number of pictures processed and pages saved on one line
+    of stderr, rewritten on every change.
+    """
+
+    def __init__(self, num_files=None, file=sys.stderr):
+        self.num_files = num_files
+        self.file = file
+        self.num_processed = 0
+        self.num_failed = 0
+        self.num_pages = 0
+        self._shown = False
+
+    def picture_opened(self, pic_file):
+        self.num_processed += 1
+        self._show()
+
+    def picture_failed(self, pic_file, error):
+        self.num_failed += 1
+        self.num_processed += 1
+        if self.num_files is not None:
+            # pictures failing to be drawn have been opened already
+            self.num_processed = min(self.num_processed, self.num_files)
+        self._show()
+
+    def page_finished(self, page_number):
+        self.num_pages += 1
+        self._show()
+
+    def finish(self):
+        """End the progress line, if shown."""
+        if self._shown:
+            print(file=self.file)
+
+    def _show(self):
+        if self.num_files is None:
+            processed = self.num_processed
+        else:
+            processed = f'{self.num_processed}/{self.num_files}'
+        print(f'\rpictures: {processed},'
+              f' pages: {self.num_pages}, failed: {self.num_failed}',
+              end='', file=self.file, flush=True)
+        self._shown = True
+
+
+def report_results(result, verbose=False):
     unique_errors = dict(result.errors)
     num_errors = len(unique_errors)
     if num_errors != 0:
@@ -42,11 +237,131 @@ def report_results(result, target_path, verbose=False):
             for pic_file, error in unique_errors.items():
                 print(f'{pic_file}:\n{error.__class__.__name__}: {error}\n')
 
-    if result.num_ok != 0:
-        print(f'Saved {_number(result.num_ok, "picture")}'
-              f' ({_number(result.num_pages, "page")}) to {target_path!r}')
+    if result.num_ok == 0:
+        print('Nothing to save.')
+        return
+
+    if len(result.shards) == 1:
+        saved_to = _file_name(result.shards[0].pdf_file)
     else:
+        saved_to = _number(len(result.shards), 'file')
+    print(f'Saved {_number(result.num_ok, "picture")}'
+          f' ({_number(result.num_pages, "page")}) to {saved_to}')
+    if verbose:
+        if len(result.shards) > 1:
+            for shard in result.shards:
+                print(f'{shard.pdf_file!r}:'
+                      f' {_number(shard.num_ok, "picture")}'
+                      f' ({_number(shard.num_pages, "page")})')
+        if result.num_duplicates != 0:
+            print(f'{_number(result.num_duplicates, "duplicate picture")}'
+                  f' stored only once.')
+        if result.stats is not None:
+            report_stats(result.stats)
+
+
+def report_stats(stats):
+    print(f'Read {_megabytes(stats.bytes_read)},'
+          f' wrote {_megabytes(stats.bytes_written)}.')
+    print('Time per phase (wall / CPU):')
+    for name in PHASES:
+        wall, cpu = stats.phase(name)
+        print(f'  {name:8} {wall:8.3f} s / {cpu:8.3f} s')
+    print('Slowest pictures:')
+    for pic_file, seconds in stats.slowest():
+        print(f'  {seconds:8.3f} s  {pic_file}')
+
+
+def report_plan(plan, pdf_file, verbose=False):
+    unique_errors = dict(plan.errors)
+    num_errors = len(unique_errors)
+    if num_errors != 0:
+        print(f'{_number(num_errors, "file")} would be skipped due to error.')
+        if verbose:
+            for pic_file, error in unique_errors.items():
+                print(f'{pic_file}:\n{error.__class__.__name__}: {error}\n')
+
+    if plan.num_ok == 0:
+        print('Nothing to save.')
+        return
+
+    print(f'Would save {_number(plan.num_ok, "picture")}'
+          f' ({_number(plan.num_pages, "page")}) to {_file_name(pdf_file)},'
+          f' about {_megabytes(plan.estimated_bytes)}')
+    if verbose:
+        for page_number, page in enumerate(plan.pages, start=1):
+            print(f'page {page_number}:')
+            for placement in page:
+                print(f'  {placement.pic_file}')
+
+
+def report_batch(job_results, verbose=False):
+    """Report results of batch jobs, return number of jobs failed."""
+    failed = [job_result for job_result in job_results
+              if job_result.error is not None]
+    results = [job_result.result for job_result in job_results
+               if job_result.error is None]
+    if failed:
+        print(f'{_number(len(failed), "job")} failed.')
+        if verbose:
+            for job, _, error in failed:
+                print(f'{job.pdf_file}:\n{error.__class__.__name__}:'
+                      f' {error}\n')
+
+    unique_errors = {}
+    for result in results:
+        unique_errors.update(result.errors)
+    if unique_errors:
+        print(f'{_number(len(unique_errors), "file")} skipped due to error.')
+        if verbose:
+            for pic_file, error in unique_errors.items():
+                print(f'{pic_file}:\n{error.__class__.__name__}: {error}\n')
+
+    num_ok = sum(result.num_ok for result in results)
+    if num_ok == 0:
         print('Nothing to save.')
+        return len(failed)
+
+    num_pages = sum(result.num_pages for result in results)
+    shards = [shard for result in results for shard in result.shards]
+    print(f'Saved {_number(num_ok, "picture")}'
+          f' ({_number(num_pages, "page")}) to {_number(len(shards), "file")}')
+    if verbose:
+        for shard in shards:
+            print(f'{shard.pdf_file!r}:'
+                  f' {_number(shard.num_ok, "picture")}'
+                  f' ({_number(shard.num_pages, "page")})')
+    return len(failed)
+
+
+def _file_name(pdf_file):
+    """Return repr of the file path, or 'stdout' if saved to stream."""
+    return repr(pdf_file) if isinstance(pdf_file, str) else 'stdout'
+
+
+def _plan_fields(plan):
+    """Return dictionary of plan, to be printed as JSON."""
+    return {
+        'num_ok': plan.num_ok,
+        'num_pages': plan.num_pages,
+        'estimated_bytes': plan.estimated_bytes,
+        'pages': [
+            [{'pic_file': str(placement.pic_file),
+              'x': placement.x, 'y': placement.y,
+              'width': placement.width, 'height': placement.height}
+             for placement in page]
+            for page in plan.pages
+        ],
+        'errors': [
+            {'pic_file': str(pic_file),
+             'error': f'{error.__class__.__name__}: {error}'}
+            for pic_file, error in plan.errors
+        ],
+    }
+
+
+def _megabytes(num_bytes):
+    return f'{num_bytes / 2 ** 20:.1f} MiB'
 
 
 def _number(number, noun):
@@ -56,30 +371,169 @@ def _number(number, noun):
 
 
 def main():
+    if sys.argv[1:2] == ['batch']:
+        main_batch(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['serve']:
+        main_serve(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         prog='pictureshow',
-        description='Save pictures to PDF.',
+        description="Save pictures to PDF. See 'pictureshow batch -h'"
+                    " to save many PDF files in one run, and"
+                    " 'pictureshow serve -h' to save PDF files on"
+                    ' requests.',
         epilog='https://pypi.org/project/pictureshow/'
     )
     parser.version = pictureshow.__version__
     args = get_args(parser)
 
-    picture_paths = args.PIC
+    if args.dry_run:
+        main_plan(parser, args)
+        return
+
     pdf_path = args.PDF
+    to_stdout = pdf_path == '-'
+    if to_stdout:
+        pdf_path = sys.stdout.buffer
+    progress = Progress(_num_inputs(args)) if args.progress else None
 
     try:
-        result = pictureshow.pictures_to_pdf(
-            *picture_paths,
+        pic_show = pictureshow.PictureShow.from_iterable(input_paths(args))
+        result = pic_show.save_pdf(
             pdf_file=pdf_path,
             page_size=args.page_size,
             landscape=args.landscape,
             margin=args.margin,
             layout=args.layout,
             stretch_small=args.stretch_small,
-            force_overwrite=args.force_overwrite
+            force_overwrite=args.force_overwrite,
+            workers=args.jobs,
+            max_dpi=args.max_dpi,
+            streaming=args.streaming,
+            max_pages_per_file=args.max_pages,
+            max_bytes_per_file=args.max_bytes,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            append=args.append,
+            stats=args.verbose,
+            hooks=progress,
+            memory_budget=args.memory_budget,
+            compression=args.compression,
+            reencode=args.reencode,
+            jpeg_quality=args.jpeg_quality,
+            min_saving=(None if args.min_saving is None
+                        else args.min_saving / 100)
         )
     except Exception as err:
+        if progress is not None:
+            progress.finish()
         parser.error(f'{err.__class__.__name__}: {err}')
     else:
+        if progress is not None:
+            progress.finish()
         if not args.quiet:
-            report_results(result, pdf_path, args.verbose)
+            # keep the PDF written to stdout intact
+            with redirect_stdout(sys.stderr if to_stdout else sys.stdout):
+                report_results(result, args.verbose)
+
+
+def main_plan(parser, args):
+    pic_show = pictureshow.PictureShow.from_iterable(input_paths(args))
+    try:
+        plan = pic_show.plan(
+            page_size=args.page_size,
+            landscape=args.landscape,
+            margin=args.margin,
+            layout=args.layout,
+            stretch_small=args.stretch_small,
+            max_dpi=args.max_dpi
+        )
+    except Exception as err:
+        parser.error(f'{err.__class__.__name__}: {err}')
+    if args.plan_json:
+        json.dump(_plan_fields(plan), sys.stdout)
+        print()
+    elif not args.quiet:
+        pdf_file = None if args.PDF == '-' else args.PDF
+        report_plan(plan, pdf_file, args.verbose)
+
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog='pictureshow batch',
+        description='Save pictures to PDF files as specified by jobs'
+                    ' in manifest, running them in a shared pool of'
+                    ' processes.',
+        epilog='https://pypi.org/project/pictureshow/'
+    )
+    args = get_batch_args(parser, argv)
+    # imported after parsing arguments, to print help and errors fast
+    from pictureshow.batch import read_manifest, run_batch
+
+    try:
+        if args.MANIFEST == '-':
+            jobs = read_manifest(sys.stdin)
+        else:
+            with open(args.MANIFEST) as f:
+                jobs = read_manifest(f)
+        job_results = list(run_batch(jobs, args.jobs))
+    except Exception as err:
+        parser.error(f'{err.__class__.__name__}: {err}')
+    # report in the order of the manifest
+    job_order = {id(job): index for index, job in enumerate(jobs)}
+    job_results.sort(key=lambda job_result: job_order[id(job_result.job)])
+
+    if args.quiet:
+        num_failed = sum(job_result.error is not None
+                         for job_result in job_results)
+    else:
+        num_failed = report_batch(job_results, args.verbose)
+    if num_failed:
+        sys.exit(1)
+
+
+def main_serve(argv):
+    parser = argparse.ArgumentParser(
+        prog='pictureshow serve',
+        description='Save pictures to PDF on HTTP requests, in a pool of'
+                    ' worker processes kept running. POST a job (as in'
+                    ' batch manifest) to /pdf, GET /status.',
+        epilog='https://pypi.org/project/pictureshow/'
+    )
+    args = get_serve_args(parser, argv)
+    from pictureshow import server
+
+    if args.queue_size is None:
+        args.queue_size = server.QUEUE_SIZE
+    try:
+        if args.socket is None:
+            pic_server = server.HTTPPictureServer(
+                ('127.0.0.1', args.port), args.jobs, args.queue_size,
+                args.quiet, args.allow_files
+            )
+            host, port = pic_server.server_address
+            url = f'http://{host}:{port}/'
+        else:
+            pic_server = server.UnixPictureServer(
+                args.socket, args.jobs, args.queue_size, args.quiet,
+                args.allow_files
+            )
+            url = args.socket
+    except Exception as err:
+        parser.error(f'{err.__class__.__name__}: {err}')
+
+    print(f'Serving on {url}', flush=True)
+    # stop on SIGTERM as on Ctrl+C, closing the server and the workers
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        pic_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pic_server.server_close()
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
@@ -1,71 +1,516 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor
+)
+import functools
+import itertools
+from io import BytesIO
+import os
 from pathlib import Path
 import re
+import struct
+import threading
+import weakref
+import zlib
 
-from PIL import UnidentifiedImageError
+from PIL import Image, UnidentifiedImageError
 from reportlab.lib import pagesizes
-from reportlab.lib.utils import ImageReader
+from reportlab.lib.utils import ImageReader, _digester, open_and_read
+from reportlab.pdfbase.pdfdoc import (
+    PDFArray, PDFDictionary, PDFImageXObject, PDFName, PDFObjectReference,
+    PDFStream
+)
 from reportlab.pdfgen.canvas import Canvas
 
 from pictureshow import PageSizeError, MarginError, LayoutError
-
-PAGE_SIZES = {
-    name: size
-    for name, size in pagesizes.__dict__.items()
-    # use isupper() to exclude deprecated names and function names
-    if name.isupper()
-}
+from pictureshow.cache import CACHE_SIZE, PictureCache
+from pictureshow.stats import Stats, timed
+from pictureshow.writer import LAYOUT_KEY, AppendingCanvas, StreamingCanvas
 
 DELIMITER = re.compile('[x,]')
+# layout packing pictures in justified rows, about AUTO_ROWS rows per page
+AUTO_LAYOUT = 'auto'
+AUTO_ROWS = 4
+# fraction by which a row may be scaled down to fit at the bottom of a page
+MAX_ROW_SHRINK = 0.25
+
+JPEG_SIGNATURE = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# number of colour components: PDF colour space
+COLOR_SPACES = {1: 'DeviceGray', 3: 'DeviceRGB', 4: 'DeviceCMYK'}
+# compression: zlib level of decoded image data, None meaning uncompressed
+COMPRESSION_LEVELS = {'none': None, 'fast': 1, 'default': 6, 'max': 9}
+# formats pictures can be re-encoded to
+REENCODINGS = ('jpeg',)
+JPEG_QUALITY = 85
+# PNG colour type: number of colour components
+PNG_COLOR_TYPES = {0: 1, 2: 3}
+# parts of error messages naming the in-memory file a picture is read from
+READER_PREFIX = re.compile(r'\n(fileName=.*? )?identity=\[[^\]]*\] ')
+BYTES_IO_REPR = re.compile(r'<_io\.BytesIO object at 0x[0-9a-fA-F]+>')
+
+# number of bytes read from the start of picture files when planning
+HEADER_SIZE = 2 ** 16
+
+# estimated size of PDF structure around the image data, in bytes
+FILE_OVERHEAD = 1000
+PAGE_OVERHEAD = 1000
+IMAGE_OVERHEAD = 500
 
 DrawingArea = namedtuple('DrawingArea', 'x y width height')
+PlacedPicture = namedtuple('PlacedPicture', 'picture x y width height')
+
+Shard = namedtuple('Shard', 'pdf_file num_ok num_pages')
+Result = namedtuple('Result',
+                    'num_ok errors num_pages num_duplicates shards stats')
+Placement = namedtuple('Placement', 'pic_file x y width height')
+Plan = namedtuple('Plan', 'pages errors num_ok num_pages estimated_bytes')
+
 
-Result = namedtuple('Result', 'num_ok errors num_pages')
+class _Cancelled(Exception):
+    """Raised in the thread saving PDF when save_pdf_async is cancelled."""
 
 
 class PictureShow:
     def __init__(self, *pic_files):
         self.pic_files = pic_files
         self.errors = []
+        self.num_duplicates = 0
+        self._stats = None
+        self._hooks = None
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def from_iterable(cls, pic_files):
+        """Return instance taking picture files from the iterable,
+        e.g. a generator. The iterable is consumed lazily while saving,
+        so it can be saved only once.
+        """
+        pic_show = cls()
+        pic_show.pic_files = pic_files
+        return pic_show
 
     def save_pdf(self, pdf_file, page_size='A4', landscape=False, margin=72,
-                 layout=(1, 1), stretch_small=False, force_overwrite=False):
-        target_str = self._validate_target_path(pdf_file, force_overwrite)
+                 layout=(1, 1), stretch_small=False, force_overwrite=False,
+                 workers=None, max_dpi=None, streaming=False,
+                 max_pages_per_file=None, max_bytes_per_file=None,
+                 cache_dir=None, cache_size=CACHE_SIZE, append=False,
+                 stats=False, hooks=None, memory_budget=None,
+                 compression='default', reencode=None,
+                 jpeg_quality=JPEG_QUALITY, min_saving=None):
+        sharded = not (max_pages_per_file is None
+                       and max_bytes_per_file is None)
+        if _is_stream(pdf_file):
+            if sharded:
+                raise ValueError('cannot split output written to a stream')
+            if append:
+                raise ValueError('cannot append to a stream')
+            target = pdf_file
+        elif sharded:
+            if append:
+                raise ValueError('cannot append to split output')
+            self._validate_shard_limits(max_pages_per_file,
+                                        max_bytes_per_file)
+            target = self._validate_shard_paths(pdf_file, force_overwrite)
+        else:
+            target = self._validate_target_path(
+                pdf_file, force_overwrite or append
+            )
         page_size = self._validate_page_size(page_size, landscape)
         layout = self._validate_layout(layout)
+        self._validate_max_dpi(max_dpi)
+        self._validate_memory_budget(memory_budget)
+        self._validate_compression(compression)
+        self._validate_reencode(reencode, jpeg_quality, min_saving)
+        if cache_dir is None:
+            cache = None
+        else:
+            cache = PictureCache(cache_dir, cache_size)
 
         return self._save_pdf(
-            target_str, page_size, margin, layout, stretch_small
+            target, page_size, margin, layout, stretch_small, workers,
+            max_dpi, streaming, max_pages_per_file, max_bytes_per_file, cache,
+            append, stats, hooks, memory_budget, compression, reencode,
+            jpeg_quality, min_saving
+        )
+
+    async def save_pdf_async(self, pdf_file, page_size='A4', landscape=False,
+                             margin=72, layout=(1, 1), stretch_small=False,
+                             force_overwrite=False, workers=None,
+                             max_dpi=None, streaming=False,
+                             max_pages_per_file=None,
+                             max_bytes_per_file=None, cache_dir=None,
+                             cache_size=CACHE_SIZE, append=False,
+                             stats=False, hooks=None, memory_budget=None,
+                             compression='default', reencode=None,
+                             jpeg_quality=JPEG_QUALITY, min_saving=None):
+        """Like save_pdf, but run in the default executor of the event
+        loop, so that reading, preparing and saving pictures does not
+        block it.
+
+        If the awaiting task is cancelled, saving stops before the next
+        picture and no PDF file is left behind. A PDF already being saved
+        is removed (or the file appended to is truncated back) once saved.
+        """
+        save = functools.partial(
+            self.save_pdf, pdf_file, page_size, landscape, margin, layout,
+            stretch_small, force_overwrite, workers, max_dpi, streaming,
+            max_pages_per_file, max_bytes_per_file, cache_dir, cache_size,
+            append, stats, hooks, memory_budget, compression, reencode,
+            jpeg_quality, min_saving
         )
+        # imported on first use, as it takes long to import
+        import asyncio
 
-    def _save_pdf(self, pdf_file, page_size, margin, layout, stretch_small):
-        pdf_canvas = Canvas(pdf_file, pagesize=page_size)
-        valid_pics = self._valid_pictures()
-        num_ok = 0
-        num_pages = 0
+        original_size = None
+        if append and not _is_stream(pdf_file) and Path(pdf_file).exists():
+            original_size = os.path.getsize(pdf_file)
+        self._cancelled.clear()
+        job = asyncio.get_event_loop().run_in_executor(None, save)
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            # wait for the job to stop and clean up
+            try:
+                result = await job
+            except _Cancelled:
+                pass
+            else:
+                # saved before noticing
+                _remove_saved(result, original_size)
+            raise
+
+    def plan(self, page_size='A4', landscape=False, margin=72,
+             layout=(1, 1), stretch_small=False, max_dpi=None):
+        """Return Plan of the pages that save_pdf would save with the
+        same options, without preparing the pictures or writing any
+        file. Only the picture headers are read.
+
+        The plan holds the pages, each a list of Placements of
+        pictures, the errors of files that would be skipped, and
+        the estimated size of the PDF in bytes. The size is a rough
+        estimate from the picture file sizes; pictures with identical
+        contents are counted each time.
+        """
+        page_size = self._validate_page_size(page_size, landscape)
+        layout = self._validate_layout(layout)
+        self._validate_max_dpi(max_dpi)
+        self._hooks = None
+        self.errors = []
         areas = tuple(self._areas(layout, page_size, margin))
-        while True:
-            last_page_empty = True
-            for area in areas:
-                try:
-                    picture = next(valid_pics)
-                except StopIteration:
-                    if not last_page_empty:
-                        num_pages += 1
-                    if num_ok != 0:
-                        pdf_canvas.save()
-                    return Result(num_ok, self.errors, num_pages)
-                x, y, pic_width, pic_height = self._position_and_size(
-                    picture.getSize(), (area.width, area.height), stretch_small
-                )
-                pdf_canvas.drawImage(
-                    picture, area.x + x, area.y + y, pic_width, pic_height,
-                    mask='auto'
+
+        pages = []
+        estimated_bytes = FILE_OVERHEAD
+        for page in self._layout_pages(self._probed_pictures(), layout,
+                                       areas, margin, stretch_small):
+            pages.append([
+                Placement(placed.picture.pic_file, placed.x, placed.y,
+                          placed.width, placed.height)
+                for placed in page
+            ])
+            estimated_bytes += PAGE_OVERHEAD
+            for placed in page:
+                data_size = placed.picture.data_size()
+                if max_dpi is not None:
+                    # downsampled to the size on page
+                    scale = placed.width / 72 * max_dpi / placed.picture.width
+                    data_size *= min(scale, 1) ** 2
+                estimated_bytes += round(data_size) + IMAGE_OVERHEAD
+        num_ok = sum(len(page) for page in pages)
+        return Plan(pages, self.errors, num_ok, len(pages), estimated_bytes)
+
+    def _probed_pictures(self):
+        """Yield (pic_file, picture) pairs of valid picture files,
+        pictures being probed for their size only.
+        """
+        for pic_file in self.pic_files:
+            try:
+                yield pic_file, _ProbedPicture(pic_file)
+            except (UnidentifiedImageError, OSError) as err:
+                # file does not exist, is a dir or is not a picture
+                self.errors.append((pic_file, _named_error(err, pic_file)))
+
+    def _save_pdf(self, pdf_file, page_size, margin, layout, stretch_small,
+                  workers=None, max_dpi=None, streaming=False,
+                  max_pages_per_file=None, max_bytes_per_file=None,
+                  cache=None, append=False, stats=False, hooks=None,
+                  memory_budget=None, compression='default', reencode=None,
+                  jpeg_quality=JPEG_QUALITY, min_saving=None):
+        self._stats = Stats() if stats else None
+        self._hooks = hooks
+        sharded = not (max_pages_per_file is None
+                       and max_bytes_per_file is None)
+        areas = tuple(self._areas(layout, page_size, margin))
+        # rows of auto layout may be taller than the target height,
+        # pictures are at most as large as the area
+        area_size = areas[0].width, areas[0].height
+        if reencode is None:
+            reencode_options = {}
+        else:
+            reencode_options = dict(reencode=reencode,
+                                    jpeg_quality=jpeg_quality,
+                                    min_saving=min_saving)
+        if sharded and max_bytes_per_file is None:
+            # prepared in the worker processes saving the shards
+            ahead_options = dict(keep_pictures=False)
+        else:
+            # sizes of pictures prepared are needed to split the output
+            ahead_options = dict(workers=workers,
+                                 memory_budget=memory_budget,
+                                 keep_pictures=not sharded)
+        valid_pics = self._valid_pictures(
+            cache=cache, area_size=area_size, stretch_small=stretch_small,
+            max_dpi=max_dpi, compression=compression, **ahead_options,
+            **reencode_options
+        )
+        page_compression = compression != 'none'
+        # recorded on the pages, a grid is continued only if it matches
+        page_layout = None if layout == AUTO_LAYOUT else (*layout, margin)
+
+        original_size = 0
+        if append and Path(pdf_file).exists():
+            original_size = os.path.getsize(pdf_file)
+            pdf_canvas = AppendingCanvas(pdf_file, pagesize=page_size,
+                                         pageCompression=page_compression,
+                                         pageLayout=page_layout)
+            num_drawn = pdf_canvas.num_pictures_on_last_page()
+            if num_drawn is not None and 0 < num_drawn < len(areas):
+                # continue the grid on the last page
+                pdf_canvas.continue_last_page()
+            else:
+                num_drawn = 0
+            pages = self._layout_pages(valid_pics, layout, areas, margin,
+                                       stretch_small, num_drawn)
+            num_ok, num_pages, errors = _draw_pages(
+                pdf_canvas, pages, discardable=True, stats=self._stats,
+                hooks=self._hooks
+            )
+            self.errors.extend(errors)
+            shards = [Shard(pdf_file, num_ok, num_pages)] if num_ok else []
+        elif not sharded:
+            pages = self._layout_pages(valid_pics, layout, areas, margin,
+                                       stretch_small)
+            output = pdf_file
+            if _is_stream(pdf_file):
+                output = _CountingStream(pdf_file)
+            num_ok, num_pages, errors, _ = _write_pdf(
+                output, page_size, pages, streaming, self._stats,
+                self._hooks, page_compression, page_layout
+            )
+            self.errors.extend(errors)
+            shards = [Shard(pdf_file, num_ok, num_pages)] if num_ok else []
+        else:
+            pages = self._layout_pages(valid_pics, layout, areas, margin,
+                                       stretch_small)
+            shards = self._save_shards(
+                pdf_file, page_size, pages, workers, streaming,
+                max_pages_per_file, max_bytes_per_file, page_compression,
+                page_layout
+            )
+            num_ok = sum(shard.num_ok for shard in shards)
+            num_pages = sum(shard.num_pages for shard in shards)
+        if self._hooks is not None and not sharded and num_ok:
+            self._hooks.document_saved(pdf_file, num_ok, num_pages)
+        if cache is not None:
+            cache.trim()
+        if self._stats is not None and _is_stream(pdf_file):
+            self._stats.bytes_written = output.num_bytes
+        elif self._stats is not None:
+            self._stats.bytes_written = sum(
+                os.path.getsize(shard.pdf_file) for shard in shards
+            ) - original_size
+
+        return Result(num_ok, self.errors, num_pages, self.num_duplicates,
+                      shards, self._stats)
+
+    def _save_shards(self, pdf_file, page_size, pages, workers, streaming,
+                     max_pages, max_bytes, page_compression=True,
+                     page_layout=None):
+        """Save pages to numbered PDF files, each written in a separate
+        worker process. Return list of shards saved. Shards saved
+        before are removed, so that none are left beyond the new ones.
+        """
+        for shard_path in _existing_shards(pdf_file):
+            shard_path.unlink()
+        workers = workers or os.cpu_count() or 1
+        shards = []
+        pending = deque()
+        shard_files = []
+        try:
+            with ProcessPoolExecutor(workers) as executor:
+                page_groups = self._shard_pages(pages, max_pages, max_bytes)
+                for index, shard_pages in enumerate(page_groups, start=1):
+                    shard_file = _shard_path(pdf_file, index)
+                    shard_files.append(shard_file)
+                    future = executor.submit(
+                        _write_pdf, shard_file, page_size, shard_pages,
+                        streaming, None if self._stats is None else Stats(),
+                        None, page_compression, page_layout
+                    )
+                    pending.append((shard_file, future))
+                    # do not keep pictures of more shards than can be written
+                    if len(pending) > workers:
+                        self._shard_written(shards, *pending.popleft())
+                for shard_file, future in pending:
+                    self._shard_written(shards, shard_file, future)
+        except _Cancelled:
+            for shard_file in shard_files:
+                shard_path = Path(shard_file)
+                if shard_path.exists():
+                    shard_path.unlink()
+            raise
+        return shards
+
+    def _shard_written(self, shards, shard_file, future):
+        """Wait for the shard to be written by a worker process,
+        add it to the list of shards if it is saved.
+        """
+        num_ok, num_pages, errors, stats = future.result()
+        self.errors.extend(errors)
+        if stats is not None:
+            self._stats.merge(stats)
+        if self._hooks is not None:
+            for pic_file, error in errors:
+                self._hooks.picture_failed(pic_file, error)
+            first_page = sum(shard.num_pages for shard in shards) + 1
+            for page_number in range(first_page, first_page + num_pages):
+                self._hooks.page_finished(page_number)
+            if num_ok:
+                self._hooks.document_saved(shard_file, num_ok, num_pages)
+        if num_ok:
+            shards.append(Shard(shard_file, num_ok, num_pages))
+
+    def _layout_pages(self, pictures, layout, areas, margin, stretch_small,
+                      first_area=0):
+        """Yield lists of pictures placed on consecutive pages, in the grid
+        of areas, or packed in rows if layout is AUTO_LAYOUT.
+        """
+        if layout == AUTO_LAYOUT:
+            return self._packed_pages(pictures, areas[0], margin,
+                                      stretch_small)
+        return self._pages(pictures, areas, stretch_small, first_area)
+
+    def _pages(self, pictures, areas, stretch_small, first_area=0):
+        """Yield lists of pictures placed in the drawing areas of
+        consecutive pages, pictures being (pic_file, picture) pairs.
+        On the first page, areas before first_area are skipped.
+        """
+        page = []
+        page_number = 1
+        for pic_file, picture in pictures:
+            if self._cancelled.is_set():
+                raise _Cancelled
+            area = areas[first_area + len(page)]
+            x, y, pic_width, pic_height = self._position_and_size(
+                picture.getSize(), (area.width, area.height), stretch_small
+            )
+            page.append(PlacedPicture(
+                picture, area.x + x, area.y + y, pic_width, pic_height
+            ))
+            if self._hooks is not None:
+                self._hooks.picture_placed(pic_file, area, page_number)
+            if first_area + len(page) == len(areas):
+                yield page
+                page = []
+                page_number += 1
+                first_area = 0
+        if self._cancelled.is_set():
+            # before the PDF is saved
+            raise _Cancelled
+        if page:
+            yield page
+
+    def _packed_pages(self, pictures, area, spacing, stretch_small):
+        """Yield lists of pictures packed in justified rows in the area
+        of consecutive pages, pictures being (pic_file, picture) pairs.
+
+        Pictures of a row are scaled to the same height, so that the row
+        fills the area width at about the height of AUTO_ROWS rows per
+        page. A row not fitting at the bottom of a page is scaled down
+        to fit, if it would not shrink by more than MAX_ROW_SHRINK.
+        Rows not filling the width (the last one, or rows scaled down)
+        are centered.
+        """
+        page = []
+        page_number = 1
+        top = area.y + area.height
+        rows = _justified_rows(pictures, area.width,
+                               _row_height(area, spacing), spacing)
+        for row, height in rows:
+            if self._cancelled.is_set():
+                raise _Cancelled
+            if height > top - area.y + 1e-6:
+                if page and (top - area.y) < height * (1 - MAX_ROW_SHRINK):
+                    yield page
+                    page = []
+                    page_number += 1
+                    top = area.y + area.height
+                # scaled down to fit
+                height = min(height, top - area.y)
+            row_width = (len(row) - 1) * spacing + sum(
+                pic_width / pic_height * height
+                for pic_width, pic_height in (
+                    picture.getSize() for _, picture in row
                 )
-                last_page_empty = False
-                num_ok += 1
-            pdf_canvas.showPage()
-            num_pages += 1
+            )
+            self._place_row(page, row, area.x + (area.width - row_width) / 2,
+                            top - height, height, spacing, stretch_small,
+                            page_number)
+            top -= height + spacing
+        if self._cancelled.is_set():
+            raise _Cancelled
+        if page:
+            yield page
+
+    def _place_row(self, page, row, x, y, height, spacing, stretch_small,
+                   page_number):
+        """Add pictures of the row, (pic_file, picture) pairs, to the page,
+        in slots of the given height starting from x, y.
+        """
+        for pic_file, picture in row:
+            pic_width, pic_height = picture.getSize()
+            slot = DrawingArea(x, y, pic_width / pic_height * height, height)
+            pic_x, pic_y, pic_width, pic_height = self._position_and_size(
+                (pic_width, pic_height), (slot.width, slot.height),
+                stretch_small
+            )
+            page.append(PlacedPicture(
+                picture, slot.x + pic_x, slot.y + pic_y, pic_width, pic_height
+            ))
+            if self._hooks is not None:
+                self._hooks.picture_placed(pic_file, slot, page_number)
+            x += slot.width + spacing
+
+    @staticmethod
+    def _shard_pages(pages, max_pages=None, max_bytes=None):
+        """Yield lists of pages, each list to be saved to one file.
+
+        A list holds at most max_pages pages, and pages whose estimated
+        size in PDF is at most max_bytes. A page exceeding max_bytes on
+        its own is saved to a file alone.
+        """
+        shard = []
+        shard_bytes = FILE_OVERHEAD
+        shard_pictures = set()
+        for page in pages:
+            # sizes are only known once the pictures are prepared
+            page_bytes = (0 if max_bytes is None
+                          else _estimated_bytes(page, shard_pictures))
+            if shard and (len(shard) == max_pages
+                          or max_bytes is not None
+                          and shard_bytes + page_bytes > max_bytes):
+                yield shard
+                shard = []
+                shard_bytes = FILE_OVERHEAD
+                shard_pictures = set()
+                if max_bytes is not None:
+                    page_bytes = _estimated_bytes(page, shard_pictures)
+            shard.append(page)
+            shard_bytes += page_bytes
+            shard_pictures.update(id(placed.picture) for placed in page)
+        if shard:
+            yield shard
 
     @staticmethod
     def _validate_target_path(file_path, force_overwrite):
@@ -77,15 +522,71 @@ class PictureShow:
 
         return target_str
 
+    @classmethod
+    def _validate_shard_paths(cls, file_path, force_overwrite):
+        """Like _validate_target_path, but check the numbered files
+        that shards of file_path would be saved to.
+        """
+        for shard_path in _existing_shards(file_path):
+            cls._validate_target_path(shard_path, force_overwrite)
+
+        return str(file_path)
+
+    @staticmethod
+    def _validate_shard_limits(max_pages, max_bytes):
+        for limit in max_pages, max_bytes:
+            if limit is not None and not (isinstance(limit, int)
+                                          and limit > 0):
+                raise ValueError(
+                    f'invalid limit {limit!r}, positive integer expected'
+                )
+
+    @staticmethod
+    def _validate_max_dpi(max_dpi):
+        if max_dpi is not None and not (isinstance(max_dpi, (int, float))
+                                        and max_dpi > 0):
+            raise ValueError(f'invalid max DPI {max_dpi!r},'
+                             f' positive number expected')
+
+    @staticmethod
+    def _validate_memory_budget(memory_budget):
+        if memory_budget is not None and not (isinstance(memory_budget, int)
+                                              and memory_budget > 0):
+            raise ValueError(f'invalid memory budget {memory_budget!r},'
+                             f' positive integer expected')
+
+    @staticmethod
+    def _validate_compression(compression):
+        if compression not in COMPRESSION_LEVELS:
+            raise ValueError(
+                f'invalid compression {compression!r},'
+                f' please use one of: {", ".join(COMPRESSION_LEVELS)}'
+            )
+
+    @staticmethod
+    def _validate_reencode(reencode, jpeg_quality, min_saving):
+        if reencode is not None and reencode not in REENCODINGS:
+            raise ValueError(
+                f'invalid reencode {reencode!r},'
+                f' please use one of: {", ".join(REENCODINGS)}'
+            )
+        if not (isinstance(jpeg_quality, int) and 1 <= jpeg_quality <= 95):
+            raise ValueError(f'invalid JPEG quality {jpeg_quality!r},'
+                             f' integer from 1 to 95 expected')
+        if min_saving is not None and not (
+                isinstance(min_saving, (int, float)) and 0 <= min_saving < 1):
+            raise ValueError(f'invalid minimum saving {min_saving!r},'
+                             f' number from 0 to 1 (excluded) expected')
+
     @staticmethod
     def _validate_page_size(page_size, landscape):
         if isinstance(page_size, str):
             try:
-                page_size = PAGE_SIZES[page_size.upper()]
+                page_size = _page_sizes()[page_size.upper()]
             except KeyError as err:
                 raise PageSizeError(
                     f'unknown page size {page_size!r},'
-                    f' please use one of: {", ".join(PAGE_SIZES)}'
+                    f' please use one of: {", ".join(_page_sizes())}'
                 ) from err
 
         page_size_error = PageSizeError('two positive numbers expected')
@@ -102,6 +603,8 @@ class PictureShow:
 
     @staticmethod
     def _validate_layout(layout):
+        if isinstance(layout, str) and layout.strip().lower() == AUTO_LAYOUT:
+            return AUTO_LAYOUT
         layout_error = LayoutError('two positive integers expected')
         try:
             if isinstance(layout, str):
@@ -115,17 +618,181 @@ class PictureShow:
 
         return columns, rows
 
-    def _valid_pictures(self):
+    def _valid_pictures(self, workers=None, cache=None, memory_budget=None,
+                        keep_pictures=True, **prepare_options):
+        """Yield (pic_file, picture) pairs of valid picture files,
+        in input order.
+
+        Pictures are probed in the main process and prepared when drawn,
+        or prepared ahead if workers or memory_budget is specified.
+        Files with identical contents are prepared only once and yield
+        the same picture (unless keep_pictures is false, see
+        _prepared_pictures). If cache is specified, pictures found in it
+        are not prepared again, and newly prepared pictures are stored
+        in it.
+        """
         self.errors = []
+        self.num_duplicates = 0
+        if workers is None and memory_budget is None:
+            results = self._prepared_pictures(prepare_options, cache,
+                                              keep_pictures)
+        else:
+            results = self._prepared_pictures_ahead(
+                workers, memory_budget, prepare_options, cache, keep_pictures
+            )
+        for pic_file, result, is_duplicate in results:
+            if isinstance(result, Exception):
+                result = _named_error(result, pic_file)
+                self.errors.append((pic_file, result))
+                if self._hooks is not None:
+                    self._hooks.picture_failed(pic_file, result)
+            else:
+                self.num_duplicates += is_duplicate
+                if self._hooks is not None:
+                    self._hooks.picture_opened(pic_file)
+                yield pic_file, result
+
+    def _read_pictures(self):
+        """Yield (pic_file, key, data) triples, key being the digest of
+        the file contents. If the file cannot be read, key is None and
+        data is the error.
+        """
         for pic_file in self.pic_files:
+            timings = None if self._stats is None else {}
             try:
-                picture = ImageReader(pic_file)
-            except (UnidentifiedImageError, OSError) as err:
-                # UnidentifiedImageError: file not recognized as picture
-                # OSError: file does not exist or is a dir
-                self.errors.append((pic_file, err))
+                with timed(timings, 'read'):
+                    data = open_and_read(pic_file)
+            except OSError as err:
+                # file does not exist or is a dir
+                yield pic_file, None, err
             else:
-                yield picture
+                if timings is not None:
+                    self._stats.add(timings, pic_file)
+                    self._stats.bytes_read += len(data)
+                yield pic_file, _digester(data), data
+
+    def _prepared_pictures(self, prepare_options, cache=None,
+                           keep_pictures=True):
+        """Yield (pic_file, result, is_duplicate) triples, result being
+        the picture or the error raised while reading or probing it.
+
+        Only the picture header is read here, the picture is prepared
+        when it is drawn. Unless keep_pictures is true, a picture is
+        yielded again for a duplicate only while it is still in use
+        elsewhere, e.g. on pages waiting to be saved, so that pictures
+        do not pile up in memory.
+        """
+        errors = {}
+        pictures = {} if keep_pictures else weakref.WeakValueDictionary()
+        seen = set()
+        for pic_file, key, data in self._read_pictures():
+            if key is None:
+                yield pic_file, data, False
+                continue
+            is_duplicate = key in seen
+            seen.add(key)
+            result = errors.get(key) or pictures.get(key)
+            if result is None and cache is not None:
+                result = cache.get(key, prepare_options)
+            if result is None:
+                timings = None if self._stats is None else {}
+                try:
+                    with timed(timings, 'probe'):
+                        result = _LazyPicture(
+                            pic_file, data,
+                            {**prepare_options, 'cache': cache,
+                             'digest': key,
+                             'with_timings': timings is not None}
+                        )
+                except (UnidentifiedImageError, OSError) as err:
+                    # file not recognized as picture
+                    result = err
+                if timings is not None:
+                    self._stats.add(timings, pic_file)
+            if isinstance(result, Exception):
+                errors[key] = result
+            else:
+                pictures[key] = result
+            yield pic_file, result, is_duplicate
+
+    def _prepared_pictures_ahead(self, workers, memory_budget,
+                                 prepare_options, cache=None,
+                                 keep_pictures=True):
+        """Like _prepared_pictures, but prepare pictures ahead of drawing
+        them, in a pool of worker processes, or in a background thread
+        if workers is None.
+
+        At most two pictures per worker (or thread) are kept pending,
+        so that finished pictures do not pile up in memory while waiting
+        to be drawn. If memory_budget is specified, pictures are also
+        held back while the estimated memory needed by the pictures
+        pending would exceed it. At least one picture is pending,
+        however large.
+        """
+        if workers is None:
+            executor = ThreadPoolExecutor(1)
+            max_pending = 2
+        else:
+            executor = ProcessPoolExecutor(workers)
+            max_pending = 2 * workers
+        if memory_budget is None:
+            memory_budget = float('inf')
+        # pictures being prepared and errors, by key
+        results = {}
+        pictures = {} if keep_pictures else weakref.WeakValueDictionary()
+        seen = set()
+        with executor:
+            pending = deque()
+            pending_bytes = 0
+            for pic_file, key, data in self._read_pictures():
+                is_duplicate = key in seen
+                footprint = 0
+                if key is None:
+                    result = data
+                else:
+                    seen.add(key)
+                    result = results.get(key) or pictures.get(key)
+                    if result is None and cache is not None:
+                        result = cache.get(key, prepare_options)
+                        if result is not None:
+                            pictures[key] = result
+                    if result is None:
+                        footprint = _footprint(data)
+                while pending and (len(pending) >= max_pending
+                                   or pending_bytes + footprint
+                                   > memory_budget):
+                    *entry, entry_bytes = pending.popleft()
+                    pending_bytes -= entry_bytes
+                    yield self._resolved(results, pictures, *entry)
+                if footprint:
+                    result = results[key] = executor.submit(
+                        _prepare_picture, data, cache, key,
+                        self._stats is not None, **prepare_options
+                    )
+                pending.append(
+                    (pic_file, key, result, is_duplicate, footprint)
+                )
+                pending_bytes += footprint
+            for *entry, _ in pending:
+                yield self._resolved(results, pictures, *entry)
+
+    def _resolved(self, results, pictures, pic_file, key, result,
+                  is_duplicate):
+        """Wait for the picture to be prepared by a worker process."""
+        if not isinstance(result, Future):
+            return pic_file, result, is_duplicate
+        try:
+            picture = result.result()
+        except (UnidentifiedImageError, OSError) as err:
+            results[key] = err
+            return pic_file, err, is_duplicate
+        if results.get(key) is result:
+            # first of the duplicates waiting for the picture
+            if self._stats is not None:
+                self._stats.add_picture(picture, pic_file)
+            del results[key]
+            pictures[key] = picture
+        return pic_file, picture, is_duplicate
 
     @staticmethod
     def _position_and_size(pic_size, area_size, stretch_small):
@@ -149,9 +816,30 @@ class PictureShow:
 
         return x, y, pic_width, pic_height
 
+    @staticmethod
+    def _downsampled(picture, size, max_dpi):
+        """Return picture resampled to max_dpi at the given size (in
+        points), or the picture itself if its resolution is not higher.
+        """
+        pic_width, pic_height = picture.getSize()
+        scale = size[0] / 72 * max_dpi / pic_width
+        if scale >= 1:
+            return picture
+
+        new_size = (max(1, round(pic_width * scale)),
+                    max(1, round(pic_height * scale)))
+        image = picture._image
+        # JPEG decoder can scale down cheaply while decoding
+        image.draft(image.mode, (2 * new_size[0], 2 * new_size[1]))
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA', 'CMYK'):
+            has_alpha = 'A' in image.mode or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+        return ImageReader(image.resize(new_size, Image.LANCZOS))
+
     @staticmethod
     def _areas(layout, page_size, margin):
-        columns, rows = layout
+        packed = layout == AUTO_LAYOUT
+        columns, rows = (1, AUTO_ROWS) if packed else layout
         page_width, page_height = page_size
 
         margins_too_wide = margin * (columns + 1) >= page_width
@@ -159,6 +847,12 @@ class PictureShow:
         if margins_too_wide or margins_too_high:
             raise MarginError(f'margin value too high: {margin}')
 
+        if packed:
+            # one area in which pictures are packed
+            yield DrawingArea(margin, margin, page_width - 2 * margin,
+                              page_height - 2 * margin)
+            return
+
         area_width = (page_width - (columns + 1) * margin) / columns
         area_height = (page_height - (rows + 1) * margin) / rows
 
@@ -169,12 +863,731 @@ class PictureShow:
                 yield DrawingArea(area_x, area_y, area_width, area_height)
 
 
+def _row_height(area, spacing):
+    """Return height of full rows of pictures packed in the area."""
+    return (area.height - (AUTO_ROWS - 1) * spacing) / AUTO_ROWS
+
+
+def _justified_rows(pictures, width, target_height, spacing):
+    """Yield (row, height) pairs, row being a list of (pic_file, picture)
+    pairs which fill the width when scaled to height.
+
+    A row ends where its height is closest to target_height, with
+    or without the picture which makes it overflow at target_height.
+    The last row is not filled, its height is target_height.
+    """
+    row = []
+    row_aspect = 0
+    for pic_file, picture in pictures:
+        pic_width, pic_height = picture.getSize()
+        aspect = pic_width / pic_height
+        row.append((pic_file, picture))
+        row_aspect += aspect
+        if row_aspect * target_height + (len(row) - 1) * spacing < width:
+            continue
+        height = (width - (len(row) - 1) * spacing) / row_aspect
+        if len(row) > 1:
+            height_without = ((width - (len(row) - 2) * spacing)
+                              / (row_aspect - aspect))
+            if height_without / target_height < target_height / height:
+                # closer to target without the last picture
+                yield row[:-1], height_without
+                row = row[-1:]
+                row_aspect = aspect
+                if aspect * target_height < width:
+                    continue
+                height = width / aspect
+        yield row, height
+        row = []
+        row_aspect = 0
+    if row:
+        yield row, target_height
+
+
+class _PictureCanvas(Canvas):
+    """Canvas able to draw prepared pictures. If pageLayout (columns,
+    rows, margin) is specified, it is recorded on each page.
+    """
+
+    def __init__(self, *args, pageLayout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._page_layout = pageLayout
+
+    def showPage(self):
+        super().showPage()
+        if self._page_layout is not None:
+            page = self._doc.Pages.pages[-1]
+            # private key, written as the standard ones
+            page.__NoDefault__ = [*page.__NoDefault__, LAYOUT_KEY]
+            setattr(page, LAYOUT_KEY, PDFArray(list(self._page_layout)))
+
+    def drawPicture(self, picture, x, y, width, height):
+        """Draw the picture like drawImage does, registering its image
+        object with the document on first use.
+        """
+        image = picture.image
+        doc = self._doc
+        reg_name = doc.getXObjectName(image.name)
+        if reg_name not in doc.idToObject:
+            doc.Reference(image, reg_name)
+            doc.addForm(image.name, image)
+            smask = getattr(image, '_smask', None)
+            if smask:
+                mask_reg_name = doc.getXObjectName(smask.name)
+                if mask_reg_name not in doc.idToObject:
+                    image.smask = doc.Reference(smask, mask_reg_name)
+                else:
+                    image.smask = PDFObjectReference(mask_reg_name)
+                del image._smask
+
+        self._currentPageHasImages = 1
+        self.saveState()
+        self.translate(x, y)
+        self.scale(width, height)
+        self._code.append(f'/{reg_name} Do')
+        self.restoreState()
+        self._formsinuse.append(image.name)
+
+
+class _PreparedPicture:
+    """Picture compressed to a PDF image object, ready to be drawn.
+
+    Unlike ImageReader, instances are cheap to pickle, so pictures can
+    be prepared in worker processes and drawn in the main process.
+    """
+
+    def __init__(self, image, size=None):
+        self.image = image
+        # size of the original picture, even if downsampled
+        self.size = size or (image.width, image.height)
+        # time spent preparing the picture, if measured
+        self.timings = None
+
+    @classmethod
+    def from_file(cls, data, area_size=None, stretch_small=False,
+                  max_dpi=None, compression='default', reencode=None,
+                  jpeg_quality=JPEG_QUALITY, min_saving=None, timings=None):
+        """Decode picture file contents, downsample the picture
+        if needed and compress it at the given compression level.
+        If timings is specified, the time of each phase is added to it.
+
+        With reencode='jpeg', a picture without transparency is
+        re-encoded as JPEG at jpeg_quality instead. If min_saving
+        is specified, the JPEG is used only if it is smaller than
+        the lossless image by at least that fraction.
+        """
+        reader = ImageReader(BytesIO(data))
+        size = reader.getSize()
+        if max_dpi is not None:
+            *_, pic_width, pic_height = PictureShow._position_and_size(
+                reader.getSize(), area_size, stretch_small
+            )
+            with timed(timings, 'scale'):
+                reader = PictureShow._downsampled(
+                    reader, (pic_width, pic_height), max_dpi
+                )
+        binary_alpha = False
+        with timed(timings, 'decode'):
+            pixels = reader.getRGBData()
+            if reader._dataA:
+                histogram = reader._dataA._image.histogram()
+                if not any(histogram[:255]):
+                    # fully opaque, embedded without mask
+                    reader._dataA = None
+                else:
+                    binary_alpha = not any(histogram[1:255])
+                    pixels += reader._dataA.getRGBData()
+        reencoded = None
+        if reencode is not None and not (reader._dataA
+                                         or reader.getTransparent()):
+            with timed(timings, 'compress'):
+                reencoded = _jpeg_image(_jpeg_encoded(reader, jpeg_quality))
+            if min_saving is None:
+                return cls(reencoded, size)
+            # PNG data is embedded as is if not re-encoded
+            lossless = cls.from_encoded(data, area_size, stretch_small,
+                                        max_dpi)
+            if lossless is not None:
+                if _saves_enough(reencoded, lossless.image, min_saving):
+                    return cls(reencoded, size)
+                return lossless
+        with timed(timings, 'compress'):
+            image = _decoded_image(_digester(pixels), reader,
+                                   COMPRESSION_LEVELS[compression],
+                                   binary_alpha)
+        if reencoded is not None and _saves_enough(reencoded, image,
+                                                   min_saving):
+            image = reencoded
+        return cls(image, size)
+
+    @classmethod
+    def from_encoded(cls, data, area_size=None, stretch_small=False,
+                     max_dpi=None, compression='default', reencode=None,
+                     **reencode_options):
+        """Embed the compressed data of a JPEG or PNG picture file
+        unchanged, without decoding it, whatever the compression.
+
+        Return None if the picture cannot be passed through as is,
+        if it has to be downsampled, or if it is a PNG picture
+        to be re-encoded.
+        """
+        if data.startswith(JPEG_SIGNATURE):
+            make_image = _jpeg_image
+        elif data.startswith(PNG_SIGNATURE) and reencode is None:
+            make_image = _png_image
+        else:
+            return None
+        try:
+            image = make_image(data)
+        except ValueError:
+            return None
+        if max_dpi is not None:
+            *_, pic_width, _ = PictureShow._position_and_size(
+                (image.width, image.height), area_size, stretch_small
+            )
+            if pic_width / 72 * max_dpi < image.width:
+                return None
+        return cls(image)
+
+    def getSize(self):
+        return self.size
+
+    def prepare(self):
+        return self
+
+    def data_size(self):
+        """Return number of bytes of image data, including soft mask."""
+        size = len(self.image.streamContent)
+        smask = getattr(self.image, '_smask', None)
+        if smask:
+            size += len(smask.streamContent)
+        return size
+
+
+class _LazyPicture:
+    """Picture file probed for its size only.
+
+    The pixel data is decoded and compressed on the first call
+    of prepare(), which returns the prepared picture, or raises
+    the error met while preparing it.
+    """
+
+    def __init__(self, pic_file, data, prepare_options):
+        with Image.open(BytesIO(data)) as image:
+            # only the header has been read so far
+            self._size = image.size
+        self.pic_file = pic_file
+        self._data = data
+        self._prepare_options = prepare_options
+        self._picture = None
+        self._error = None
+
+    def getSize(self):
+        return self._size
+
+    def prepare(self):
+        if self._error is not None:
+            raise self._error
+        if self._picture is None:
+            try:
+                self._picture = _prepare_picture(
+                    self._data, **self._prepare_options
+                )
+            except (UnidentifiedImageError, OSError) as err:
+                self._error = err
+                raise
+            finally:
+                self._data = None
+        return self._picture
+
+    def data_size(self):
+        """Return data size of the prepared picture, or 0 if it cannot
+        be prepared.
+        """
+        try:
+            return self.prepare().data_size()
+        except (UnidentifiedImageError, OSError):
+            return 0
+
+
+class _ProbedPicture:
+    """Picture file probed for its size only, when planning. Unlike
+    _LazyPicture, only the start of local files is read.
+    """
+
+    def __init__(self, pic_file):
+        self.pic_file = pic_file
+        if '://' in str(pic_file):
+            data = open_and_read(pic_file)
+            self._file_size = len(data)
+            source = BytesIO(data)
+        else:
+            with open(pic_file, 'rb') as f:
+                data = f.read(HEADER_SIZE)
+                self._file_size = os.fstat(f.fileno()).st_size
+            source = pic_file
+        size = _header_size(data)
+        if size is None:
+            # other formats, or header not within the data read
+            with Image.open(source) as image:
+                size = image.size
+        self.width, self.height = size
+
+    def getSize(self):
+        return self.width, self.height
+
+    def data_size(self):
+        """Return estimated number of bytes of image data in PDF: the
+        picture file size, as pictures are either embedded as is or
+        compressed about as well as in the file.
+        """
+        return self._file_size
+
+
+@functools.lru_cache(maxsize=None)
+def _page_sizes():
+    """Return dictionary of page sizes defined in reportlab by name,
+    collected on first use.
+    """
+    return {
+        name: size
+        for name, size in pagesizes.__dict__.items()
+        # use isupper() to exclude deprecated names and function names
+        if name.isupper()
+    }
+
+
+def _decoded_image(name, reader, level, binary_alpha=False):
+    """Return image object of the decoded picture, with its alpha
+    channel as soft mask, Flate-compressed at the zlib level (or left
+    uncompressed if level is None). If binary_alpha is true, all alpha
+    values are 0 or 255, and the soft mask has 1 bit per pixel.
+    """
+    image = PDFImageXObject(name)
+    image.width, image.height = reader.getSize()
+    image.bitsPerComponent = 8
+    image.colorSpace = COLOR_SPACES[len(reader.mode)]
+    image.streamContent, image._filters = _flate(reader.getRGBData(), level)
+    image.mask = None
+    if reader._dataA:
+        alpha = reader._dataA
+        if binary_alpha:
+            image._smask = _binary_mask(alpha._image, level)
+        else:
+            image._smask = _decoded_image(_digester(alpha.getRGBData()),
+                                          alpha, level)
+        image._smask._decode = [0, 1]
+    else:
+        color = reader.getTransparent()
+        if color:
+            # colour key masking
+            red, green, blue = color
+            image.mask = (red, red, green, green, blue, blue)
+    return image
+
+
+def _binary_mask(alpha, level):
+    """Return image object of the alpha channel (a PIL image with
+    values 0 or 255 only) with 1 bit per pixel, compressed like
+    _decoded_image does.
+    """
+    data = alpha.convert('1', dither=Image.NONE).tobytes()
+    mask = PDFImageXObject(_digester(data))
+    mask.width, mask.height = alpha.size
+    mask.bitsPerComponent = 1
+    mask.colorSpace = 'DeviceGray'
+    mask.streamContent, mask._filters = _flate(data, level)
+    mask.mask = None
+    return mask
+
+
+def _flate(data, level):
+    """Return data compressed at the zlib level, and the PDF filters
+    to decode it.
+    """
+    if level is None:
+        return data, ()
+    return zlib.compress(data, level), ('FlateDecode',)
+
+
+def _jpeg_encoded(reader, quality):
+    """Return JPEG data of the decoded picture, at the quality."""
+    image = Image.frombytes(reader.mode, reader.getSize(),
+                            reader.getRGBData())
+    stream = BytesIO()
+    image.save(stream, 'JPEG', quality=quality)
+    return stream.getvalue()
+
+
+def _saves_enough(reencoded, image, min_saving):
+    """Return True if the data of the re-encoded image is smaller than
+    the data of the image by at least the min_saving fraction.
+    """
+    return (len(reencoded.streamContent)
+            <= (1 - min_saving) * len(image.streamContent))
+
+
+def _header_size(data):
+    """Return width and height of a JPEG or PNG picture parsed from
+    the start of its data, or None if they are not found there.
+    """
+    if data.startswith(PNG_SIGNATURE) and data[12:16] == b'IHDR':
+        return struct.unpack_from('>II', data, 16)
+    try:
+        width, height, _ = _jpeg_info(data)
+    except ValueError:
+        return None
+    return width, height
+
+
+def _jpeg_info(data):
+    """Return width, height and number of components of JPEG data.
+
+    Only the marker segments up to the frame header are parsed.
+    Raise ValueError if data is not an 8-bit baseline or progressive
+    JPEG with 1, 3 or 4 components.
+    """
+    if not data.startswith(JPEG_SIGNATURE):
+        raise ValueError('not a JPEG')
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError('marker expected')
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # marker without parameters
+            pos += 2
+            continue
+        if marker in (0xC0, 0xC1, 0xC2):
+            # start of frame: baseline, extended sequential or progressive
+            try:
+                precision, height, width, components = struct.unpack_from(
+                    '>BHHB', data, pos + 4
+                )
+            except struct.error as err:
+                raise ValueError('truncated frame header') from err
+            if (precision != 8 or height == 0
+                    or components not in COLOR_SPACES):
+                raise ValueError('unsupported frame header')
+            return width, height, components
+        if (0xC3 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC)
+                or marker in (0xD9, 0xDA)):
+            # lossless or arithmetic coding, or no frame header
+            raise ValueError('unsupported JPEG')
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+
+    raise ValueError('frame header not found')
+
+
+def _jpeg_image(data):
+    """Return image object embedding JPEG data as is."""
+    width, height, components = _jpeg_info(data)
+    image = PDFImageXObject(_digester(data))
+    image.width = width
+    image.height = height
+    image.bitsPerComponent = 8
+    image.colorSpace = COLOR_SPACES[components]
+    # CMYK JPEG data is stored inverted (Adobe convention)
+    image._dotrans = components == 4
+    image._filters = ('DCTDecode',)
+    image.streamContent = data
+    image.mask = None
+    return image
+
+
+def _png_info(data):
+    """Return width, height, number of colour components and
+    the compressed image data of PNG data.
+
+    Raise ValueError if data is not an 8-bit, non-interlaced greyscale
+    or RGB PNG without transparency.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('not a PNG')
+
+    header = None
+    idat_chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        if len(chunk) != length:
+            raise ValueError('truncated chunk')
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif chunk_type == b'IDAT':
+            idat_chunks.append(chunk)
+        elif chunk_type == b'tRNS':
+            raise ValueError('transparency not supported')
+        elif chunk_type == b'IEND':
+            break
+        pos += 12 + length
+
+    if header is None or not idat_chunks:
+        raise ValueError('header or image data not found')
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if (bit_depth != 8 or color_type not in PNG_COLOR_TYPES
+            or interlace != 0):
+        raise ValueError('unsupported PNG')
+    return width, height, PNG_COLOR_TYPES[color_type], b''.join(idat_chunks)
+
+
+def _png_image(data):
+    """Return image object embedding compressed PNG data as is."""
+    width, height, components, idat_data = _png_info(data)
+    image = _PredictorImageXObject(_digester(data))
+    image.width = width
+    image.height = height
+    image.bitsPerComponent = 8
+    image.colorSpace = COLOR_SPACES[components]
+    image._filters = ('FlateDecode',)
+    image.decodeParms = {'Predictor': 15, 'Colors': components,
+                         'BitsPerComponent': 8, 'Columns': width}
+    image.streamContent = idat_data
+    image.mask = None
+    return image
+
+
+class _PredictorImageXObject(PDFImageXObject):
+    """Image object with Flate-compressed data using PNG predictors."""
+
+    def format(self, document):
+        stream = PDFStream(content=self.streamContent)
+        stream.dictionary.dict.update(
+            Type=PDFName('XObject'),
+            Subtype=PDFName('Image'),
+            Width=self.width,
+            Height=self.height,
+            BitsPerComponent=self.bitsPerComponent,
+            ColorSpace=PDFName(self.colorSpace),
+            Filter=PDFArray([PDFName(name) for name in self._filters]),
+            # one dictionary per filter
+            DecodeParms=PDFArray([PDFDictionary(self.decodeParms)]),
+        )
+        return stream.format(document)
+
+
+def _named_error(err, pic_file):
+    """Return error like err, naming pic_file in its message instead of
+    the in-memory file it was read from, so that errors read the same
+    wherever the picture was probed or prepared.
+    """
+    message = READER_PREFIX.sub('', str(err), count=1)
+    message = BYTES_IO_REPR.sub(repr(str(pic_file)), message)
+    if message == str(err):
+        return err
+    return type(err)(message)
+
+
+def _footprint(data):
+    """Return estimated number of bytes of memory needed to prepare
+    a picture: its file contents, and its decoded pixels with their
+    compressed copy, as an upper bound. The picture dimensions are
+    read from the header only.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+            num_bands = len(image.getbands())
+    except (UnidentifiedImageError, OSError):
+        # preparing will fail early
+        return len(data)
+    return len(data) + 2 * width * height * num_bands
+
+
+def _prepare_picture(data, cache=None, digest=None, with_timings=False,
+                     **options):
+    """Return picture prepared from picture file contents. If cache
+    is specified, store the picture in it under the digest of the file
+    contents. If with_timings is true, the time of each phase is stored in the
+    timings attribute of the picture.
+
+    Module-level function, so that it can be called in worker processes.
+    """
+    timings = {} if with_timings else None
+    picture = (_PreparedPicture.from_encoded(data, **options)
+               or _PreparedPicture.from_file(data, timings=timings,
+                                             **options))
+    if cache is not None:
+        cache.put(digest, options, picture)
+    picture.timings = timings
+    return picture
+
+
+def _write_pdf(pdf_file, page_size, pages, streaming=False, stats=None,
+               hooks=None, page_compression=True, page_layout=None):
+    """Draw placed pictures to PDF file page by page. Return number
+    of pictures and pages saved, list of (pic_file, error) pairs
+    for pictures which failed to be prepared, and stats. The file is
+    saved only if there is any picture. page_layout (columns, rows,
+    margin) of a grid is recorded on the pages. Stats are returned
+    for worker processes to pass them back.
+    """
+    canvas_class = StreamingCanvas if streaming else _PictureCanvas
+    pdf_canvas = canvas_class(pdf_file, pagesize=page_size,
+                              pageCompression=page_compression,
+                              pageLayout=page_layout)
+    num_ok, num_pages, errors = _draw_pages(
+        pdf_canvas, pages, discardable=streaming, stats=stats, hooks=hooks
+    )
+    return num_ok, num_pages, errors, stats
+
+
+def _draw_pages(pdf_canvas, pages, discardable=False, stats=None,
+                hooks=None):
+    """Draw placed pictures on canvas page by page and save it, if
+    there is any picture. Return number of pictures and pages saved,
+    and list of (pic_file, error) pairs for pictures which failed
+    to be prepared. If stats is specified, the time of each phase
+    is added to it. If hooks are specified, they are called for
+    pictures failing and pages finished.
+
+    The canvas is discarded if discardable is true and nothing is
+    saved, so that no unfinished file is left.
+    """
+    num_ok = 0
+    num_pages = 0
+    errors = []
+    timings = None if stats is None else {}
+    try:
+        for page in pages:
+            for picture, *position in page:
+                try:
+                    prepared = picture.prepare()
+                except (UnidentifiedImageError, OSError) as err:
+                    # corrupt pixel data, the drawing area is left empty
+                    err = _named_error(err, picture.pic_file)
+                    errors.append((picture.pic_file, err))
+                    if hooks is not None:
+                        hooks.picture_failed(picture.pic_file, err)
+                    continue
+                if stats is not None:
+                    stats.add_picture(prepared,
+                                      getattr(picture, 'pic_file', None))
+                with timed(timings, 'draw'):
+                    pdf_canvas.drawPicture(prepared, *position)
+                num_ok += 1
+            with timed(timings, 'draw'):
+                pdf_canvas.showPage()
+            num_pages += 1
+            if hooks is not None:
+                hooks.page_finished(num_pages)
+    except BaseException:
+        if discardable:
+            pdf_canvas.discard()
+        raise
+    if num_ok != 0:
+        with timed(timings, 'save'):
+            pdf_canvas.save()
+    elif discardable:
+        pdf_canvas.discard()
+    if stats is not None:
+        stats.add(timings)
+    return num_ok, num_pages, errors
+
+
+def _estimated_bytes(page, known_pictures):
+    """Return estimated size of page in PDF, in bytes. Pictures whose
+    id is in known_pictures are already saved and not counted again.
+    """
+    new_pictures = {id(placed.picture): placed.picture for placed in page
+                    if id(placed.picture) not in known_pictures}
+    return PAGE_OVERHEAD + sum(picture.data_size() + IMAGE_OVERHEAD
+                               for picture in new_pictures.values())
+
+
+class _CountingStream:
+    """Writable binary stream counting the bytes written to stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.num_bytes = 0
+
+    def write(self, data):
+        self.num_bytes += len(data)
+        return self.stream.write(data)
+
+
+def _is_stream(pdf_file):
+    """Return True if pdf_file is a writable stream rather than a path."""
+    return callable(getattr(pdf_file, 'write', None))
+
+
+def _remove_saved(result, original_size=None):
+    """Remove the files saved, or truncate the file appended to back
+    to original_size. Streams are left as they are.
+    """
+    for shard in result.shards:
+        if _is_stream(shard.pdf_file):
+            continue
+        if original_size is None:
+            os.remove(shard.pdf_file)
+        else:
+            os.truncate(shard.pdf_file, original_size)
+
+
+def _shard_path(pdf_file, index):
+    """Return path of the shard with given index, numbered with three
+    digits before the suffix, e.g. 'out.pdf' -> 'out-001.pdf'.
+    """
+    path = Path(pdf_file)
+    if isinstance(index, int):
+        index = f'{index:03d}'
+    return str(path.with_name(f'{path.stem}-{index}{path.suffix}'))
+
+
+def _existing_shards(pdf_file):
+    """Return paths of existing shards of pdf_file, numbered from 1 up
+    to the first number missing, as they would have been saved.
+    """
+    paths = []
+    for index in itertools.count(1):
+        shard_path = Path(_shard_path(pdf_file, index))
+        if not shard_path.exists():
+            return paths
+        paths.append(shard_path)
+
+
 def pictures_to_pdf(*pic_files, pdf_file, page_size='A4', landscape=False,
                     margin=72, layout=(1, 1), stretch_small=False,
-                    force_overwrite=False):
+                    force_overwrite=False, workers=None, max_dpi=None,
+                    streaming=False, max_pages_per_file=None,
+                    max_bytes_per_file=None, cache_dir=None,
+                    cache_size=CACHE_SIZE, append=False, stats=False,
+                    hooks=None, memory_budget=None, compression='default',
+                    reencode=None, jpeg_quality=JPEG_QUALITY,
+                    min_saving=None):
     pic_show = PictureShow(*pic_files)
 
     return pic_show.save_pdf(
         pdf_file, page_size, landscape, margin, layout, stretch_small,
-        force_overwrite
+        force_overwrite, workers, max_dpi, streaming, max_pages_per_file,
+        max_bytes_per_file, cache_dir, cache_size, append, stats, hooks,
+        memory_budget, compression, reencode, jpeg_quality, min_saving
+    )
+
+
+async def pictures_to_pdf_async(*pic_files, pdf_file, page_size='A4',
+                                landscape=False, margin=72, layout=(1, 1),
+                                stretch_small=False, force_overwrite=False,
+                                workers=None, max_dpi=None, streaming=False,
+                                max_pages_per_file=None,
+                                max_bytes_per_file=None, cache_dir=None,
+                                cache_size=CACHE_SIZE, append=False,
+                                stats=False, hooks=None,
+                                memory_budget=None, compression='default',
+                                reencode=None, jpeg_quality=JPEG_QUALITY,
+                                min_saving=None):
+    pic_show = PictureShow(*pic_files)
+
+    return await pic_show.save_pdf_async(
+        pdf_file, page_size, landscape, margin, layout, stretch_small,
+        force_overwrite, workers, max_dpi, streaming, max_pages_per_file,
+        max_bytes_per_file, cache_dir, cache_size, append, stats, hooks,
+        memory_budget, compression, reencode, jpeg_quality, min_saving
     )
@@ -0,0 +1,33 @@
+class Hooks:
+    """Callbacks invoked while pictures are saved to PDF, e.g. to show
+    progress or to feed metrics and tracing.
+
+    Subclass and override the methods of interest; the methods of this
+    class do nothing. All methods are called in the thread calling
+    save_pdf. Pages of split output are drawn in worker processes,
+    so page_finished, and picture_failed for pictures failing to be
+    drawn, are called for them only after the file is saved.
+    """
+
+    def picture_opened(self, pic_file):
+        """Called when the picture file has been read and recognized
+        as a picture.
+        """
+
+    def picture_failed(self, pic_file, error):
+        """Called when the picture file cannot be read or recognized
+        as a picture, or when its pixel data cannot be decoded while
+        drawing it (after picture_placed).
+        """
+
+    def picture_placed(self, pic_file, area, page_number):
+        """Called when the picture has been assigned the DrawingArea
+        area on the page with the given number (counted from 1 among
+        the pages saved).
+        """
+
+    def page_finished(self, page_number):
+        """Called when the page with the given number has been drawn."""
+
+    def document_saved(self, pdf_file, num_pictures, num_pages):
+        """Called when the PDF file has been saved."""
@@ -0,0 +1,108 @@
+"""Lazy enumeration of picture files, so that long lists of paths never
+have to be held in memory (or passed on the command line) at once.
+
+Directories are listed one at a time and sorted by name, so the order
+of paths is stable while only the entries of the directories being
+walked are held in memory.
+"""
+
+import fnmatch
+import os
+
+PICTURE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif',
+                      '.tiff', '.webp')
+GLOB_CHARS = ('*', '?', '[')
+
+
+def scan_dir(directory, extensions=PICTURE_EXTENSIONS):
+    """Yield paths of files with given extensions (case insensitive,
+    leading dot optional) in the directory and its subdirectories,
+    depth first.
+    """
+    extensions = tuple(f'.{extension.strip().lstrip(".").lower()}'
+                       for extension in extensions)
+    for entry in _sorted_entries(directory):
+        if entry.is_dir():
+            yield from scan_dir(entry.path, extensions)
+        elif entry.name.lower().endswith(extensions):
+            yield entry.path
+
+
+def expand_pattern(pattern):
+    """Yield paths matching the glob pattern, '**' matching any number
+    of subdirectories (and all files below, at the end of the pattern).
+    The pattern itself is yielded if it is not a pattern, if it is
+    an existing path or a URL, or if nothing matches it (as the shell
+    does), so that it is reported as a missing file.
+    """
+    if (not _is_pattern(pattern) or '://' in pattern
+            or os.path.exists(pattern)):
+        yield pattern
+        return
+    parts = pattern.replace(os.sep, '/').split('/')
+    # leading directory without wildcards
+    num_fixed = next(i for i, part in enumerate(parts) if _is_pattern(part))
+    directory = '/'.join(parts[:num_fixed])
+    if num_fixed == 1 and not directory:
+        # absolute path
+        directory = '/'
+    matched = False
+    for path in _matches(directory, parts[num_fixed:]):
+        matched = True
+        yield path
+    if not matched:
+        yield pattern
+
+
+def read_list(lines):
+    """Yield paths from an iterable of lines, e.g. a file object,
+    skipping blank lines.
+    """
+    for line in lines:
+        path = line.strip()
+        if path:
+            yield path
+
+
+def _matches(directory, parts):
+    """Yield paths in directory matching the pattern parts."""
+    part, *rest = parts
+    if part == '**':
+        if rest:
+            yield from _matches(directory, rest)
+        for entry in _sorted_entries(directory or '.', missing_ok=True):
+            if entry.name.startswith('.'):
+                continue
+            path = os.path.join(directory, entry.name)
+            if entry.is_dir():
+                yield from _matches(path, parts)
+            elif not rest:
+                yield path
+        return
+    for entry in _sorted_entries(directory or '.', missing_ok=True):
+        # hidden files are matched only explicitly
+        if (entry.name.startswith('.') and not part.startswith('.')
+                or not fnmatch.fnmatch(entry.name, part)):
+            continue
+        path = os.path.join(directory, entry.name)
+        if not rest:
+            yield path
+        elif entry.is_dir():
+            yield from _matches(path, rest)
+
+
+def _sorted_entries(directory, missing_ok=False):
+    """Return entries of directory sorted by name. If missing_ok
+    is true, return empty list if directory does not exist.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        if missing_ok:
+            return []
+        raise
+
+
+def _is_pattern(path):
+    return any(char in path for char in GLOB_CHARS)
@@ -0,0 +1,288 @@
+from base64 import a85decode
+from collections import namedtuple
+import re
+import zlib
+
+WHITESPACE = b'\0\t\n\f\r '
+REGULAR_CHAR = re.compile(rb'[^\0\t\n\f\r ()<>\[\]{}/%]+')
+NUMBER = re.compile(rb'[+-]?(\d+\.?\d*|\.\d+)')
+REFERENCE = re.compile(rb'\s+(\d+)\s+R(?=[\s()<>\[\]{}/%]|$)')
+STARTXREF = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+XREF_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+DO_OPERATOR = re.compile(rb'/[^\0\t\n\f\r ()<>\[\]{}/%]+\s*Do\b')
+OBJECT_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+STREAM_KEYWORD = re.compile(rb'\s*stream\r?\n')
+NAME_ESCAPE = re.compile(rb'#([0-9a-fA-F]{2})')
+OCTAL_ESCAPE = re.compile(rb'[0-7]{1,3}')
+COMMENT = re.compile(rb'%[^\r\n]*')
+# characters to be escaped in names
+NAME_SPECIAL = re.compile(r'[^!-~]|[()<>\[\]{}/%#]')
+# page attributes which can be inherited from the page tree
+INHERITABLE = ('Resources', 'MediaBox', 'CropBox', 'Rotate')
+KEYWORDS = {b'true': True, b'false': False, b'null': None}
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+Reference = namedtuple('Reference', 'num gen')
+
+
+class Name(str):
+    """PDF name object, without the leading slash."""
+
+
+class PdfSyntaxError(ValueError):
+    pass
+
+
+class PdfFile:
+    """Existing PDF file, parsed only as far as needed to append pages
+    to it: the trailer, the cross-reference sections and the objects
+    of the page tree.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        file.seek(0, 2)
+        self.size = file.tell()
+        file.seek(max(self.size - 1024, 0))
+        match = None
+        for match in STARTXREF.finditer(file.read()):
+            pass
+        if match is None:
+            raise PdfSyntaxError('startxref not found')
+        self.startxref = int(match.group(1))
+        self.trailer = None
+        # object number: file offset, from the most recent section
+        self.offsets = {}
+        xref_offset = self.startxref
+        while xref_offset is not None:
+            trailer = self._read_xref(xref_offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            xref_offset = trailer.get('Prev')
+        if 'Encrypt' in self.trailer:
+            raise PdfSyntaxError('encrypted PDF not supported')
+
+    def object(self, ref):
+        """Return the object with given reference, or the object itself
+        if it is not a reference. Streams are returned as a pair of
+        the stream dictionary and the encoded data.
+        """
+        if not isinstance(ref, Reference):
+            return ref
+        offset = self.offsets[ref.num]
+        data = self._read_from(offset, b'endobj')
+        header = OBJECT_HEADER.match(data)
+        if header is None or int(header.group(1)) != ref.num:
+            raise PdfSyntaxError(f'object {ref.num} not found')
+        obj, pos = parse_object(data, header.end())
+        stream = STREAM_KEYWORD.match(data, pos)
+        if stream is None:
+            return obj
+        length = self.object(obj['Length'])
+        start = offset + stream.end()
+        self._file.seek(start)
+        return obj, self._file.read(length)
+
+    def pages(self):
+        """Return reference and dictionary of the root of the page tree."""
+        root = self.object(self.trailer['Root'])
+        return root['Pages'], self.object(root['Pages'])
+
+    def last_page(self):
+        """Return reference and dictionary of the last page, or a pair
+        of None if there is no page. Attributes inherited from the page
+        tree are included in the dictionary.
+        """
+        ref, node = self.pages()
+        inherited = {}
+        while 'Kids' in node:
+            inherited.update((key, node[key]) for key in INHERITABLE
+                             if key in node)
+            kids = self.object(node['Kids'])
+            if not kids:
+                return None, None
+            ref = kids[-1]
+            node = self.object(ref)
+        return ref, {**inherited, **node}
+
+    def count_drawn_objects(self, page):
+        """Return number of XObjects drawn on page, or None if its
+        contents cannot be decoded.
+        """
+        contents = self.object(page.get('Contents', []))
+        if not isinstance(contents, list):
+            contents = [page['Contents']]
+        count = 0
+        for ref in contents:
+            stream_dict, data = self.object(ref)
+            filters = self.object(stream_dict.get('Filter', []))
+            if not isinstance(filters, list):
+                filters = [filters]
+            for name in filters:
+                if name == 'FlateDecode':
+                    data = zlib.decompress(data)
+                elif name == 'ASCII85Decode':
+                    data = a85decode(data.strip().rstrip(b'~>'))
+                else:
+                    return None
+            count += len(DO_OPERATOR.findall(data))
+        return count
+
+    def _read_xref(self, offset):
+        """Read cross-reference table at offset, return its trailer."""
+        # a cross-reference stream has no trailer to look for
+        self._file.seek(offset)
+        if self._file.read(4) != b'xref':
+            raise PdfSyntaxError('cross-reference streams not supported')
+        data = self._read_from(offset, b'trailer')
+        tokens = iter(data[4:-len(b'trailer')].split())
+        for first, count in zip(tokens, tokens):
+            for num in range(int(first), int(first) + int(count)):
+                entry = XREF_ENTRY.fullmatch(
+                    b' '.join(next(tokens, b'') for _ in range(3))
+                )
+                if entry is None:
+                    raise PdfSyntaxError('invalid cross-reference table')
+                if entry.group(3) == b'n':
+                    self.offsets.setdefault(num, int(entry.group(1)))
+        self._file.seek(offset + len(data))
+        trailer, _ = parse_object(self._file.read(4096) + b' ', 0)
+        return trailer
+
+    def _read_from(self, offset, end_marker):
+        """Read file from offset up to the end marker."""
+        self._file.seek(offset)
+        data = b''
+        while True:
+            chunk = self._file.read(65536)
+            if not chunk:
+                raise PdfSyntaxError(f'{end_marker.decode()} not found')
+            data += chunk
+            end = data.find(end_marker, max(len(data) - len(chunk) - 10, 0))
+            if end != -1:
+                if end_marker == b'trailer':
+                    return data[:end + len(end_marker)]
+                return data[:end]
+
+
+def parse_object(data, pos):
+    """Parse the PDF object at pos, return it and the position after it."""
+    pos = _skip_whitespace(data, pos)
+    char = data[pos:pos + 1]
+    if data.startswith(b'<<', pos):
+        result = {}
+        pos += 2
+        while True:
+            pos = _skip_whitespace(data, pos)
+            if data.startswith(b'>>', pos):
+                return result, pos + 2
+            key, pos = parse_object(data, pos)
+            result[key], pos = parse_object(data, pos)
+    if char == b'[':
+        result = []
+        pos += 1
+        while True:
+            pos = _skip_whitespace(data, pos)
+            if data.startswith(b']', pos):
+                return result, pos + 1
+            item, pos = parse_object(data, pos)
+            result.append(item)
+    if char == b'/':
+        match = REGULAR_CHAR.match(data, pos + 1)
+        end = match.end() if match else pos + 1
+        name = NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]),
+                               data[pos + 1:end])
+        return Name(name.decode('latin-1')), end
+    if char == b'(':
+        return _parse_literal_string(data, pos + 1)
+    if char == b'<':
+        end = data.index(b'>', pos)
+        hex_digits = bytes(
+            byte for byte in data[pos + 1:end] if byte not in WHITESPACE
+        )
+        if len(hex_digits) % 2:
+            hex_digits += b'0'
+        return bytes.fromhex(hex_digits.decode('ascii')), end + 1
+    match = NUMBER.match(data, pos)
+    if match:
+        number = match.group()
+        ref = REFERENCE.match(data, match.end())
+        if ref and b'.' not in number:
+            return Reference(int(number), int(ref.group(1))), ref.end()
+        if b'.' in number:
+            return float(number), match.end()
+        return int(number), match.end()
+    match = REGULAR_CHAR.match(data, pos)
+    if match and match.group() in KEYWORDS:
+        return KEYWORDS[match.group()], match.end()
+    raise PdfSyntaxError(f'unexpected data at position {pos}')
+
+
+def _parse_literal_string(data, pos):
+    result = bytearray()
+    depth = 1
+    while True:
+        char = data[pos:pos + 1]
+        if not char:
+            raise PdfSyntaxError('unterminated string')
+        pos += 1
+        if char == b'\\':
+            char = data[pos:pos + 1]
+            pos += 1
+            octal = OCTAL_ESCAPE.match(data, pos - 1)
+            if octal:
+                result.append(int(octal.group(), 8) & 0xff)
+                pos = octal.end()
+            elif char in b'\r\n':
+                # line continuation
+                if data.startswith(b'\r\n', pos - 1):
+                    pos += 1
+            else:
+                result += ESCAPES.get(char, char)
+            continue
+        if char == b'(':
+            depth += 1
+        elif char == b')':
+            depth -= 1
+            if depth == 0:
+                return bytes(result), pos
+        result += char
+
+
+def _skip_whitespace(data, pos):
+    while True:
+        while data[pos:pos + 1] and data[pos:pos + 1] in WHITESPACE:
+            pos += 1
+        if data[pos:pos + 1] != b'%':
+            return pos
+        # comment up to the end of line
+        pos = COMMENT.match(data, pos).end()
+
+
+def serialize(obj):
+    """Return PDF representation of a parsed object, as str."""
+    if isinstance(obj, Name):
+        return '/' + NAME_SPECIAL.sub(
+            lambda m: ''.join(f'#{b:02X}'
+                              for b in m.group().encode('latin-1')),
+            obj
+        )
+    if isinstance(obj, Reference):
+        return f'{obj.num} {obj.gen} R'
+    if isinstance(obj, dict):
+        entries = ' '.join(f'{serialize(Name(key))} {serialize(value)}'
+                           for key, value in obj.items())
+        return f'<< {entries} >>'
+    if isinstance(obj, list):
+        return '[{}]'.format(' '.join(serialize(item) for item in obj))
+    if isinstance(obj, bytes):
+        return f'<{obj.hex()}>'
+    if obj is True:
+        return 'true'
+    if obj is False:
+        return 'false'
+    if obj is None:
+        return 'null'
+    if isinstance(obj, float):
+        return f'{obj:.4f}'.rstrip('0').rstrip('.')
+    return str(obj)
@@ -0,0 +1,279 @@
+"""HTTP server saving pictures to PDF in a pool of warm worker processes.
+
+Jobs are posted to /pdf as JSON objects, in the format of the lines
+of a batch manifest (see pictureshow.batch), e.g.
+
+    {"pic_files": ["a.png", "b/*.jpg"], "layout": "2x2"}
+
+The PDF is sent back in the response. Only if the server allows files
+(allow_files), a job may set pdf_file to save the PDF to that file,
+sending the result back as JSON, or the force_overwrite, append and
+cache_dir options. Paths are relative to the working directory of
+the server.
+
+Requests must have the JSON content type, no Origin header and a local
+Host header, so that web pages opened in a browser cannot post jobs.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+import json
+import os
+import socketserver
+import threading
+
+from pictureshow import __version__
+from pictureshow.batch import job_paths, parse_job, run_job
+
+# default number of jobs waiting for a worker, more are refused
+QUEUE_SIZE = 16
+MAX_REQUEST_SIZE = 2 ** 24
+# options of a job writing files on the server, allowed only on request
+FILE_OPTIONS = ('force_overwrite', 'append', 'cache_dir')
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '[::1]')
+
+
+class _ServerMixin(socketserver.ThreadingMixIn):
+    """Server handling each request in a thread, running the jobs
+    in a pool of worker processes started in advance.
+
+    At most workers jobs run at a time, and at most queue_size more
+    wait for a worker; jobs beyond that are refused with status 503,
+    so that waiting times stay bounded under load.
+
+    Unless allow_files is true, jobs saving to a pdf_file on the server
+    are refused with status 403.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, queue_size=QUEUE_SIZE,
+                 quiet=False, allow_files=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.quiet = quiet
+        self.allow_files = allow_files
+        self.num_jobs = 0
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(self.workers)
+        try:
+            # start the worker processes and import the libraries
+            warm_ups = [self._executor.submit(_warm_up)
+                        for _ in range(self.workers)]
+            for future in warm_ups:
+                future.result()
+            super().__init__(address, _RequestHandler)
+        except BaseException:
+            self._executor.shutdown()
+            raise
+
+    def is_local_host(self, host):
+        """Return true if host (Host header, possibly with port) names
+        the server, rather than a domain rebound to its address.
+        """
+        return True
+
+    def handle_job(self, job):
+        """Run the job in a worker process and return its outcome,
+        or return None if too many jobs are running and waiting.
+        """
+        with self._lock:
+            if self.num_jobs >= self.workers + self.queue_size:
+                return None
+            self.num_jobs += 1
+        try:
+            if job.pdf_file is None:
+                return self._executor.submit(_render_job, job).result()
+            return self._executor.submit(run_job, job).result(), None
+        finally:
+            with self._lock:
+                self.num_jobs -= 1
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown()
+
+
+class HTTPPictureServer(_ServerMixin, HTTPServer):
+    """Server listening on a TCP address, e.g. ('127.0.0.1', 8000)."""
+
+    def is_local_host(self, host):
+        if host is None:
+            return False
+        # strip the port, an IPv6 address is in brackets
+        name, _, port = host.rpartition(':')
+        if not port.isdigit():
+            name = host
+        return name.lower() in LOCAL_HOSTS
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixPictureServer(_ServerMixin, socketserver.UnixStreamServer):
+        """Server listening on a Unix socket, at a file path.
+        It cannot be reached from a browser, any Host is accepted.
+        """
+
+        def server_close(self):
+            super().server_close()
+            os.remove(self.server_address)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = f'pictureshow/{__version__}'
+
+    def do_GET(self):
+        if not self._check_origin():
+            return
+        if self.path != '/status':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+            return
+        self._send_json(HTTPStatus.OK, {
+            'workers': self.server.workers,
+            'queue_size': self.server.queue_size,
+            'num_jobs': self.server.num_jobs,
+        })
+
+    def do_POST(self):
+        if not self._check_origin():
+            return
+        if self.path != '/pdf':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self._send_json(HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                            {'error': 'application/json expected'})
+            self.close_connection = True
+            return
+        if 'Content-Length' not in self.headers:
+            self._send_json(HTTPStatus.LENGTH_REQUIRED,
+                            {'error': 'Content-Length required'})
+            self.close_connection = True
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(HTTPStatus.BAD_REQUEST,
+                            {'error': 'invalid Content-Length'})
+            self.close_connection = True
+            return
+        if length > MAX_REQUEST_SIZE:
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            {'error': 'request too large'})
+            self.close_connection = True
+            return
+        try:
+            job = parse_job(self.rfile.read(length), target_required=False)
+            if not (self.server.allow_files or _writes_no_files(job)):
+                self._send_json(HTTPStatus.FORBIDDEN,
+                                {'error': 'files on the server not allowed'})
+                return
+            outcome = self.server.handle_job(job)
+        except BrokenProcessPool as err:
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR,
+                            {'error': f'{err.__class__.__name__}: {err}'})
+            return
+        except Exception as err:
+            # invalid job or options
+            self._send_json(HTTPStatus.BAD_REQUEST,
+                            {'error': f'{err.__class__.__name__}: {err}'})
+            return
+        if outcome is None:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE,
+                            {'error': 'too many jobs'},
+                            {'Retry-After': '1'})
+            return
+
+        result, pdf_data = outcome
+        if pdf_data is None or result.num_ok == 0:
+            # saved to file, or nothing to save
+            status = (HTTPStatus.OK if result.num_ok
+                      else HTTPStatus.UNPROCESSABLE_ENTITY)
+            self._send_json(status, _result_fields(result))
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(pdf_data)))
+        self.send_header('X-Num-Pictures', str(result.num_ok))
+        self.send_header('X-Num-Pages', str(result.num_pages))
+        self.send_header('X-Num-Errors', str(len(result.errors)))
+        self.end_headers()
+        self.wfile.write(pdf_data)
+
+    def _check_origin(self):
+        """Return true if the request may come from a local client;
+        otherwise send an error and return false. Browsers send Origin
+        with cross-site requests, and the Host of the page's domain
+        if it was rebound to the server's address.
+        """
+        if 'Origin' in self.headers:
+            error = 'cross-origin requests not allowed'
+        elif not self.server.is_local_host(self.headers.get('Host')):
+            error = 'unknown host'
+        else:
+            return True
+        self._send_json(HTTPStatus.FORBIDDEN, {'error': error})
+        self.close_connection = True
+        return False
+
+    def address_string(self):
+        # client address of a Unix socket is empty
+        if not self.client_address:
+            return 'local'
+        return super().address_string()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, fields, headers=None):
+        body = json.dumps(fields).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _writes_no_files(job):
+    """Return true if the job writes no files on the server."""
+    return job.pdf_file is None and not any(
+        job.options.get(key) for key in FILE_OPTIONS
+    )
+
+
+def _result_fields(result):
+    """Return dictionary of save_pdf result, to be sent as JSON."""
+    return {
+        'num_ok': result.num_ok,
+        'num_pages': result.num_pages,
+        'num_duplicates': result.num_duplicates,
+        'errors': [
+            {'pic_file': str(pic_file),
+             'error': f'{error.__class__.__name__}: {error}'}
+            for pic_file, error in result.errors
+        ],
+        'files': [shard.pdf_file for shard in result.shards],
+    }
+
+
+def _warm_up():
+    """Import the libraries in a worker process."""
+    import pictureshow.core  # noqa: F401
+
+
+def _render_job(job):
+    """Save the job to PDF in memory, return the result and PDF data."""
+    from pictureshow.core import PictureShow
+
+    stream = BytesIO()
+    result = PictureShow.from_iterable(job_paths(job)).save_pdf(
+        stream, **job.options
+    )
+    return result._replace(shards=[]), stream.getvalue()
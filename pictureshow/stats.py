@@ -0,0 +1,95 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import time
+
+# read: reading picture files
+# probe: reading picture headers
+# decode: decoding pixel data
+# scale: downsampling, including decoding of the pictures downsampled
+# compress: compressing image data for PDF
+# draw: drawing pictures on pages
+# save: saving the PDF file
+PHASES = ('read', 'probe', 'decode', 'scale', 'compress', 'draw', 'save')
+NUM_SLOWEST = 5
+
+PhaseTime = namedtuple('PhaseTime', 'wall cpu')
+PictureTime = namedtuple('PictureTime', 'pic_file seconds')
+
+
+class Stats:
+    """Time spent in the phases of saving pictures to PDF, and numbers
+    of bytes read and written.
+
+    Wall and CPU times are in seconds, summed over all pictures. Phases
+    run in worker processes are included, so with workers, the sum
+    of wall times may exceed the total run time.
+    """
+
+    def __init__(self):
+        self.wall = dict.fromkeys(PHASES, 0.0)
+        self.cpu = dict.fromkeys(PHASES, 0.0)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # pic_file: wall time spent reading and preparing the picture
+        self._picture_times = {}
+
+    def phase(self, name):
+        """Return PhaseTime of the named phase."""
+        return PhaseTime(self.wall[name], self.cpu[name])
+
+    def add(self, timings, pic_file=None):
+        """Add timings, a dictionary of phase name: (wall, cpu) pairs.
+        If pic_file is specified, the wall times are counted towards
+        the time of that picture.
+        """
+        for name, (wall, cpu) in timings.items():
+            self.wall[name] += wall
+            self.cpu[name] += cpu
+            if pic_file is not None:
+                self._picture_times[pic_file] = (
+                    self._picture_times.get(pic_file, 0.0) + wall
+                )
+
+    def add_picture(self, picture, pic_file):
+        """Add timings of preparing the picture, unless they have been
+        added already (the picture may be drawn more than once).
+        """
+        if picture.timings is not None:
+            self.add(picture.timings, pic_file)
+            picture.timings = None
+
+    def merge(self, other):
+        """Add everything counted by other Stats instance."""
+        self.add({name: other.phase(name) for name in PHASES})
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        for pic_file, seconds in other._picture_times.items():
+            self._picture_times[pic_file] = (
+                self._picture_times.get(pic_file, 0.0) + seconds
+            )
+
+    def slowest(self, n=NUM_SLOWEST):
+        """Return list of PictureTime of the n slowest pictures,
+        slowest first.
+        """
+        times = sorted(self._picture_times.items(), key=lambda item: item[1],
+                       reverse=True)
+        return [PictureTime(*item) for item in times[:n]]
+
+
+@contextmanager
+def timed(timings, name):
+    """Add wall and CPU time of the block to timings[name], unless
+    timings is None.
+    """
+    if timings is None:
+        yield
+        return
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = timings.get(name, (0.0, 0.0))
+        timings[name] = (wall + time.perf_counter() - wall_start,
+                         cpu + time.process_time() - cpu_start)
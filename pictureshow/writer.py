@@ -0,0 +1,354 @@
+import os
+import zlib
+
+from pictureshow.reader import Name, PdfFile, Reference, serialize
+
+HEADER = b'%PDF-1.4\n%\x93\x8c\x8b\x9e\n'
+
+CATALOG_REF = 1
+PAGES_REF = 2
+# private page dictionary key, recording the grid of pictures on a page
+LAYOUT_KEY = 'PictureshowLayout'
+
+
+class StreamingCanvas:
+    """Write pictures to PDF page by page.
+
+    Each page is written to the file as soon as it is finished, together
+    with the image objects used on it for the first time. Only the
+    object offsets are kept until the cross-reference table is written
+    on save, so memory use does not grow with the number of pictures.
+
+    filename may also be a writable binary stream, which need not be
+    seekable. It is written to, but neither closed nor discarded.
+    Page contents are compressed unless pageCompression is false.
+    If pageLayout (columns, rows, margin) is specified, it is recorded
+    on each page, so that the grid can be continued when appending.
+    """
+
+    def __init__(self, filename, pagesize, pageCompression=True,
+                 pageLayout=None):
+        self._filename = filename
+        self._page_size = pagesize
+        self._page_compression = pageCompression
+        self._page_layout = pageLayout
+        self._file = None
+        # number of bytes written, offsets are counted as the stream
+        # may not support tell
+        self._position = 0
+        # object number: file offset
+        self._offsets = {}
+        # objects 1 and 2 are reserved for the catalog and page tree
+        self._next_ref = 3
+        self._pages_ref = PAGES_REF
+        self._page_refs = []
+        # image object name: object number
+        self._image_refs = {}
+        self._code = []
+        self._page_images = {}
+
+    def drawPicture(self, picture, x, y, width, height):
+        """Draw the prepared picture, writing its image object
+        on first use.
+        """
+        image = picture.image
+        image_ref = self._image_refs.get(image.name)
+        if image_ref is None:
+            image_ref = self._write_image(image)
+            self._image_refs[image.name] = image_ref
+        name = f'Im{image_ref}'
+        self._page_images[name] = image_ref
+        self._code.append(
+            f'q {_num(width)} 0 0 {_num(height)} {_num(x)} {_num(y)} cm'
+            f' /{name} Do Q'
+        )
+
+    def showPage(self):
+        content_ref, x_objects = self._write_contents()
+        x_objects = ' '.join(
+            f'/{name} {ref} 0 R' for name, ref in x_objects.items()
+        )
+        page_width, page_height = self._page_size
+        layout = ''
+        if self._page_layout is not None:
+            layout = ' /{} [{}]'.format(
+                LAYOUT_KEY, ' '.join(_num(value)
+                                     for value in self._page_layout)
+            )
+        page_ref = self._write_object(
+            f'<< /Type /Page /Parent {self._pages_ref} 0 R'
+            f' /MediaBox [0 0 {_num(page_width)} {_num(page_height)}]'
+            f' /Resources << /ProcSet [/PDF /ImageB /ImageC /ImageI]'
+            f' /XObject << {x_objects} >> >>'
+            f' /Contents {content_ref} 0 R{layout} >>'.encode('ascii')
+        )
+        self._page_refs.append(page_ref)
+
+    def save(self):
+        """Write the page tree, cross-reference table and trailer,
+        and close the file.
+        """
+        if self._code:
+            self.showPage()
+        kids = ' '.join(f'{ref} 0 R' for ref in self._page_refs)
+        self._write_object(
+            f'<< /Type /Pages /Kids [{kids}]'
+            f' /Count {len(self._page_refs)} >>'.encode('ascii'),
+            PAGES_REF
+        )
+        self._write_object(
+            f'<< /Type /Catalog /Pages {PAGES_REF} 0 R >>'.encode('ascii'),
+            CATALOG_REF
+        )
+        # object 0 is the head of the list of free objects
+        self._write_xref(
+            f'<< /Size {self._next_ref} /Root {CATALOG_REF} 0 R >>',
+            {0: None, **self._offsets}
+        )
+
+    def discard(self):
+        """Close and remove the unfinished file. What has been written
+        to a stream is left there.
+        """
+        if self._file is not None and self._file is not self._filename:
+            self._file.close()
+            os.remove(self._filename)
+
+    def _write_image(self, image):
+        """Write image object (and its soft mask), release its data
+        and return its object number.
+        """
+        entries = [
+            '/Type /XObject /Subtype /Image',
+            f'/Width {image.width} /Height {image.height}',
+            f'/BitsPerComponent {image.bitsPerComponent}',
+            f'/ColorSpace /{image.colorSpace}',
+            '/Filter [{}]'.format(
+                ' '.join(f'/{name}' for name in image._filters)
+            ),
+        ]
+        decode_parms = getattr(image, 'decodeParms', None)
+        if decode_parms:
+            entries.append('/DecodeParms [<< {} >>]'.format(
+                ' '.join(f'/{key} {value}'
+                         for key, value in decode_parms.items())
+            ))
+        if image.colorSpace == 'DeviceCMYK' and getattr(image, '_dotrans',
+                                                        False):
+            entries.append('/Decode [1 0 1 0 1 0 1 0]')
+        elif getattr(image, '_decode', None):
+            entries.append('/Decode [{}]'.format(
+                ' '.join(str(value) for value in image._decode)
+            ))
+        if image.mask:
+            entries.append('/Mask [{}]'.format(
+                ' '.join(str(value) for value in image.mask)
+            ))
+        smask = getattr(image, '_smask', None)
+        if smask:
+            entries.append(f'/SMask {self._write_image(smask)} 0 R')
+
+        content = image.streamContent
+        if isinstance(content, str):
+            content = content.encode('latin-1')
+        image_ref = self._write_stream(' '.join(entries), content)
+        image.streamContent = None
+        image._smask = None
+        return image_ref
+
+    def _write_contents(self):
+        """Write content stream of the current page. Return its object
+        number and the image objects used on the page, by name.
+        """
+        content = '\n'.join(self._code).encode('ascii')
+        if self._page_compression:
+            content_ref = self._write_stream('/Filter /FlateDecode',
+                                             zlib.compress(content))
+        else:
+            content_ref = self._write_stream('', content)
+        x_objects = self._page_images
+        self._code = []
+        self._page_images = {}
+        return content_ref, x_objects
+
+    def _write_xref(self, trailer, offsets):
+        """Write cross-reference section of objects with given offsets
+        (None meaning a free object), followed by the trailer, and close
+        the file.
+        """
+        xref_offset = self._position
+        lines = ['xref\n']
+        refs = sorted(offsets)
+        start = 0
+        for end in range(1, len(refs) + 1):
+            # subsection of consecutive object numbers
+            if end < len(refs) and refs[end] == refs[end - 1] + 1:
+                continue
+            lines.append(f'{refs[start]} {end - start}\n')
+            for ref in refs[start:end]:
+                if offsets[ref] is None:
+                    lines.append('0000000000 65535 f \n')
+                else:
+                    lines.append(f'{offsets[ref]:010d} 00000 n \n')
+            start = end
+        lines.append(
+            f'trailer\n{trailer}\nstartxref\n{xref_offset}\n%%EOF\n'
+        )
+        self._write(''.join(lines).encode('ascii'))
+        self._close()
+
+    def _write_stream(self, entries, content):
+        return self._write_object(
+            f'<< {entries} /Length {len(content)} >>\nstream\n'.encode('ascii')
+            + content + b'\nendstream'
+        )
+
+    def _write_object(self, body, ref=None):
+        """Write object body, return its object number. Unless ref is
+        specified, the next free object number is used.
+        """
+        if self._file is None:
+            if hasattr(self._filename, 'write'):
+                self._file = self._filename
+            else:
+                self._file = open(self._filename, 'wb')
+            self._write(HEADER)
+        if ref is None:
+            ref = self._next_ref
+            self._next_ref += 1
+        self._offsets[ref] = self._position
+        self._write(f'{ref} 0 obj\n'.encode('ascii') + body
+                    + b'\nendobj\n')
+        return ref
+
+    def _write(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _close(self):
+        """Close the file, unless it is a stream passed in."""
+        if self._file is not self._filename:
+            self._file.close()
+
+
+class AppendingCanvas(StreamingCanvas):
+    """Append pages to an existing PDF file in an incremental update.
+
+    The original file is left as is. New and changed objects are
+    written after its end, followed by a cross-reference section
+    pointing to the previous one. Only the trailer, the cross-reference
+    sections and the page tree are read from the original file.
+    """
+
+    def __init__(self, filename, pagesize, pageCompression=True,
+                 pageLayout=None):
+        super().__init__(filename, pagesize, pageCompression, pageLayout)
+        # separate file objects for reading and appending
+        self._original_file = open(filename, 'rb')
+        try:
+            self._pdf = PdfFile(self._original_file)
+            pages_ref, self._pages = self._pdf.pages()
+        except BaseException:
+            self._original_file.close()
+            raise
+        self._pages_ref = pages_ref.num
+        self._next_ref = self._pdf.trailer['Size']
+        self._continued_page = None
+        self._file = open(filename, 'ab')
+        self._position = self._pdf.size
+        self._write(b'\n')
+
+    def num_pictures_on_last_page(self):
+        """Return number of pictures drawn on the last page, or None
+        if its size or its recorded layout differ from those of the
+        canvas, or its contents cannot be read.
+        """
+        _, page = self._pdf.last_page()
+        if page is None or self._page_layout is None:
+            return None
+        x0, y0, x1, y1 = (self._pdf.object(value)
+                          for value in self._pdf.object(page['MediaBox']))
+        page_width, page_height = self._page_size
+        if not (abs(x1 - x0 - page_width) < 0.01
+                and abs(y1 - y0 - page_height) < 0.01):
+            return None
+        layout = self._pdf.object(page.get(LAYOUT_KEY))
+        if not (isinstance(layout, list) and _close_numbers(
+                [self._pdf.object(value) for value in layout],
+                self._page_layout)):
+            # not written by pictureshow, or with another layout
+            return None
+        return self._pdf.count_drawn_objects(page)
+
+    def continue_last_page(self):
+        """Draw pictures on the last page of the file until the next
+        showPage call.
+        """
+        self._continued_page = self._pdf.last_page()
+
+    def showPage(self):
+        if self._continued_page is None:
+            super().showPage()
+            return
+        page_ref, page = self._continued_page
+        self._continued_page = None
+        contents = self._pdf.object(page.get('Contents', []))
+        if not isinstance(contents, list):
+            contents = [page['Contents']]
+        # isolate the graphics state of the original contents
+        save_ref = self._write_stream('', b'q')
+        restore_ref = self._write_stream('', b'Q')
+        content_ref, x_objects = self._write_contents()
+        page['Contents'] = [
+            Reference(save_ref, 0), *contents, Reference(restore_ref, 0),
+            Reference(content_ref, 0)
+        ]
+        resources = dict(self._pdf.object(page.get('Resources', {})))
+        resources['XObject'] = {
+            **self._pdf.object(resources.get('XObject', {})),
+            **{Name(name): Reference(ref, 0)
+               for name, ref in x_objects.items()}
+        }
+        page['Resources'] = resources
+        self._write_object(serialize(page).encode('ascii'), page_ref.num)
+
+    def save(self):
+        """Write the updated page tree, cross-reference section and
+        trailer, and close the file.
+        """
+        if self._code:
+            self.showPage()
+        if self._page_refs:
+            pages = dict(self._pages)
+            pages['Kids'] = self._pdf.object(pages['Kids']) + [
+                Reference(ref, 0) for ref in self._page_refs
+            ]
+            pages['Count'] = (self._pdf.object(pages['Count'])
+                              + len(self._page_refs))
+            self._write_object(serialize(pages).encode('ascii'),
+                               self._pages_ref)
+        trailer = {key: value for key, value in self._pdf.trailer.items()
+                   if key in ('Root', 'Info', 'ID')}
+        trailer['Size'] = self._next_ref
+        trailer['Prev'] = self._pdf.startxref
+        self._write_xref(serialize(trailer), self._offsets)
+        self._original_file.close()
+
+    def discard(self):
+        """Remove everything written, leaving the original file."""
+        self._file.close()
+        self._original_file.close()
+        os.truncate(self._filename, self._pdf.size)
+
+
+def _close_numbers(values, expected):
+    """Return true if values are numbers close to the expected ones."""
+    return len(values) == len(expected) and all(
+        isinstance(value, (int, float)) and abs(value - number) < 0.01
+        for value, number in zip(values, expected)
+    )
+
+
+def _num(value):
+    """Format number for PDF, which does not allow exponent notation."""
+    return f'{value:.4f}'.rstrip('0').rstrip('.')
@@ -1,5 +1,8 @@
+import json
 from pathlib import Path
 import subprocess
+import sys
+from urllib.request import Request, urlopen
 
 from PyPDF2 import PdfFileReader
 import pytest
@@ -37,6 +40,16 @@ def temp_pdf():
         pdf_path.unlink()
 
 
+@pytest.fixture
+def temp_shards():
+    pdf_path = Path('_test_temp_.pdf')
+    yield pdf_path
+
+    # teardown
+    for shard_path in Path.cwd().glob('_test_temp_-[0-9][0-9][0-9].pdf'):
+        shard_path.unlink()
+
+
 @pytest.fixture
 def temp_existing():
     pdf_path = Path('_test_temp_.pdf').resolve()
@@ -61,6 +74,24 @@ def test_number(number, noun, expected):
     assert _number(number, noun) == expected
 
 
+@pytest.mark.parametrize('args', ('-V', '-h', 'batch -h', 'serve -h',
+                                  '-l foo'))
+def test_heavy_modules_not_imported(args):
+    # the command line app exits before saving anything
+    code = ('import runpy, sys\n'
+            f'sys.argv = ["pictureshow", *{args.split()!r}]\n'
+            'try:\n'
+            '    runpy.run_module("pictureshow", run_name="__main__")\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'print(sorted(name for name in ("PIL", "reportlab", "asyncio",'
+            ' "pictureshow.core") if name in sys.modules))')
+    proc = subprocess.run([sys.executable, '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    assert proc.stdout.decode().splitlines()[-1] == '[]'
+
+
 class TestCallsToCore:
     """Test that the command line app calls the underlying function
     correctly.
@@ -91,6 +122,47 @@ class TestOutput:
         assert 'skipped' not in std_out
         assert 'Nothing' not in std_out
 
+    @pytest.mark.parametrize(
+        'inputs, num_pics',
+        (
+            pytest.param("'pics/plots/gauss*'", 2, id='quoted glob'),
+            pytest.param("'pics/**/*.png'", 5, id='recursive glob'),
+            # pics/not_jpg.jpg is skipped
+            pytest.param('-d pics', 8, id='input dir'),
+            pytest.param('-d pics -e JPG', 3, id='input dir, extension'),
+            pytest.param('-d pics/plots -d pics/blender', 6,
+                         id='2 input dirs'),
+        )
+    )
+    def test_lazy_input(self, app_exec, temp_pdf, inputs, num_pics):
+        command = f'{app_exec} {inputs} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=num_pics)
+
+    def test_list_file(self, app_exec, temp_pdf, tmp_path):
+        list_file = tmp_path / 'list.txt'
+        list_file.write_text('\n'.join(PICS_2_GOOD) + '\n\n')
+        command = f'{app_exec} @{list_file} {PIC_FILE} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=3)
+
+    def test_from_stdin(self, app_exec, temp_pdf):
+        command = f'{app_exec} --from-stdin {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                       input='\n'.join(PICS_2_GOOD).encode())
+
+        assert_pdf(temp_pdf, num_pages=2)
+
+    def test_no_input(self, app_exec, temp_pdf):
+        command = f'{app_exec} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+
+        assert proc.returncode == 2
+        assert 'no pictures specified' in proc.stderr.decode()
+        assert not temp_pdf.exists()
+
     def test_valid_and_invalid_input(self, app_exec, temp_pdf):
         command = f'{app_exec} {" ".join(PICS_1_GOOD_1_BAD)} {temp_pdf}'
         proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
@@ -108,6 +180,8 @@ class TestOutput:
             pytest.param(PICS_2_BAD, '2 files', id='2bad'),
             pytest.param(PICS_DIR, '1 file', id='dir'),
             pytest.param(PICS_MISSING, '1 file', id='missing'),
+            pytest.param(["'pics/missing*.png'"], '1 file',
+                         id='glob not matched'),
         )
     )
     def test_invalid_input(self, app_exec, temp_pdf, pic_files, num_invalid):
@@ -157,6 +231,31 @@ class TestOutput:
         assert proc.returncode == 0
         assert f'Saved 6 pictures ({num_pages}) to ' in std_out
 
+    def test_jobs(self, app_exec, temp_pdf):
+        # 6 valid pictures + 2 invalid
+        pic_files = PICS_2_GOOD * 3 + PICS_2_BAD
+
+        command = f'{app_exec} -j2 -l1x2 {" ".join(pic_files)} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        std_out = proc.stdout.decode()
+
+        assert proc.returncode == 0
+        assert '2 files skipped due to error.' in std_out
+        assert 'Saved 6 pictures (3 pages) to ' in std_out
+
+    def test_max_pages(self, app_exec, temp_shards):
+        # 6 pictures
+        pic_files = PICS_2_GOOD * 3
+
+        command = (f'{app_exec} -v --max-pages 2 {" ".join(pic_files)}'
+                   f' {temp_shards}')
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        std_out = proc.stdout.decode()
+
+        assert proc.returncode == 0
+        assert 'Saved 6 pictures (6 pages) to 3 files' in std_out
+        assert "'_test_temp_-003.pdf': 2 pictures (2 pages)" in std_out
+
     @pytest.mark.parametrize(
         'layout',
         (
@@ -212,6 +311,8 @@ class TestOutput:
         assert proc.returncode == 0
         assert '1 file skipped due to error.' in std_out
         assert 'UnidentifiedImageError' in std_out
+        assert 'Time per phase (wall / CPU):' in std_out
+        assert f'  {PIC_FILE}\n' in std_out
 
     def test_verbose_shows_only_unique_files(self, app_exec, temp_pdf):
         # duplicate items
@@ -225,6 +326,29 @@ class TestOutput:
         # only unique items reported
         assert '2 files skipped due to error.' in std_out
 
+    def test_verbose_reports_duplicates(self, app_exec, temp_pdf):
+        # 2 unique pictures
+        pic_files = PICS_2_GOOD * 3
+
+        command = f'{app_exec} -v {" ".join(pic_files)} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        std_out = proc.stdout.decode()
+
+        assert proc.returncode == 0
+        assert 'Saved 6 pictures (6 pages) to ' in std_out
+        assert '4 duplicate pictures stored only once.' in std_out
+
+    def test_progress(self, app_exec, temp_pdf):
+        command = (f'{app_exec} --progress {" ".join(PICS_1_GOOD_1_BAD)}'
+                   f' {temp_pdf}')
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        std_err = proc.stderr.decode()
+
+        assert proc.returncode == 0
+        assert std_err.endswith('\rpictures: 2/2, pages: 1, failed: 1\n')
+        assert 'Saved 1 picture (1 page)' in proc.stdout.decode()
+
     def test_quiet_and_verbose_are_mutually_exclusive(self, app_exec, temp_pdf):
         command = f'{app_exec} -qv {PIC_FILE} {temp_pdf}'
         proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
@@ -234,6 +358,121 @@ class TestOutput:
         assert 'error: argument -v' in std_err
         assert 'not allowed with argument -q' in std_err
 
+    def test_dry_run(self, app_exec, temp_pdf):
+        command = (f'{app_exec} --dry-run -l2x1'
+                   f' {" ".join(PICS_2_GOOD + PICS_1_BAD)} {temp_pdf}')
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        std_out = proc.stdout.decode()
+
+        assert proc.returncode == 0
+        assert '1 file would be skipped due to error.' in std_out
+        assert 'Would save 2 pictures (1 page) to ' in std_out
+        assert 'MiB' in std_out
+        assert not temp_pdf.exists()
+
+    def test_plan_json(self, app_exec, temp_pdf):
+        command = (f'{app_exec} --dry-run --plan-json -l2x1'
+                   f' {" ".join(PICS_2_GOOD * 2 + PICS_1_BAD)} {temp_pdf}')
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        plan = json.loads(proc.stdout)
+
+        assert proc.returncode == 0
+        assert plan['num_ok'] == 4
+        assert plan['num_pages'] == 2
+        assert [[placement['pic_file'] for placement in page]
+                for page in plan['pages']] == [list(PICS_2_GOOD)] * 2
+        assert [error['pic_file'] for error in plan['errors']] == [
+            PICS_1_BAD[0]
+        ]
+        assert not temp_pdf.exists()
+
+    def test_plan_json_requires_dry_run(self, app_exec, temp_pdf):
+        command = f'{app_exec} --plan-json {PIC_FILE} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+
+        assert proc.returncode == 2
+        assert '--plan-json requires --dry-run' in proc.stderr.decode()
+        assert not temp_pdf.exists()
+
+
+def write_manifest(path, jobs):
+    path.write_text(''.join(f'{json.dumps(job)}\n' for job in jobs))
+
+
+class TestBatch:
+    """Test the batch subcommand of the command line app."""
+
+    def test_jobs_saved(self, app_exec, tmp_path):
+        manifest = tmp_path / 'manifest.jsonl'
+        write_manifest(manifest, [
+            {'pic_files': [*PICS_2_GOOD, *PICS_1_BAD],
+             'pdf_file': str(tmp_path / 'a.pdf'), 'layout': '1x2'},
+            {'input_dirs': ['pics/plots'], 'extensions': ['png'],
+             'pdf_file': str(tmp_path / 'b.pdf')},
+        ])
+
+        command = f'{app_exec} batch -j2 {manifest}'
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert proc.returncode == 0
+        assert proc.stdout.decode() == (
+            '1 file skipped due to error.\n'
+            'Saved 4 pictures (3 pages) to 2 files\n'
+        )
+        assert_pdf(tmp_path / 'a.pdf', num_pages=1)
+        assert_pdf(tmp_path / 'b.pdf', num_pages=2)
+
+    def test_failed_job(self, app_exec, tmp_path):
+        manifest = tmp_path / 'manifest.jsonl'
+        write_manifest(manifest, [
+            {'pic_files': list(PICS_1_GOOD),
+             'pdf_file': str(tmp_path / 'a.pdf')},
+            {'pic_files': list(PICS_1_GOOD),
+             'pdf_file': str(tmp_path / 'b.pdf'), 'page_size': 'foo'},
+        ])
+
+        command = f'{app_exec} batch -v {manifest}'
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        std_out = proc.stdout.decode()
+
+        assert proc.returncode == 1
+        assert std_out.startswith('1 job failed.\n')
+        assert 'PageSizeError' in std_out
+        assert 'Saved 1 picture (1 page) to 1 file\n' in std_out
+        assert_pdf(tmp_path / 'a.pdf', num_pages=1)
+        assert not (tmp_path / 'b.pdf').exists()
+
+    def test_invalid_manifest(self, app_exec, tmp_path):
+        command = f'{app_exec} batch -'
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE,
+                              input=b'{"pdf_file": "a.pdf"}\n')
+
+        assert proc.returncode == 2
+        assert 'line 1: no pictures specified' in proc.stderr.decode()
+
+
+class TestServe:
+    """Test the serve subcommand of the command line app."""
+
+    def test_job_served(self, app_exec, temp_pdf):
+        command = f'{app_exec} serve --port 0 -j1 -q'
+        proc = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+        try:
+            first_line = proc.stdout.readline().decode()
+            assert first_line.startswith('Serving on http://127.0.0.1:')
+            url = f'{first_line.split()[-1]}pdf'
+            job = {'pic_files': list(PICS_2_GOOD), 'layout': '1x2'}
+            request = Request(url, json.dumps(job).encode(),
+                              {'Content-Type': 'application/json'})
+            with urlopen(request) as response:
+                temp_pdf.write_bytes(response.read())
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+        assert proc.returncode == 0
+        assert_pdf(temp_pdf, num_pages=1)
+
 
 def assert_pdf(path, num_pages):
     assert path.exists()
@@ -259,6 +498,47 @@ class TestGeneratedFile:
 
         assert_pdf(temp_pdf, num_pages=num_pics)
 
+    @pytest.mark.parametrize(
+        'inputs, num_pics',
+        (
+            pytest.param("'pics/plots/gauss*'", 2, id='quoted glob'),
+            pytest.param("'pics/**/*.png'", 5, id='recursive glob'),
+            # pics/not_jpg.jpg is skipped
+            pytest.param('-d pics', 8, id='input dir'),
+            pytest.param('-d pics -e JPG', 3, id='input dir, extension'),
+            pytest.param('-d pics/plots -d pics/blender', 6,
+                         id='2 input dirs'),
+        )
+    )
+    def test_lazy_input(self, app_exec, temp_pdf, inputs, num_pics):
+        command = f'{app_exec} {inputs} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=num_pics)
+
+    def test_list_file(self, app_exec, temp_pdf, tmp_path):
+        list_file = tmp_path / 'list.txt'
+        list_file.write_text('\n'.join(PICS_2_GOOD) + '\n\n')
+        command = f'{app_exec} @{list_file} {PIC_FILE} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=3)
+
+    def test_from_stdin(self, app_exec, temp_pdf):
+        command = f'{app_exec} --from-stdin {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                       input='\n'.join(PICS_2_GOOD).encode())
+
+        assert_pdf(temp_pdf, num_pages=2)
+
+    def test_no_input(self, app_exec, temp_pdf):
+        command = f'{app_exec} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+
+        assert proc.returncode == 2
+        assert 'no pictures specified' in proc.stderr.decode()
+        assert not temp_pdf.exists()
+
     def test_valid_and_invalid_input(self, app_exec, temp_pdf):
         command = f'{app_exec} {" ".join(PICS_1_GOOD_1_BAD)} {temp_pdf}'
         subprocess.run(command, shell=True, stdout=subprocess.PIPE)
@@ -310,6 +590,153 @@ class TestGeneratedFile:
 
         assert_pdf(temp_pdf, num_pages=num_pages)
 
+    def test_jobs(self, app_exec, temp_pdf):
+        # 6 valid pictures + 2 invalid
+        pic_files = PICS_2_GOOD * 3 + PICS_2_BAD
+
+        command = f'{app_exec} -j2 -l1x2 {" ".join(pic_files)} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=3)
+
+    def test_streaming(self, app_exec, temp_pdf):
+        # 6 valid pictures + 2 invalid
+        pic_files = PICS_2_GOOD * 3 + PICS_2_BAD
+
+        command = (f'{app_exec} --streaming -l1x2 {" ".join(pic_files)}'
+                   f' {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=3)
+
+    def test_memory_budget(self, app_exec, temp_pdf):
+        # 6 valid pictures + 2 invalid
+        pic_files = PICS_2_GOOD * 3 + PICS_2_BAD
+
+        command = (f'{app_exec} --memory-budget 1000000 -l1x2'
+                   f' {" ".join(pic_files)} {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=3)
+
+    @pytest.mark.parametrize('streaming', ('', '--streaming'))
+    def test_stdout(self, app_exec, temp_pdf, streaming):
+        command = f'{app_exec} {streaming} -l1x2 {" ".join(PICS_2_GOOD)} -'
+        # stdout is a pipe, which is not seekable
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        temp_pdf.write_bytes(proc.stdout)
+
+        assert_pdf(temp_pdf, num_pages=1)
+        assert proc.stderr.decode() == 'Saved 2 pictures (1 page) to stdout\n'
+
+    def test_max_bytes(self, app_exec, temp_shards):
+        # 6 pictures
+        pic_files = PICS_2_GOOD * 3
+        max_bytes = 60_000
+
+        command = (f'{app_exec} --max-bytes {max_bytes}'
+                   f' {" ".join(pic_files)} {temp_shards}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert not temp_shards.exists()
+        shard_paths = sorted(
+            Path.cwd().glob('_test_temp_-[0-9][0-9][0-9].pdf')
+        )
+        assert len(shard_paths) > 1
+        for shard_path in shard_paths:
+            assert_pdf(shard_path, num_pages=1)
+            assert shard_path.stat().st_size <= max_bytes
+
+    def test_append(self, app_exec, temp_pdf):
+        command = f'{app_exec} -l1x2 {PIC_FILE} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        original_contents = temp_pdf.read_bytes()
+
+        command = f'{app_exec} -a -l1x2 {" ".join(PICS_2_GOOD)} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=2)
+        assert temp_pdf.read_bytes().startswith(original_contents)
+
+    def test_cache_dir(self, app_exec, temp_pdf, tmp_path):
+        cache_dir = tmp_path / 'cache'
+        command = (f'{app_exec} -f --cache-dir {cache_dir}'
+                   f' {" ".join(PICS_2_GOOD)} {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        cold_contents = temp_pdf.read_bytes()
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=2)
+        assert len(list(cache_dir.iterdir())) == 2
+        assert len(temp_pdf.read_bytes()) == len(cold_contents)
+
+    def test_max_dpi_reduces_file_size(self, app_exec, temp_pdf):
+        command = f'{app_exec} -l3x3 {" ".join(PICS_2_GOOD)} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        full_size = temp_pdf.stat().st_size
+        temp_pdf.unlink()
+
+        command = (f'{app_exec} -l3x3 --max-dpi 72 {" ".join(PICS_2_GOOD)}'
+                   f' {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=1)
+        assert temp_pdf.stat().st_size < full_size
+
+    def test_no_compression_increases_file_size(self, app_exec, temp_pdf):
+        pic_files = ('pics/plots/gauss_2x2.png',)
+        command = f'{app_exec} {" ".join(pic_files)} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        default_size = temp_pdf.stat().st_size
+        temp_pdf.unlink()
+
+        command = (f'{app_exec} --compression none {" ".join(pic_files)}'
+                   f' {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=1)
+        assert temp_pdf.stat().st_size > default_size
+
+    def test_auto_layout(self, app_exec, temp_pdf):
+        pic_files = PICS_2_GOOD * 3
+        command = f'{app_exec} -l auto {" ".join(pic_files)} {temp_pdf}'
+        proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert proc.returncode == 0
+        assert 'Saved 6 pictures (1 page) to ' in proc.stdout.decode()
+        assert_pdf(temp_pdf, num_pages=1)
+
+    def test_reencode_reduces_file_size(self, app_exec, temp_pdf):
+        pic_file = 'pics/mandelbrot.png'
+        command = f'{app_exec} {pic_file} {temp_pdf}'
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+        lossless_size = temp_pdf.stat().st_size
+        temp_pdf.unlink()
+
+        command = (f'{app_exec} --reencode jpeg --jpeg-quality 50'
+                   f' {pic_file} {temp_pdf}')
+        subprocess.run(command, shell=True, stdout=subprocess.PIPE)
+
+        assert_pdf(temp_pdf, num_pages=1)
+        assert temp_pdf.stat().st_size < lossless_size
+
+    @pytest.mark.parametrize(
+        'option',
+        (
+            pytest.param('--jpeg-quality 0', id='jpeg quality'),
+            pytest.param('--min-saving 100', id='min saving'),
+        )
+    )
+    def test_invalid_reencode_option(self, app_exec, temp_pdf, option):
+        command = (f'{app_exec} --reencode jpeg {option} {PIC_FILE}'
+                   f' {temp_pdf}')
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+
+        assert proc.returncode == 2
+        assert 'error: ValueError: invalid' in proc.stderr.decode()
+        assert not temp_pdf.exists()
+
     @pytest.mark.parametrize(
         'layout',
         (
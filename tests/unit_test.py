@@ -1,11 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from io import BytesIO
+import json
+import os
+import socket
+import threading
 from pathlib import Path
 from unittest.mock import create_autospec
+import zlib
 
 import pytest
-from PIL import UnidentifiedImageError as ImageError
-
-from pictureshow import PictureShow, PageSizeError, MarginError, LayoutError
-from pictureshow.core import ImageReader
+from PIL import Image, UnidentifiedImageError as ImageError
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import ContentStream
+from reportlab.pdfgen.canvas import Canvas
+
+from pictureshow import (
+    Hooks, PictureShow, PageSizeError, MarginError, LayoutError,
+    pictures_to_pdf_async
+)
+from pictureshow.core import (
+    DrawingArea, ImageReader, PlacedPicture, Placement, _LazyPicture,
+    _PictureCanvas, _PreparedPicture,
+    _footprint, _header_size, _jpeg_info, _png_info, _prepare_picture
+)
+from pictureshow.batch import Job, read_manifest, run_batch
+from pictureshow.cache import PictureCache
+from pictureshow.server import HTTPPictureServer
+from pictureshow.inputs import expand_pattern, read_list, scan_dir
+from pictureshow.stats import PHASES, PictureTime, Stats
+from pictureshow.reader import (
+    Name, PdfFile, PdfSyntaxError, Reference, parse_object, serialize
+)
+from pictureshow.writer import LAYOUT_KEY, AppendingCanvas, StreamingCanvas
 
 A4_WIDTH = 72 * 210 / 25.4
 A4_LENGTH = 72 * 297 / 25.4
@@ -16,18 +44,44 @@ DEFAULTS = dict(page_size=A4, margin=72, layout=(1, 1), stretch_small=False)
 
 
 def picture():
-    """Return a mock to replace ImageReader objects in tests."""
-    image_reader = create_autospec(ImageReader, instance=True)
-    image_reader.getSize.return_value = (640, 400)
-
-    return image_reader
+    """Return a mock to replace _PreparedPicture objects in tests."""
+    prepared_picture = create_autospec(_PreparedPicture, instance=True)
+    prepared_picture.getSize.return_value = (640, 400)
+    prepared_picture.data_size.return_value = 10_000
+
+    return prepared_picture
+
+
+def patch_prepare(mocker, prepare_side_effects):
+    """Patch reading and preparing pictures. Each file read has unique
+    contents, so that no duplicates are detected.
+    """
+    unique_contents = [bytes([i]) for i in range(len(prepare_side_effects))]
+    mocker.patch('pictureshow.core.open_and_read', autospec=True,
+                 side_effect=unique_contents)
+    mocker.patch('pictureshow.core._LazyPicture', autospec=True,
+                 side_effect=prepare_side_effects)
+
+
+def png_with_alpha(alpha):
+    """Return PNG data of a plot with its alpha channel replaced:
+    'gradual' is a gradient, 'binary' has values 0 and 255 only.
+    """
+    image = Image.open('pics/plots/gauss_2x2.png')
+    gradient = Image.linear_gradient('L').resize(image.size)
+    if alpha == 'binary':
+        gradient = gradient.point(lambda value: 255 if value >= 128 else 0)
+    image.putalpha(gradient)
+    stream = BytesIO()
+    image.save(stream, 'PNG')
+    return stream.getvalue()
 
 
 class TestSavePdf:
     """Test core.PictureShow._save_pdf"""
 
     @pytest.mark.parametrize(
-        'reader_side_effects, expected_ok, expected_errors',
+        'prepare_side_effects, expected_ok, expected_errors',
         (
             pytest.param([picture()], 1, 0, id='1 valid'),
             pytest.param([picture(), picture()], 2, 0, id='2 valid'),
@@ -35,13 +89,12 @@ class TestSavePdf:
                          id='1 valid + 1 invalid'),
         )
     )
-    def test_valid_input(self, mocker, reader_side_effects, expected_ok,
+    def test_valid_input(self, mocker, prepare_side_effects, expected_ok,
                          expected_errors):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pdf_file = 'foo.pdf'
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        mocker.patch('pictureshow.core.Canvas', autospec=True)
+        patch_prepare(mocker, prepare_side_effects)
+        mocker.patch('pictureshow.core._PictureCanvas', autospec=True)
         result = PictureShow(*pic_files)._save_pdf(pdf_file, **DEFAULTS)
 
         assert result.num_ok == expected_ok
@@ -49,19 +102,19 @@ class TestSavePdf:
         assert result.num_pages == expected_ok
 
     @pytest.mark.parametrize(
-        'reader_side_effects, expected_errors',
+        'prepare_side_effects, expected_errors',
         (
             pytest.param([ImageError], 1, id='1 invalid'),
             pytest.param([ImageError, ImageError], 2, id='2 invalid'),
             pytest.param([OSError], 1, id='dir or missing'),
         )
     )
-    def test_invalid_input(self, mocker, reader_side_effects, expected_errors):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+    def test_invalid_input(self, mocker, prepare_side_effects,
+                           expected_errors):
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pdf_file = 'foo.pdf'
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        mocker.patch('pictureshow.core.Canvas', autospec=True)
+        patch_prepare(mocker, prepare_side_effects)
+        mocker.patch('pictureshow.core._PictureCanvas', autospec=True)
         result = PictureShow(*pic_files)._save_pdf(pdf_file, **DEFAULTS)
 
         assert result.num_ok == 0
@@ -69,19 +122,18 @@ class TestSavePdf:
         assert result.num_pages == 0
 
     @pytest.mark.parametrize(
-        'reader_side_effects, expected_ok, expected_pages',
+        'prepare_side_effects, expected_ok, expected_pages',
         (
             pytest.param([picture(), picture()], 2, 1, id='2 valid'),
             pytest.param([picture(), picture(), picture()], 3, 2, id='3 valid'),
         )
     )
-    def test_multipage_layout(self, mocker, reader_side_effects, expected_ok,
+    def test_multipage_layout(self, mocker, prepare_side_effects, expected_ok,
                               expected_pages):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pdf_file = 'foo.pdf'
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        mocker.patch('pictureshow.core.Canvas', autospec=True)
+        patch_prepare(mocker, prepare_side_effects)
+        mocker.patch('pictureshow.core._PictureCanvas', autospec=True)
         params = {**DEFAULTS, 'layout': (1, 2)}
         result = PictureShow(*pic_files)._save_pdf(pdf_file, **params)
 
@@ -90,6 +142,825 @@ class TestSavePdf:
         assert result.num_pages == expected_pages
 
 
+class TestErrorMessages:
+    """Test core.PictureShow.save_pdf errors, prepared anywhere"""
+
+    @pytest.fixture
+    def truncated_file(self, tmp_path):
+        pic_file = tmp_path / 'truncated.png'
+        pic_file.write_bytes(Path('pics/mandelbrot.png').read_bytes()[:3000])
+        return str(pic_file)
+
+    @pytest.mark.parametrize(
+        'options',
+        (
+            pytest.param({}, id='serial'),
+            pytest.param({'workers': 2}, id='workers'),
+            pytest.param({'memory_budget': 2**30}, id='memory budget'),
+            pytest.param({'max_pages_per_file': 1}, id='shards'),
+        )
+    )
+    def test_same_messages(self, tmp_path, truncated_file, options):
+        pic_files = ['pics/not_jpg.jpg', truncated_file,
+                     'pics/mandelbrot.png']
+        result = PictureShow(*pic_files).save_pdf(tmp_path / 'foo.pdf',
+                                                  **options)
+
+        assert [(pic_file, str(error)) for pic_file, error
+                in result.errors] == [
+            ('pics/not_jpg.jpg',
+             "cannot identify image file 'pics/not_jpg.jpg'"),
+            (truncated_file, 'image file is truncated'),
+        ]
+
+    def test_plan_message(self):
+        plan = PictureShow('pics/not_jpg.jpg').plan()
+
+        assert [str(error) for _, error in plan.errors] == [
+            "cannot identify image file 'pics/not_jpg.jpg'"
+        ]
+
+
+class TestSaveShards:
+    """Test core.PictureShow._save_pdf with shard limits"""
+
+    def test_max_pages(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg',
+                     'pics/not_jpg.jpg'] * 3
+        params = {**DEFAULTS, 'layout': (1, 2)}
+        result = PictureShow(*pic_files)._save_pdf(
+            str(tmp_path / 'foo.pdf'), max_pages_per_file=2, **params
+        )
+
+        assert result.num_ok == 6
+        assert result.num_pages == 3
+        assert len(result.errors) == 3
+        assert [(Path(shard.pdf_file).name, shard.num_ok, shard.num_pages)
+                for shard in result.shards] == [('foo-001.pdf', 4, 2),
+                                                ('foo-002.pdf', 2, 1)]
+        for shard in result.shards:
+            assert PdfFileReader(shard.pdf_file).numPages == shard.num_pages
+        assert not (tmp_path / 'foo.pdf').exists()
+
+    def test_prepared_in_workers(self, tmp_path, mocker):
+        prepare = mocker.spy(_LazyPicture, 'prepare')
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg',
+                     'pics/plots/gauss_2x2.png'] * 2
+        result = PictureShow(*pic_files).save_pdf(
+            tmp_path / 'foo.pdf', max_pages_per_file=2
+        )
+
+        assert result.num_ok == 6
+        assert result.num_duplicates == 3
+        assert len(result.shards) == 3
+        # not prepared in the main process
+        assert prepare.call_count == 0
+
+    def test_no_valid_pictures(self, tmp_path):
+        result = PictureShow('pics/not_jpg.jpg')._save_pdf(
+            str(tmp_path / 'foo.pdf'), max_pages_per_file=2, **DEFAULTS
+        )
+
+        assert result.num_ok == 0
+        assert result.shards == []
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.fixture
+    def old_files(self, tmp_path):
+        """Shards of an earlier run, and files not named as shards."""
+        names = ['foo-001.pdf', 'foo-002.pdf', 'foo-003.pdf', 'foo-005.pdf',
+                 'foo-2023.pdf', 'foo-01.pdf', 'foo-bar.pdf', 'bar-002.pdf']
+        for name in names:
+            (tmp_path / name).write_bytes(b'old')
+        return names
+
+    def test_stale_shards_removed(self, tmp_path, old_files):
+        pic_files = ['pics/mandelbrot.png'] * 3
+        result = PictureShow(*pic_files).save_pdf(
+            tmp_path / 'foo.pdf', force_overwrite=True, max_pages_per_file=2
+        )
+
+        assert len(result.shards) == 2
+        # numbered files after the first gap are not shards of the run
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            'bar-002.pdf', 'foo-001.pdf', 'foo-002.pdf', 'foo-005.pdf',
+            'foo-01.pdf', 'foo-2023.pdf', 'foo-bar.pdf'
+        ]
+        assert (tmp_path / 'foo-001.pdf').read_bytes() != b'old'
+        assert (tmp_path / 'foo-005.pdf').read_bytes() == b'old'
+
+    def test_dated_files_not_shards(self, tmp_path):
+        for name in 'foo-2023.pdf', 'foo-2024.pdf':
+            (tmp_path / name).write_bytes(b'old')
+        result = PictureShow('pics/mandelbrot.png').save_pdf(
+            tmp_path / 'foo.pdf', max_pages_per_file=10
+        )
+
+        assert len(result.shards) == 1
+        assert (tmp_path / 'foo-2023.pdf').read_bytes() == b'old'
+        assert (tmp_path / 'foo-2024.pdf').read_bytes() == b'old'
+
+    def test_existing_shards_raise_error(self, tmp_path, old_files):
+        with pytest.raises(FileExistsError, match="file '.*' exists"):
+            PictureShow('pics/mandelbrot.png').save_pdf(
+                tmp_path / 'foo.pdf', max_pages_per_file=2
+            )
+
+        assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+            old_files
+        )
+
+
+class WriteOnlyStream:
+    """Binary stream supporting only write, like a pipe or a socket."""
+
+    def __init__(self):
+        self.buffer = BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+class TestSaveToStream:
+    """Test core.PictureShow.save_pdf with a stream as pdf_file"""
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_saved(self, streaming):
+        stream = WriteOnlyStream()
+        result = PictureShow(
+            'pics/mandelbrot.png', 'pics/not_jpg.jpg', 'pics/mandelbrot.jpg'
+        ).save_pdf(stream, layout=(1, 2), streaming=streaming, stats=True)
+
+        contents = stream.buffer.getvalue()
+        assert PdfFileReader(BytesIO(contents)).numPages == 1
+        assert result.num_ok == 2
+        assert result.shards[0].pdf_file is stream
+        assert result.stats.bytes_written == len(contents)
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_nothing_saved(self, streaming):
+        stream = BytesIO()
+        result = PictureShow('pics/not_jpg.jpg').save_pdf(
+            stream, streaming=streaming
+        )
+
+        assert result.num_ok == 0
+        assert stream.getvalue() == b''
+        assert not stream.closed
+
+    @pytest.mark.parametrize(
+        'options',
+        (
+            pytest.param({'max_pages_per_file': 1}, id='split'),
+            pytest.param({'append': True}, id='append'),
+        )
+    )
+    def test_unsupported(self, options):
+        with pytest.raises(ValueError):
+            PictureShow('pics/mandelbrot.png').save_pdf(BytesIO(), **options)
+
+
+class TestSaveStats:
+    """Test core.PictureShow._save_pdf with stats"""
+
+    @pytest.mark.parametrize(
+        'options',
+        (
+            pytest.param({}, id='default'),
+            pytest.param({'workers': 2}, id='workers'),
+            pytest.param({'max_dpi': 10}, id='downsampled'),
+            pytest.param({'max_pages_per_file': 1}, id='shards'),
+        )
+    )
+    def test_stats(self, tmp_path, options):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain.png',
+                     'pics/not_jpg.jpg', 'pics/mandelbrot.png']
+        result = PictureShow(*pic_files)._save_pdf(
+            str(tmp_path / 'foo.pdf'), stats=True, **options, **DEFAULTS
+        )
+        stats = result.stats
+
+        assert stats.bytes_read == sum(os.path.getsize(pic_file)
+                                       for pic_file in pic_files)
+        assert stats.bytes_written == sum(os.path.getsize(shard.pdf_file)
+                                          for shard in result.shards)
+        assert all(stats.phase(name).wall >= 0 for name in PHASES)
+        assert stats.phase('compress').wall > 0
+        assert stats.phase('save').wall > 0
+        assert (stats.phase('scale').wall > 0) == ('max_dpi' in options)
+        slowest = stats.slowest()
+        assert {pic_file for pic_file, _ in slowest} == set(pic_files)
+        assert slowest == sorted(slowest, key=lambda item: -item.seconds)
+
+    def test_no_stats_by_default(self, tmp_path):
+        result = PictureShow('pics/mandelbrot.png')._save_pdf(
+            str(tmp_path / 'foo.pdf'), **DEFAULTS
+        )
+
+        assert result.stats is None
+
+
+class TestStats:
+    """Test stats.Stats"""
+
+    def test_merge(self):
+        stats = Stats()
+        stats.add({'read': (1.0, 0.5)}, 'foo.png')
+        stats.bytes_read = 100
+        other = Stats()
+        other.add({'read': (2.0, 1.0), 'draw': (0.25, 0.25)}, 'bar.png')
+        other.add({'decode': (1.5, 1.5)}, 'foo.png')
+        other.bytes_written = 200
+        stats.merge(other)
+
+        assert stats.phase('read') == (3.0, 1.5)
+        assert stats.phase('draw') == (0.25, 0.25)
+        assert stats.phase('save') == (0.0, 0.0)
+        assert (stats.bytes_read, stats.bytes_written) == (100, 200)
+        assert stats.slowest() == [PictureTime('foo.png', 2.5),
+                                   PictureTime('bar.png', 2.25)]
+        assert stats.slowest(1) == [PictureTime('foo.png', 2.5)]
+
+
+class RecordingHooks(Hooks):
+    """Hooks recording the events called."""
+
+    def __init__(self):
+        self.events = []
+
+    def picture_opened(self, pic_file):
+        self.events.append(('opened', pic_file))
+
+    def picture_failed(self, pic_file, error):
+        self.events.append(('failed', pic_file))
+
+    def picture_placed(self, pic_file, area, page_number):
+        self.events.append(('placed', pic_file, area.x, page_number))
+
+    def page_finished(self, page_number):
+        self.events.append(('page', page_number))
+
+    def document_saved(self, pdf_file, num_pictures, num_pages):
+        self.events.append(('saved', Path(pdf_file).name, num_pictures,
+                            num_pages))
+
+
+class TestHooks:
+    """Test core.PictureShow._save_pdf with hooks"""
+
+    def test_events(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/not_jpg.jpg',
+                     'pics/blender/chain.png', 'pics/mandelbrot.jpg']
+        hooks = RecordingHooks()
+        params = {**DEFAULTS, 'layout': (2, 1)}
+        PictureShow(*pic_files)._save_pdf(str(tmp_path / 'foo.pdf'),
+                                          hooks=hooks, **params)
+        left, right = 72, (A4_WIDTH + 72) / 2
+
+        assert hooks.events == [
+            ('opened', 'pics/mandelbrot.png'),
+            ('placed', 'pics/mandelbrot.png', left, 1),
+            ('failed', 'pics/not_jpg.jpg'),
+            ('opened', 'pics/blender/chain.png'),
+            ('placed', 'pics/blender/chain.png', right, 1),
+            ('page', 1),
+            ('opened', 'pics/mandelbrot.jpg'),
+            ('placed', 'pics/mandelbrot.jpg', left, 2),
+            ('page', 2),
+            ('saved', 'foo.pdf', 3, 2),
+        ]
+
+    def test_shard_events(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/mandelbrot.jpg',
+                     'pics/blender/chain.png']
+        hooks = RecordingHooks()
+        PictureShow(*pic_files)._save_pdf(
+            str(tmp_path / 'foo.pdf'), max_pages_per_file=2, hooks=hooks,
+            **DEFAULTS
+        )
+
+        assert [event for event in hooks.events
+                if event[0] in ('page', 'saved')] == [
+            ('page', 1), ('page', 2), ('saved', 'foo-001.pdf', 2, 2),
+            ('page', 3), ('saved', 'foo-002.pdf', 1, 1),
+        ]
+        assert [event[0] for event in hooks.events].count('placed') == 3
+
+    def test_default_hooks_do_nothing(self, tmp_path):
+        pic_show = PictureShow('pics/mandelbrot.png', 'pics/not_jpg.jpg')
+        result = pic_show._save_pdf(str(tmp_path / 'foo.pdf'), hooks=Hooks(),
+                                    **DEFAULTS)
+
+        assert result.num_ok == 1
+
+
+def run(coroutine):
+    """Run coroutine in a new event loop, return its result."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestSavePdfAsync:
+    """Test core.PictureShow.save_pdf_async"""
+
+    def test_result(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/not_jpg.jpg'] * 2
+        result = run(pictures_to_pdf_async(
+            *pic_files, pdf_file=tmp_path / 'foo.pdf', layout=(1, 2)
+        ))
+
+        assert result.num_ok == 2
+        assert result.num_pages == 1
+        assert len(result.errors) == 2
+        assert result.num_duplicates == 1
+        assert PdfFileReader(str(tmp_path / 'foo.pdf')).numPages == 1
+
+    @pytest.mark.parametrize(
+        'options',
+        (
+            pytest.param({}, id='default'),
+            pytest.param({'streaming': True}, id='streaming'),
+            pytest.param({'max_pages_per_file': 1}, id='shards'),
+        )
+    )
+    def test_cancelled(self, mocker, tmp_path, options):
+        pic_show = PictureShow(*['pics/mandelbrot.png'] * 10)
+        data = Path('pics/mandelbrot.png').read_bytes()
+        num_reads = 0
+
+        def read_and_cancel(pic_file):
+            # cancel the task while the 5th file is being read
+            nonlocal num_reads
+            num_reads += 1
+            if num_reads == 5:
+                loop.call_soon_threadsafe(job.cancel)
+                pic_show._cancelled.wait(timeout=5)
+            return data
+
+        async def save():
+            nonlocal loop, job
+            loop = asyncio.get_event_loop()
+            job = asyncio.ensure_future(
+                pic_show.save_pdf_async(tmp_path / 'foo.pdf', **options)
+            )
+            await job
+
+        loop = job = None
+        mocker.patch('pictureshow.core.open_and_read', autospec=True,
+                     side_effect=read_and_cancel)
+        with pytest.raises(asyncio.CancelledError):
+            run(save())
+
+        assert num_reads == 5
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.parametrize(
+        'canvas_class, options',
+        (
+            pytest.param(_PictureCanvas, {}, id='default'),
+            pytest.param(StreamingCanvas, {'streaming': True},
+                         id='streaming'),
+            pytest.param(AppendingCanvas, {'append': True}, id='append'),
+        )
+    )
+    def test_cancelled_while_saving(self, mocker, tmp_path, canvas_class,
+                                    options):
+        pdf_path = tmp_path / 'foo.pdf'
+        original = b''
+        if options.get('append'):
+            PictureShow('pics/mandelbrot.png').save_pdf(pdf_path)
+            original = pdf_path.read_bytes()
+        pic_show = PictureShow(*['pics/blender/chain_render.jpg'] * 2)
+        save_canvas = canvas_class.save
+
+        def cancel_and_save(pdf_canvas):
+            loop.call_soon_threadsafe(job.cancel)
+            pic_show._cancelled.wait(timeout=5)
+            save_canvas(pdf_canvas)
+
+        async def save():
+            nonlocal loop, job
+            loop = asyncio.get_event_loop()
+            job = asyncio.ensure_future(
+                pic_show.save_pdf_async(pdf_path, **options)
+            )
+            await job
+
+        loop = job = None
+        mocker.patch.object(canvas_class, 'save', autospec=True,
+                            side_effect=cancel_and_save)
+        with pytest.raises(asyncio.CancelledError):
+            run(save())
+
+        if original:
+            assert pdf_path.read_bytes() == original
+        else:
+            assert list(tmp_path.iterdir()) == []
+
+
+def placed(picture):
+    return PlacedPicture(picture, 0, 0, 100, 100)
+
+
+class TestShardPages:
+    """Test core.PictureShow._shard_pages"""
+
+    @pytest.mark.parametrize(
+        'max_pages, expected_lengths',
+        (
+            pytest.param(1, [1, 1, 1, 1, 1], id='1'),
+            pytest.param(2, [2, 2, 1], id='2'),
+            pytest.param(5, [5], id='5'),
+            pytest.param(10, [5], id='10'),
+        )
+    )
+    def test_max_pages(self, max_pages, expected_lengths):
+        pages = [[placed(picture())] for _ in range(5)]
+        shards = PictureShow._shard_pages(pages, max_pages=max_pages)
+
+        assert [len(shard) for shard in shards] == expected_lengths
+
+    @pytest.mark.parametrize(
+        'max_bytes, expected_lengths',
+        (
+            pytest.param(1000, [1, 1, 1, 1, 1], id='page too big'),
+            pytest.param(15_000, [1, 1, 1, 1, 1], id='1 page fits'),
+            pytest.param(30_000, [2, 2, 1], id='2 pages fit'),
+            pytest.param(100_000, [5], id='all fit'),
+        )
+    )
+    def test_max_bytes(self, max_bytes, expected_lengths):
+        pages = [[placed(picture())] for _ in range(5)]
+        shards = PictureShow._shard_pages(pages, max_bytes=max_bytes)
+
+        assert [len(shard) for shard in shards] == expected_lengths
+
+    def test_duplicate_counted_once_per_shard(self):
+        pic = picture()
+        pages = [[placed(pic)] for _ in range(5)]
+        shards = PictureShow._shard_pages(pages, max_bytes=20_000)
+
+        assert [len(shard) for shard in shards] == [5]
+
+
+class TestValidateShardLimits:
+    """Test core.PictureShow._validate_shard_limits"""
+
+    @pytest.mark.parametrize(
+        'max_pages, max_bytes',
+        (
+            pytest.param(0, None, id='0 pages'),
+            pytest.param(None, -1, id='-1 bytes'),
+            pytest.param(1.5, None, id='float'),
+            pytest.param('2', None, id='str'),
+        )
+    )
+    def test_invalid_limit_raises_error(self, max_pages, max_bytes):
+        with pytest.raises(ValueError, match='positive integer expected'):
+            PictureShow._validate_shard_limits(max_pages, max_bytes)
+
+
+class TestValidateMaxDpi:
+    """Test core.PictureShow._validate_max_dpi"""
+
+    @pytest.mark.parametrize('max_dpi', (0, -5, 'abc', '72'))
+    def test_invalid_max_dpi_raises_error(self, max_dpi):
+        with pytest.raises(ValueError, match='positive number expected'):
+            PictureShow._validate_max_dpi(max_dpi)
+
+    @pytest.mark.parametrize('max_dpi', (None, 72, 0.5))
+    def test_valid_max_dpi(self, max_dpi):
+        PictureShow._validate_max_dpi(max_dpi)
+
+    def test_save_pdf_raises_error(self, tmp_path):
+        with pytest.raises(ValueError, match='invalid max DPI 0'):
+            PictureShow('pics/mandelbrot.png').save_pdf(
+                tmp_path / 'foo.pdf', max_dpi=0
+            )
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestValidateMemoryBudget:
+    """Test core.PictureShow._validate_memory_budget"""
+
+    @pytest.mark.parametrize('memory_budget', (0, -1, 1.5, '2'))
+    def test_invalid_budget_raises_error(self, memory_budget):
+        with pytest.raises(ValueError, match='positive integer expected'):
+            PictureShow._validate_memory_budget(memory_budget)
+
+
+class TestValidateCompression:
+    """Test core.PictureShow._validate_compression"""
+
+    @pytest.mark.parametrize('compression', (None, 6, 'low', 'MAX'))
+    def test_invalid_compression_raises_error(self, compression):
+        with pytest.raises(ValueError, match='invalid compression'):
+            PictureShow._validate_compression(compression)
+
+
+class TestCompression:
+    """Test core.PictureShow.save_pdf with compression levels"""
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_file_size(self, tmp_path, streaming):
+        pic_files = ['pics/plots/gauss_2x2.png', 'pics/mandelbrot.jpg']
+        sizes = {}
+        for compression in ('none', 'fast', 'default', 'max'):
+            pdf_path = tmp_path / f'{compression}.pdf'
+            result = PictureShow(*pic_files).save_pdf(
+                pdf_path, streaming=streaming, compression=compression,
+                max_dpi=72
+            )
+            assert result.num_ok == 2
+            assert PdfFileReader(str(pdf_path)).numPages == 2
+            sizes[compression] = pdf_path.stat().st_size
+
+        assert sizes['none'] > sizes['fast'] > sizes['default']
+        assert sizes['default'] >= sizes['max']
+
+    @pytest.mark.parametrize(
+        'compression, expected_filters',
+        (
+            pytest.param('none', (), id='none'),
+            pytest.param('fast', ('FlateDecode',), id='fast'),
+        )
+    )
+    def test_decoded_image(self, compression, expected_filters):
+        picture = _prepare_picture(png_with_alpha('gradual'),
+                                   compression=compression)
+        image = picture.image
+
+        assert image._filters == expected_filters
+        assert image._smask._filters == expected_filters
+        if compression == 'none':
+            assert len(image.streamContent) == (
+                image.width * image.height * 3
+            )
+
+    def test_encoded_image_unchanged(self):
+        data = Path('pics/mandelbrot.jpg').read_bytes()
+        picture = _prepare_picture(data, compression='none')
+
+        assert picture.image.streamContent == data
+
+
+class TestValidateReencode:
+    """Test core.PictureShow._validate_reencode"""
+
+    @pytest.mark.parametrize(
+        'options, message',
+        (
+            pytest.param({'reencode': 'png'}, 'invalid reencode',
+                         id='reencode'),
+            pytest.param({'jpeg_quality': 0}, 'invalid JPEG quality',
+                         id='quality too low'),
+            pytest.param({'jpeg_quality': 85.0}, 'invalid JPEG quality',
+                         id='quality not int'),
+            pytest.param({'min_saving': 1}, 'invalid minimum saving',
+                         id='saving too high'),
+            pytest.param({'min_saving': '0.5'}, 'invalid minimum saving',
+                         id='saving not number'),
+        )
+    )
+    def test_invalid_option_raises_error(self, options, message):
+        options = {'reencode': 'jpeg', 'jpeg_quality': 85,
+                   'min_saving': None, **options}
+        with pytest.raises(ValueError, match=message):
+            PictureShow._validate_reencode(**options)
+
+
+class TestReencode:
+    """Test core._prepare_picture re-encoding pictures to JPEG"""
+
+    @pytest.fixture
+    def tiff_data(self):
+        stream = BytesIO()
+        Image.open('pics/blender/chain_render.jpg').save(stream, 'TIFF')
+        return stream.getvalue()
+
+    def test_png_reencoded(self):
+        data = Path('pics/mandelbrot.png').read_bytes()
+        picture = _prepare_picture(data, reencode='jpeg')
+        image = picture.image
+
+        assert picture.getSize() == (640, 640)
+        assert image._filters == ('DCTDecode',)
+        assert image.colorSpace == 'DeviceGray'
+        assert len(image.streamContent) < len(data)
+
+    def test_tiff_reencoded(self, tiff_data):
+        picture = _prepare_picture(tiff_data, reencode='jpeg')
+
+        assert picture.image._filters == ('DCTDecode',)
+        assert picture.image.colorSpace == 'DeviceRGB'
+        assert _jpeg_info(picture.image.streamContent) == (671, 468, 3)
+
+    def test_quality(self, tiff_data):
+        low, high = (
+            _prepare_picture(tiff_data, reencode='jpeg', jpeg_quality=quality)
+            for quality in (20, 95)
+        )
+        assert len(low.image.streamContent) < len(high.image.streamContent)
+
+    def test_alpha_not_reencoded(self):
+        picture = _prepare_picture(png_with_alpha('gradual'),
+                                   reencode='jpeg')
+        assert picture.image._filters == ('FlateDecode',)
+        assert picture.image._smask is not None
+
+    def test_jpeg_unchanged(self):
+        data = Path('pics/mandelbrot.jpg').read_bytes()
+        picture = _prepare_picture(data, reencode='jpeg')
+
+        assert picture.image.streamContent == data
+
+    @pytest.mark.parametrize(
+        'min_saving, reencoded',
+        (
+            pytest.param(0, True, id='0'),
+            pytest.param(0.999, False, id='0.999'),
+        )
+    )
+    @pytest.mark.parametrize('pic_format', ('png', 'tiff'))
+    def test_min_saving(self, tiff_data, pic_format, min_saving, reencoded):
+        if pic_format == 'png':
+            data = Path('pics/mandelbrot.png').read_bytes()
+        else:
+            data = tiff_data
+        picture = _prepare_picture(data, reencode='jpeg',
+                                   min_saving=min_saving)
+
+        assert (picture.image._filters == ('DCTDecode',)) == reencoded
+        if pic_format == 'png' and not reencoded:
+            # embedded as is
+            assert picture.image.streamContent in data
+
+    def test_save_pdf(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain.png']
+        sizes = {}
+        for reencode in (None, 'jpeg'):
+            pdf_path = tmp_path / f'{reencode}.pdf'
+            result = PictureShow(*pic_files).save_pdf(pdf_path,
+                                                      reencode=reencode)
+            assert result.num_ok == 2
+            assert PdfFileReader(str(pdf_path)).numPages == 2
+            sizes[reencode] = pdf_path.stat().st_size
+
+        assert sizes['jpeg'] < sizes[None]
+
+
+class TestAlpha:
+    """Test core._prepare_picture with alpha channels"""
+
+    def test_opaque_alpha_dropped(self):
+        picture = _prepare_picture(
+            Path('pics/plots/gauss_2x2.png').read_bytes()
+        )
+        image = picture.image
+
+        assert getattr(image, '_smask', None) is None
+        assert image.colorSpace == 'DeviceRGB'
+        assert len(zlib.decompress(image.streamContent)) == 824 * 584 * 3
+
+    def test_opaque_alpha_reencoded(self):
+        picture = _prepare_picture(
+            Path('pics/plots/gauss_2x2.png').read_bytes(), reencode='jpeg'
+        )
+        assert picture.image._filters == ('DCTDecode',)
+
+    @pytest.mark.parametrize(
+        'alpha, bits, row_size',
+        (
+            pytest.param('binary', 1, 824 // 8, id='binary'),
+            pytest.param('gradual', 8, 824, id='gradual'),
+        )
+    )
+    def test_soft_mask(self, alpha, bits, row_size):
+        picture = _prepare_picture(png_with_alpha(alpha))
+        smask = picture.image._smask
+
+        assert smask.bitsPerComponent == bits
+        assert smask.colorSpace == 'DeviceGray'
+        assert len(zlib.decompress(smask.streamContent)) == row_size * 584
+
+    def test_binary_mask_values(self):
+        picture = _prepare_picture(png_with_alpha('binary'),
+                                   compression='none')
+        mask = Image.frombytes('1', (824, 584),
+                               picture.image._smask.streamContent)
+        expected = Image.open(BytesIO(png_with_alpha('binary'))).split()[3]
+
+        assert list(mask.convert('L').getdata()) == list(expected.getdata())
+
+    def test_save_pdf(self, tmp_path):
+        pdf_path = tmp_path / 'foo.pdf'
+        pic_file = tmp_path / 'binary.png'
+        pic_file.write_bytes(png_with_alpha('binary'))
+        result = PictureShow(pic_file).save_pdf(pdf_path)
+
+        assert result.num_ok == 1
+        page = PdfFileReader(str(pdf_path)).pages[0]
+        image, = page['/Resources']['/XObject'].values()
+        smask = image.get_object()['/SMask'].get_object()
+        assert smask['/BitsPerComponent'] == 1
+
+
+class TestPlan:
+    """Test core.PictureShow.plan"""
+
+    def test_pages_as_saved(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/not_jpg.jpg',
+                     'pics/blender/chain.png', 'pics/blender/chain_render.jpg',
+                     'missing.png', 'pics/mandelbrot.jpg']
+        plan = PictureShow(*pic_files).plan(layout=(2, 2), margin=36)
+        result = PictureShow(*pic_files).save_pdf(
+            tmp_path / 'foo.pdf', layout=(2, 2), margin=36
+        )
+
+        assert plan.num_ok == result.num_ok == 4
+        assert plan.num_pages == result.num_pages == 1
+        assert [pic_file for pic_file, _ in plan.errors] == [
+            pic_file for pic_file, _ in result.errors
+        ]
+        assert [placement.pic_file for placement in plan.pages[0]] == [
+            'pics/mandelbrot.png', 'pics/blender/chain.png',
+            'pics/blender/chain_render.jpg', 'pics/mandelbrot.jpg'
+        ]
+
+    def test_placement(self):
+        plan = PictureShow('pics/blender/chain_render.jpg').plan(
+            page_size=(400, 400), margin=50
+        )
+        width = 300
+        height = width * 468 / 671
+        assert plan.pages == [[Placement(
+            'pics/blender/chain_render.jpg', 50, 50 + (width - height) / 2,
+            width, height
+        )]]
+
+    def test_pictures_not_read(self, mocker):
+        open_and_read = mocker.patch('pictureshow.core.open_and_read',
+                                     autospec=True)
+        prepare = mocker.patch('pictureshow.core._prepare_picture',
+                               autospec=True)
+        plan = PictureShow('pics/mandelbrot.png', 'pics/mandelbrot.jpg').plan()
+
+        assert plan.num_pages == 2
+        open_and_read.assert_not_called()
+        prepare.assert_not_called()
+
+    def test_estimated_bytes(self):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg']
+        one = PictureShow(*pic_files[:1]).plan()
+        two = PictureShow(*pic_files).plan()
+        downsampled = PictureShow(*pic_files).plan(max_dpi=72)
+
+        assert one.estimated_bytes < two.estimated_bytes
+        assert downsampled.estimated_bytes < two.estimated_bytes
+        assert two.estimated_bytes > sum(
+            os.path.getsize(pic_file) for pic_file in pic_files
+        )
+
+    def test_generator_consumed(self):
+        pic_show = PictureShow.from_iterable(
+            pic_file for pic_file in ['pics/mandelbrot.png'] * 3
+        )
+        assert pic_show.plan(layout=(1, 2)).num_pages == 2
+
+    def test_invalid_layout_raises_error(self):
+        with pytest.raises(LayoutError):
+            PictureShow('pics/mandelbrot.png').plan(layout=(0, 1))
+
+
+class TestHeaderSize:
+    """Test core._header_size"""
+
+    @pytest.mark.parametrize(
+        'pic_file, expected',
+        (
+            pytest.param('pics/blender/chain_render.jpg', (671, 468),
+                         id='jpeg'),
+            pytest.param('pics/blender/chain.png', (827, 585), id='png'),
+        )
+    )
+    def test_size_found(self, pic_file, expected):
+        assert _header_size(Path(pic_file).read_bytes()) == expected
+
+    @pytest.mark.parametrize(
+        'data',
+        (
+            pytest.param(b'\xff\xd8\xff\xe0\x00\x10JFIF',
+                         id='truncated jpeg'),
+            pytest.param(b'GIF89a\x10\x00\x10\x00', id='gif'),
+        )
+    )
+    def test_size_not_found(self, data):
+        assert _header_size(data) is None
+
+
 class TestValidateTargetPath:
     """Test core.PictureShow._validate_target_path"""
 
@@ -271,6 +1142,10 @@ class TestValidateLayout:
         result = PictureShow()._validate_layout(layout)
         assert result == expected
 
+    @pytest.mark.parametrize('layout', ('auto', ' AUTO '))
+    def test_auto_layout(self, layout):
+        assert PictureShow()._validate_layout(layout) == 'auto'
+
     @pytest.mark.parametrize(
         'layout',
         (
@@ -306,60 +1181,1082 @@ class TestValidPictures:
     """Test core.PictureShow._valid_pictures"""
 
     @pytest.mark.parametrize(
-        'reader_side_effects',
+        'prepare_side_effects',
         (
             pytest.param([picture()], id='1 valid'),
             pytest.param([picture(), picture()], id='2 valid'),
         )
     )
-    def test_all_valid_pictures(self, mocker, reader_side_effects):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+    def test_all_valid_pictures(self, mocker, prepare_side_effects):
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pic_show = PictureShow(*pic_files)
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        result = list(pic_show._valid_pictures())
+        patch_prepare(mocker, prepare_side_effects)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures()]
 
-        assert result == reader_side_effects
+        assert result == prepare_side_effects
         assert len(pic_show.errors) == 0
 
     @pytest.mark.parametrize(
-        'reader_side_effects, expected',
+        'prepare_side_effects, expected',
         (
             pytest.param([1, ImageError, 2], [1, 2], id='2 valid + 1 invalid'),
             pytest.param([ImageError, 1, ImageError], [1],
                          id='2 invalid + 1 valid'),
         )
     )
-    def test_valid_and_invalid_pictures(self, mocker, reader_side_effects,
+    def test_valid_and_invalid_pictures(self, mocker, prepare_side_effects,
                                         expected):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pic_show = PictureShow(*pic_files)
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        result = list(pic_show._valid_pictures())
+        patch_prepare(mocker, prepare_side_effects)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures()]
 
         assert result == expected
         assert len(pic_show.errors) == len(pic_files) - len(expected)
 
     @pytest.mark.parametrize(
-        'reader_side_effects',
+        'prepare_side_effects',
         (
             pytest.param([ImageError], id='1 invalid'),
             pytest.param([ImageError, ImageError], id='2 invalid'),
             pytest.param([OSError], id='dir or missing'),
         )
     )
-    def test_all_invalid_pictures(self, mocker, reader_side_effects):
-        pic_files = ['foo.png'] * len(reader_side_effects)
+    def test_all_invalid_pictures(self, mocker, prepare_side_effects):
+        pic_files = ['foo.png'] * len(prepare_side_effects)
         pic_show = PictureShow(*pic_files)
-        mocker.patch('pictureshow.core.ImageReader', autospec=True,
-                     side_effect=reader_side_effects)
-        result = list(pic_show._valid_pictures())
+        patch_prepare(mocker, prepare_side_effects)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures()]
 
         assert result == []
         assert len(pic_show.errors) == len(pic_files)
 
 
+class TestValidPicturesDuplicates:
+    """Test core.PictureShow._valid_pictures with duplicate files"""
+
+    @pytest.mark.parametrize('workers', (None, 2))
+    def test_duplicates_prepared_once(self, tmp_path, workers):
+        copy = tmp_path / 'copy.png'
+        copy.write_bytes(Path('pics/mandelbrot.png').read_bytes())
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg',
+                     copy, 'pics/mandelbrot.png']
+        pic_show = PictureShow(*pic_files)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures(workers)]
+
+        assert len(result) == 4
+        assert result[0] is result[2] is result[3]
+        assert result[1] is not result[0]
+        assert pic_show.num_duplicates == 2
+
+    @pytest.mark.parametrize('workers', (None, 2))
+    def test_invalid_duplicates_not_counted(self, workers):
+        pic_files = ['pics/not_jpg.jpg', 'missing.png'] * 2
+        pic_show = PictureShow(*pic_files)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures(workers)]
+
+        assert result == []
+        assert len(pic_show.errors) == 4
+        assert pic_show.num_duplicates == 0
+
+    def test_duplicates_counted_in_result(self, mocker):
+        mocker.patch('pictureshow.core.open_and_read', autospec=True,
+                     return_value=b'foo')
+        mocker.patch('pictureshow.core._LazyPicture', autospec=True,
+                     return_value=picture())
+        mocker.patch('pictureshow.core._PictureCanvas', autospec=True)
+        result = PictureShow('foo.png', 'bar.png')._save_pdf(
+            'foo.pdf', **DEFAULTS
+        )
+
+        assert result.num_ok == 2
+        assert result.num_pages == 2
+        assert result.num_duplicates == 1
+
+
+class TestValidPicturesWorkers:
+    """Test core.PictureShow._valid_pictures with worker processes"""
+
+    @pytest.mark.parametrize('workers', (1, 2))
+    def test_order_preserved(self, workers):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg',
+                     'pics/plots/gauss_2x2.png']
+        pic_show = PictureShow(*pic_files)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures(workers)]
+
+        expected = [ImageReader(pic_file).getSize() for pic_file in pic_files]
+        assert [picture.getSize() for picture in result] == expected
+        assert len(pic_show.errors) == 0
+
+    def test_errors_collected(self):
+        pic_files = ['pics/not_jpg.jpg', 'pics/mandelbrot.png', 'missing.png',
+                     'pics']
+        pic_show = PictureShow(*pic_files)
+        result = [picture for _, picture
+                  in pic_show._valid_pictures(workers=2)]
+
+        assert len(result) == 1
+        assert [pic_file for pic_file, _ in pic_show.errors] == [
+            'pics/not_jpg.jpg', 'missing.png', 'pics'
+        ]
+        assert isinstance(pic_show.errors[0][1], ImageError)
+        assert isinstance(pic_show.errors[1][1], OSError)
+
+
+class TestFromIterable:
+    """Test core.PictureShow.from_iterable"""
+
+    def test_consumed_lazily(self, tmp_path):
+        consumed = []
+
+        def pic_files():
+            for pic_file in ('pics/mandelbrot.png', 'pics/not_jpg.jpg'):
+                consumed.append(pic_file)
+                yield pic_file
+
+        pic_show = PictureShow.from_iterable(pic_files())
+        assert consumed == []
+        result = pic_show.save_pdf(tmp_path / 'foo.pdf')
+
+        assert consumed == ['pics/mandelbrot.png', 'pics/not_jpg.jpg']
+        assert result.num_ok == 1
+        assert len(result.errors) == 1
+
+
+class TestValidPicturesMemoryBudget:
+    """Test core.PictureShow._valid_pictures with memory budget"""
+
+    @pytest.mark.parametrize(
+        'workers, memory_budget, expected_reads',
+        (
+            pytest.param(None, 100, 2, id='1 fits'),
+            pytest.param(None, 250, 3, id='2 fit'),
+            pytest.param(None, 50, 2, id='too large'),
+            pytest.param(2, 250, 3, id='2 fit, workers'),
+            pytest.param(2, 10_000, 5, id='4 per 2 workers'),
+        )
+    )
+    def test_read_ahead_limited(self, mocker, workers, memory_budget,
+                                expected_reads):
+        # each picture needs 100 bytes
+        read = mocker.patch('pictureshow.core.open_and_read', autospec=True,
+                            side_effect=[bytes([i]) for i in range(10)])
+        mocker.patch('pictureshow.core._footprint', autospec=True,
+                     return_value=100)
+        mocker.patch('pictureshow.core._prepare_picture', autospec=True,
+                     return_value=picture())
+        # mocks cannot be used in worker processes
+        mocker.patch('pictureshow.core.ProcessPoolExecutor',
+                     ThreadPoolExecutor)
+        pic_show = PictureShow(*['foo.png'] * 10)
+        pictures = pic_show._valid_pictures(workers, None, memory_budget)
+
+        next(pictures)
+        assert read.call_count == expected_reads
+        assert len(list(pictures)) == 9
+
+    def test_save(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/not_jpg.jpg',
+                     'pics/blender/chain.png', 'pics/mandelbrot.png']
+        result = PictureShow(*pic_files)._save_pdf(
+            str(tmp_path / 'foo.pdf'), memory_budget=1, **DEFAULTS
+        )
+
+        assert result.num_ok == 3
+        assert result.num_duplicates == 1
+        assert len(result.errors) == 1
+        assert PdfFileReader(str(tmp_path / 'foo.pdf')).numPages == 3
+
+
+class TestReadManifest:
+    """Test batch.read_manifest"""
+
+    def test_jobs(self):
+        lines = [
+            '{"pic_files": ["a.png", "*.jpg"], "pdf_file": "a.pdf",'
+            ' "layout": "2x2"}\n',
+            '\n',
+            '{"input_dirs": ["pics"], "extensions": ["png"],'
+            ' "pdf_file": "b.pdf", "max_dpi": 150}\n',
+        ]
+
+        assert read_manifest(lines) == [
+            Job('a.pdf', ['a.png', '*.jpg'], [],
+                ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff',
+                 '.webp'),
+                {'layout': '2x2'}),
+            Job('b.pdf', [], ['pics'], ['png'], {'max_dpi': 150}),
+        ]
+
+    @pytest.mark.parametrize(
+        'line, message',
+        (
+            pytest.param('{"pdf_file": "a.pdf", "pic_files": ["a.png"]',
+                         'invalid JSON', id='invalid JSON'),
+            pytest.param('["a.png", "a.pdf"]', 'JSON object expected',
+                         id='not an object'),
+            pytest.param('{"pdf_file": "a.pdf", "pic_files": ["a.png"],'
+                         ' "workers": 2}', "unknown key 'workers'",
+                         id='unknown key'),
+            pytest.param('{"pic_files": ["a.png"]}', 'pdf_file path expected',
+                         id='no target'),
+            pytest.param('{"pdf_file": "a.pdf", "pic_files": "a.png"}',
+                         'pic_files must be a list', id='not a list'),
+            pytest.param('{"pdf_file": "a.pdf"}', 'no pictures specified',
+                         id='no pictures'),
+        )
+    )
+    def test_invalid_job(self, line, message):
+        lines = ['{"pdf_file": "b.pdf", "pic_files": ["b.png"]}', line]
+        with pytest.raises(ValueError, match=f'^line 2: {message}'):
+            read_manifest(lines)
+
+    def test_same_target(self):
+        lines = ['{"pdf_file": "a.pdf", "pic_files": ["a.png"]}',
+                 '{"pdf_file": "./a.pdf", "pic_files": ["b.png"]}']
+        with pytest.raises(ValueError, match='also the target of line 1'):
+            read_manifest(lines)
+
+
+class TestRunBatch:
+    """Test batch.run_batch"""
+
+    def test_results(self, tmp_path):
+        jobs = [
+            Job(str(tmp_path / 'a.pdf'),
+                ['pics/mandelbrot.png', 'pics/not_jpg.jpg'], [], ['png'],
+                {'layout': (1, 2)}),
+            Job(str(tmp_path / 'b.pdf'), [], ['pics/plots'], ['png'], {}),
+            Job(str(tmp_path / 'c.pdf'), ['pics/mandelbrot.png'], [],
+                ['png'], {'page_size': 'foo'}),
+        ]
+        job_results = {Path(job.pdf_file).name: (result, error)
+                       for job, result, error in run_batch(jobs, workers=2)}
+
+        result, error = job_results['a.pdf']
+        assert error is None
+        assert (result.num_ok, result.num_pages) == (1, 1)
+        assert len(result.errors) == 1
+        result, error = job_results['b.pdf']
+        assert error is None
+        assert (result.num_ok, result.num_pages) == (2, 2)
+        assert PdfFileReader(str(tmp_path / 'b.pdf')).numPages == 2
+        result, error = job_results['c.pdf']
+        assert result is None
+        assert isinstance(error, PageSizeError)
+        assert not (tmp_path / 'c.pdf').exists()
+
+
+@pytest.fixture(scope='class')
+def pic_server():
+    """Server running in a background thread, with one worker and
+    no queue.
+    """
+    server = HTTPPictureServer(('127.0.0.1', 0), workers=1, queue_size=0,
+                               quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+
+    # teardown
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def post_job(server, fields, headers=None):
+    """Post job to server, return status, headers and body."""
+    connection = HTTPConnection(*server.server_address)
+    headers = {'Content-Type': 'application/json', **(headers or {})}
+    try:
+        connection.request('POST', '/pdf', json.dumps(fields), headers)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+class TestPictureServer:
+    """Test server.HTTPPictureServer"""
+
+    def test_pdf_returned(self, pic_server):
+        status, headers, body = post_job(pic_server, {
+            'pic_files': ['pics/mandelbrot.png', 'pics/not_jpg.jpg',
+                          'pics/blender/chain_render.jpg'],
+            'layout': '1x2'
+        })
+
+        assert status == 200
+        assert headers['Content-Type'] == 'application/pdf'
+        assert headers['X-Num-Pictures'] == '2'
+        assert headers['X-Num-Pages'] == '1'
+        assert headers['X-Num-Errors'] == '1'
+        assert PdfFileReader(BytesIO(body)).numPages == 1
+
+    def test_pdf_saved(self, pic_server, tmp_path, mocker):
+        mocker.patch.object(pic_server, 'allow_files', True)
+        pdf_file = str(tmp_path / 'foo.pdf')
+        status, _, body = post_job(pic_server, {
+            'pic_files': ['pics/mandelbrot.png'], 'pdf_file': pdf_file
+        })
+
+        assert status == 200
+        assert json.loads(body) == {'num_ok': 1, 'num_pages': 1,
+                                    'num_duplicates': 0, 'errors': [],
+                                    'files': [pdf_file]}
+        assert PdfFileReader(pdf_file).numPages == 1
+
+    @pytest.mark.parametrize(
+        'fields',
+        (
+            pytest.param({'pdf_file': 'foo.pdf'}, id='pdf_file'),
+            pytest.param({'force_overwrite': True}, id='force_overwrite'),
+            pytest.param({'append': True}, id='append'),
+            pytest.param({'cache_dir': 'cache'}, id='cache_dir'),
+        )
+    )
+    def test_files_not_allowed(self, pic_server, tmp_path, fields):
+        fields = {key: str(tmp_path / value) if isinstance(value, str)
+                  else value for key, value in fields.items()}
+        status, _, body = post_job(
+            pic_server, {'pic_files': ['pics/mandelbrot.png'], **fields}
+        )
+
+        assert status == 403
+        assert json.loads(body) == {
+            'error': 'files on the server not allowed'
+        }
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.parametrize(
+        'headers, status',
+        (
+            pytest.param({'Content-Type': 'application/x-www-form-urlencoded'},
+                         415, id='form'),
+            pytest.param({'Content-Type': 'text/plain'}, 415, id='text'),
+            pytest.param({'Content-Type': 'application/json; charset=utf-8'},
+                         200, id='json with charset'),
+            pytest.param({'Origin': 'http://127.0.0.1:8000'}, 403,
+                         id='origin'),
+            pytest.param({'Host': 'evil.example.com'}, 403, id='rebound host'),
+            pytest.param({'Host': 'evil.example.com:8000'}, 403,
+                         id='rebound host with port'),
+            pytest.param({'Host': 'localhost:8000'}, 200, id='localhost'),
+            pytest.param({'Host': '[::1]:8000'}, 200, id='IPv6 localhost'),
+        )
+    )
+    def test_browser_requests(self, pic_server, headers, status):
+        response_status, _, _ = post_job(
+            pic_server, {'pic_files': ['pics/mandelbrot.png']}, headers
+        )
+
+        assert response_status == status
+
+    def test_nothing_saved(self, pic_server):
+        status, _, body = post_job(pic_server,
+                                   {'pic_files': ['pics/not_jpg.jpg']})
+
+        assert status == 422
+        result = json.loads(body)
+        assert result['num_ok'] == 0
+        assert result['errors'][0]['pic_file'] == 'pics/not_jpg.jpg'
+
+    @pytest.mark.parametrize(
+        'fields, error',
+        (
+            pytest.param({'pic_files': ['pics/mandelbrot.png'],
+                          'workers': 2}, 'ValueError', id='invalid job'),
+            pytest.param({'pic_files': ['pics/mandelbrot.png'],
+                          'page_size': 'foo'}, 'PageSizeError',
+                         id='invalid option'),
+        )
+    )
+    def test_bad_request(self, pic_server, fields, error):
+        status, _, body = post_job(pic_server, fields)
+
+        assert status == 400
+        assert json.loads(body)['error'].startswith(f'{error}: ')
+
+    @pytest.mark.parametrize(
+        'length, status',
+        (
+            pytest.param(None, 411, id='missing'),
+            pytest.param('foo', 400, id='not a number'),
+            pytest.param('-1', 400, id='negative'),
+        )
+    )
+    def test_invalid_content_length(self, pic_server, length, status):
+        connection = HTTPConnection(*pic_server.server_address, timeout=5)
+        try:
+            connection.putrequest('POST', '/pdf')
+            connection.putheader('Content-Type', 'application/json')
+            if length is not None:
+                connection.putheader('Content-Length', length)
+            connection.endheaders()
+            response = connection.getresponse()
+        finally:
+            connection.close()
+
+        assert response.status == status
+
+    def test_too_many_jobs(self, pic_server, mocker):
+        mocker.patch.object(pic_server, 'num_jobs', 1)
+        status, headers, _ = post_job(pic_server,
+                                      {'pic_files': ['pics/mandelbrot.png']})
+
+        assert status == 503
+        assert headers['Retry-After'] == '1'
+
+    def test_status(self, pic_server):
+        connection = HTTPConnection(*pic_server.server_address)
+        connection.request('GET', '/status')
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == {
+            'workers': 1, 'queue_size': 0, 'num_jobs': 0
+        }
+        connection.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                    reason='Unix sockets not supported')
+def test_unix_picture_server(tmp_path):
+    from pictureshow.server import UnixPictureServer
+
+    socket_path = str(tmp_path / 'server.sock')
+    server = UnixPictureServer(socket_path, workers=1, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        body = json.dumps({'pic_files': ['pics/mandelbrot.png']}).encode()
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(socket_path)
+            client.sendall(b'POST /pdf HTTP/1.0\r\nContent-Length: %d\r\n'
+                           b'Content-Type: application/json\r\n'
+                           b'\r\n%s' % (len(body), body))
+            response = b''.join(iter(lambda: client.recv(65536), b''))
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    head, pdf_data = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 200 ')
+    assert PdfFileReader(BytesIO(pdf_data)).numPages == 1
+    assert not Path(socket_path).exists()
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """Directory tree of empty files, as current working directory."""
+    for path in ('b.png', 'a.JPG', 'c.txt', '.hidden.png', 'sub/d.png',
+                 'sub/deeper/e.png', 'sub/f.gif', 'empty/'):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if not str(path).endswith('empty'):
+            path.touch()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def posix(paths):
+    return [path.replace(os.sep, '/') for path in paths]
+
+
+class TestInputs:
+    """Test inputs.scan_dir, inputs.expand_pattern, inputs.read_list"""
+
+    def test_scan_dir(self, tree):
+        assert posix(scan_dir('.')) == [
+            './.hidden.png', './a.JPG', './b.png', './sub/d.png',
+            './sub/deeper/e.png', './sub/f.gif'
+        ]
+
+    def test_scan_dir_extensions(self, tree):
+        assert posix(scan_dir('sub', ['.PNG'])) == ['sub/d.png',
+                                                   'sub/deeper/e.png']
+
+    def test_scan_dir_missing(self, tree):
+        with pytest.raises(FileNotFoundError):
+            list(scan_dir('missing'))
+
+    @pytest.mark.parametrize(
+        'pattern, expected',
+        (
+            pytest.param('*.png', ['b.png'], id='hidden not matched'),
+            pytest.param('.*', ['.hidden.png'], id='hidden'),
+            pytest.param('[ab].*', ['a.JPG', 'b.png'], id='range'),
+            pytest.param('sub/*', ['sub/d.png', 'sub/deeper', 'sub/f.gif'],
+                         id='subdirectory'),
+            pytest.param('*/*.png', ['sub/d.png'], id='any directory'),
+            pytest.param('**/*.png', ['b.png', 'sub/d.png',
+                                      'sub/deeper/e.png'], id='recursive'),
+            pytest.param('sub/**', ['sub/d.png', 'sub/deeper/e.png',
+                                    'sub/f.gif'], id='recursive at end'),
+            pytest.param('missing/*', ['missing/*'], id='missing directory'),
+            pytest.param('*.bmp', ['*.bmp'], id='nothing matched'),
+            pytest.param('b.png', ['b.png'], id='not a pattern'),
+            pytest.param('missing.png', ['missing.png'], id='missing file'),
+            pytest.param('http://foo/?bar', ['http://foo/?bar'], id='URL'),
+        )
+    )
+    def test_expand_pattern(self, tree, pattern, expected):
+        assert posix(expand_pattern(pattern)) == expected
+
+    def test_expand_absolute_pattern(self, tree):
+        assert list(expand_pattern(str(tree / 'sub' / '*.gif'))) == [
+            str(tree / 'sub' / 'f.gif')
+        ]
+
+    def test_read_list(self):
+        lines = BytesIO(b'foo.png\n\n  bar baz.jpg \r\n').read().decode()
+
+        assert list(read_list(lines.splitlines(True))) == ['foo.png',
+                                                           'bar baz.jpg']
+
+
+class TestFootprint:
+    """Test core._footprint"""
+
+    @pytest.mark.parametrize('pic_file', ('pics/mandelbrot.png',
+                                          'pics/blender/chain_render.jpg'))
+    def test_estimate(self, pic_file):
+        data = Path(pic_file).read_bytes()
+        with Image.open(pic_file) as image:
+            decoded_size = len(image.tobytes())
+
+        assert _footprint(data) == len(data) + 2 * decoded_size
+
+    def test_not_a_picture(self):
+        data = Path('pics/not_jpg.jpg').read_bytes()
+
+        assert _footprint(data) == len(data)
+
+
+def jpeg_data(mode='RGB', size=(64, 48), **save_options):
+    """Return contents of a JPEG file with a blank picture."""
+    stream = BytesIO()
+    Image.new(mode, size).save(stream, 'JPEG', **save_options)
+    return stream.getvalue()
+
+
+class TestJpegInfo:
+    """Test core._jpeg_info"""
+
+    @pytest.mark.parametrize(
+        'mode, save_options, expected',
+        (
+            pytest.param('RGB', {}, (64, 48, 3), id='baseline RGB'),
+            pytest.param('L', {}, (64, 48, 1), id='baseline gray'),
+            pytest.param('CMYK', {}, (64, 48, 4), id='baseline CMYK'),
+            pytest.param('RGB', {'progressive': True}, (64, 48, 3),
+                         id='progressive'),
+        )
+    )
+    def test_valid_jpeg(self, mode, save_options, expected):
+        assert _jpeg_info(jpeg_data(mode, **save_options)) == expected
+
+    def test_jpeg_file(self):
+        data = Path('pics/blender/chain_render.jpg').read_bytes()
+        assert _jpeg_info(data) == (671, 468, 3)
+
+    @pytest.mark.parametrize(
+        'data',
+        (
+            pytest.param(b'', id='empty'),
+            pytest.param(Path('pics/not_jpg.jpg').read_bytes(), id='not jpg'),
+            pytest.param(jpeg_data()[:100], id='truncated'),
+            pytest.param(b'\xff\xd8\xff\xc3\x00\x0b\x08\x00\x10\x00\x10'
+                         b'\x01', id='lossless'),
+        )
+    )
+    def test_invalid_jpeg_raises_error(self, data):
+        with pytest.raises(ValueError):
+            _jpeg_info(data)
+
+
+def png_data(mode='RGB', size=(64, 48), **save_options):
+    """Return contents of a PNG file with a blank picture."""
+    stream = BytesIO()
+    Image.new(mode, size).save(stream, 'PNG', **save_options)
+    return stream.getvalue()
+
+
+class TestPngInfo:
+    """Test core._png_info"""
+
+    @pytest.mark.parametrize(
+        'mode, expected_components',
+        (
+            pytest.param('RGB', 3, id='RGB'),
+            pytest.param('L', 1, id='gray'),
+        )
+    )
+    def test_valid_png(self, mode, expected_components):
+        width, height, components, idat_data = _png_info(png_data(mode))
+
+        assert (width, height, components) == (64, 48, expected_components)
+        # decompressed data: filter type byte + pixel data for each row
+        expected_length = 48 * (1 + 64 * expected_components)
+        assert len(zlib.decompress(idat_data)) == expected_length
+
+    def test_multiple_idat_chunks_joined(self):
+        data = Path('pics/mandelbrot.png').read_bytes()
+        *_, idat_data = _png_info(data)
+        assert len(zlib.decompress(idat_data)) == 640 * (1 + 640)
+
+    @pytest.mark.parametrize(
+        'data',
+        (
+            pytest.param(b'', id='empty'),
+            pytest.param(jpeg_data(), id='jpg'),
+            pytest.param(png_data()[:40], id='truncated'),
+            pytest.param(png_data('RGBA'), id='alpha'),
+            pytest.param(png_data('P'), id='palette'),
+            pytest.param(png_data('I;16'), id='16 bit'),
+            pytest.param(png_data(transparency=(0, 0, 0)), id='transparency'),
+        )
+    )
+    def test_unsupported_png_raises_error(self, data):
+        with pytest.raises(ValueError):
+            _png_info(data)
+
+
+class TestFromEncoded:
+    """Test core._PreparedPicture.from_encoded"""
+
+    def test_jpeg_data_embedded_unchanged(self):
+        data = Path('pics/blender/chain_render.jpg').read_bytes()
+        picture = _PreparedPicture.from_encoded(data)
+
+        assert picture.getSize() == (671, 468)
+        assert picture.image.streamContent == data
+        assert picture.image._filters == ('DCTDecode',)
+
+    def test_png_data_embedded_unchanged(self):
+        data = Path('pics/mandelbrot.png').read_bytes()
+        picture = _PreparedPicture.from_encoded(data)
+
+        assert picture.getSize() == (640, 640)
+        assert picture.image.streamContent in data
+        assert picture.image._filters == ('FlateDecode',)
+        assert picture.image.decodeParms['Predictor'] == 15
+
+    @pytest.mark.parametrize(
+        'pic_file',
+        (
+            pytest.param('pics/plots/gauss_2x2.png', id='png with alpha'),
+            pytest.param('pics/not_jpg.jpg', id='not jpg'),
+            pytest.param('pics/empty.pdf', id='pdf'),
+        )
+    )
+    def test_unsupported_file_returns_none(self, pic_file):
+        data = Path(pic_file).read_bytes()
+        assert _PreparedPicture.from_encoded(data) is None
+
+    @pytest.mark.parametrize(
+        'max_dpi, passed_through',
+        (
+            pytest.param(None, True, id='None'),
+            pytest.param(600, True, id='600'),
+            pytest.param(72, False, id='72'),
+        )
+    )
+    @pytest.mark.parametrize(
+        'pic_file',
+        ('pics/blender/chain_render.jpg', 'pics/mandelbrot.png')
+    )
+    def test_max_dpi(self, pic_file, max_dpi, passed_through):
+        picture = _PreparedPicture.from_encoded(
+            Path(pic_file).read_bytes(), area_size=(300, 300),
+            max_dpi=max_dpi
+        )
+        assert (picture is not None) == passed_through
+
+
+class TestLazyPicture:
+    """Test core._LazyPicture"""
+
+    @pytest.mark.parametrize(
+        'pic_file, expected_size',
+        (
+            pytest.param('pics/blender/chain_render.jpg', (671, 468),
+                         id='jpeg'),
+            pytest.param('pics/plots/gauss_2x2.png', (824, 584), id='png'),
+        )
+    )
+    def test_size_probed_without_preparing(self, mocker, pic_file,
+                                           expected_size):
+        prepare = mocker.patch('pictureshow.core._prepare_picture',
+                               autospec=True)
+        picture = _LazyPicture(pic_file, Path(pic_file).read_bytes(), {})
+
+        assert picture.getSize() == expected_size
+        prepare.assert_not_called()
+
+    def test_prepared_once(self, mocker):
+        pic_file = 'pics/mandelbrot.png'
+        prepare = mocker.patch('pictureshow.core._prepare_picture',
+                               autospec=True, side_effect=_prepare_picture)
+        picture = _LazyPicture(pic_file, Path(pic_file).read_bytes(), {})
+
+        assert picture.prepare() is picture.prepare()
+        assert picture.prepare().getSize() == picture.getSize()
+        prepare.assert_called_once()
+
+    @pytest.mark.parametrize(
+        'pic_file',
+        ('pics/not_jpg.jpg', 'pics/empty.pdf')
+    )
+    def test_invalid_file_raises_error(self, pic_file):
+        with pytest.raises(ImageError):
+            _LazyPicture(pic_file, Path(pic_file).read_bytes(), {})
+
+    def test_truncated_file_raises_error_when_prepared(self):
+        data = Path('pics/plots/gauss_2x2.png').read_bytes()
+        picture = _LazyPicture('foo.png', data[:len(data) // 2], {})
+
+        with pytest.raises(OSError, match='truncated'):
+            picture.prepare()
+        # the error is kept and raised again
+        with pytest.raises(OSError, match='truncated'):
+            picture.prepare()
+        assert picture.data_size() == 0
+
+    def test_truncated_file_reported_as_error(self, tmp_path):
+        truncated = tmp_path / 'truncated.png'
+        data = Path('pics/plots/gauss_2x2.png').read_bytes()
+        truncated.write_bytes(data[:len(data) // 2])
+        pic_files = ['pics/mandelbrot.png', truncated]
+        result = PictureShow(*pic_files)._save_pdf(
+            str(tmp_path / 'foo.pdf'), **DEFAULTS
+        )
+
+        assert result.num_ok == 1
+        assert [pic_file for pic_file, _ in result.errors] == [truncated]
+
+
+class TestPictureCache:
+    """Test cache.PictureCache"""
+
+    @pytest.fixture
+    def mandelbrot(self):
+        return _prepare_picture(Path('pics/mandelbrot.png').read_bytes())
+
+    def test_put_and_get(self, tmp_path, mandelbrot):
+        cache = PictureCache(tmp_path / 'cache')
+        options = dict(area_size=(400, 400), stretch_small=False,
+                       max_dpi=None)
+        cache.put('foo', options, mandelbrot)
+        cached = cache.get('foo', options)
+
+        assert cached.getSize() == mandelbrot.getSize()
+        assert cached.image.streamContent == mandelbrot.image.streamContent
+        assert cache.get('bar', options) is None
+
+    @pytest.mark.parametrize(
+        'other_options, expected_hit',
+        (
+            pytest.param({'area_size': (200, 200)}, True,
+                         id='area size without max_dpi'),
+            pytest.param({'max_dpi': 150}, False, id='max_dpi'),
+            pytest.param({'compression': 'max'}, False, id='compression'),
+            pytest.param({'reencode': 'jpeg'}, False, id='reencode'),
+        )
+    )
+    def test_options_in_key(self, tmp_path, mandelbrot, other_options,
+                            expected_hit):
+        cache = PictureCache(tmp_path)
+        options = dict(area_size=(400, 400), stretch_small=False,
+                       max_dpi=None)
+        cache.put('foo', options, mandelbrot)
+
+        cached = cache.get('foo', {**options, **other_options})
+        assert (cached is not None) == expected_hit
+
+    def test_corrupt_entry_removed(self, tmp_path, mandelbrot):
+        cache = PictureCache(tmp_path)
+        cache.put('foo', {}, mandelbrot)
+        entry, = tmp_path.iterdir()
+        entry.write_bytes(b'foo')
+
+        assert cache.get('foo', {}) is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_trim_removes_least_recently_used(self, tmp_path, mandelbrot):
+        cache = PictureCache(tmp_path)
+        for digest in 'abc':
+            cache.put(digest, {}, mandelbrot)
+        entry_size = next(tmp_path.iterdir()).stat().st_size
+        for path, mtime in zip(sorted(tmp_path.iterdir()), (1, 2, 3)):
+            os.utime(path, (mtime, mtime))
+        # reading makes the entry most recently used
+        oldest = cache._path('a', {})
+        cache.get('a', {})
+
+        cache.max_size = 2 * entry_size
+        cache.trim()
+        assert len(list(tmp_path.iterdir())) == 2
+        assert oldest.exists()
+
+    @pytest.mark.parametrize('workers', (None, 2))
+    def test_warm_run_prepares_nothing(self, mocker, tmp_path, workers):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg']
+        options = dict(force_overwrite=True, workers=workers,
+                       cache_dir=tmp_path / 'cache')
+        cold = PictureShow(*pic_files).save_pdf(tmp_path / 'cold.pdf',
+                                                 **options)
+        prepare = mocker.patch('pictureshow.core._prepare_picture',
+                               autospec=True)
+        warm = PictureShow(*pic_files).save_pdf(tmp_path / 'warm.pdf',
+                                                 **options)
+
+        prepare.assert_not_called()
+        assert warm.num_ok == cold.num_ok == 2
+        assert ((tmp_path / 'warm.pdf').stat().st_size
+                == (tmp_path / 'cold.pdf').stat().st_size)
+
+
+class TestParseObject:
+    """Test reader.parse_object and reader.serialize"""
+
+    @pytest.mark.parametrize(
+        'data, expected',
+        (
+            pytest.param(b'<< /Type /Page /Count 3 >>',
+                         {'Type': 'Page', 'Count': 3}, id='dict'),
+            pytest.param(b'[0 0 595.2756 841.8898]',
+                         [0, 0, 595.2756, 841.8898], id='array'),
+            pytest.param(b'[5 0 R 6 0 R]',
+                         [Reference(5, 0), Reference(6, 0)], id='references'),
+            pytest.param(b'(a \\(b\\) \\101)', b'a (b) A', id='string'),
+            pytest.param(b'<1afe 79>', b'\x1a\xfey', id='hex string'),
+            pytest.param(b'/A#20B', 'A B', id='name'),
+            pytest.param(b'% comment\n<< /A true /B null >>',
+                         {'A': True, 'B': None}, id='comment'),
+        )
+    )
+    def test_parse(self, data, expected):
+        obj, pos = parse_object(data, 0)
+        assert obj == expected
+        assert pos == len(data)
+
+    def test_serialize_round_trip(self):
+        obj = {Name('Kids'): [Reference(5, 0)], Name('Type'): Name('Pages'),
+               Name('ID'): [b'\x1a\xfe'], Name('Box'): [0, 595.2756]}
+        data = serialize(obj).encode('ascii')
+
+        assert data == (b'<< /Kids [5 0 R] /Type /Pages /ID [<1afe>]'
+                        b' /Box [0 595.2756] >>')
+        assert parse_object(data, 0)[0] == obj
+
+
+class TestAppend:
+    """Test core.PictureShow.save_pdf with append=True"""
+
+    @pytest.fixture
+    def pdf_path(self, tmp_path):
+        pdf_path = tmp_path / 'foo.pdf'
+        PictureShow('pics/mandelbrot.png').save_pdf(pdf_path, layout=(2, 2))
+        return pdf_path
+
+    def test_last_page_continued(self, pdf_path):
+        original = pdf_path.read_bytes()
+        pic_files = ['pics/blender/chain_render.jpg'] * 2
+        result = PictureShow(*pic_files).save_pdf(pdf_path, layout=(2, 2),
+                                                  append=True)
+
+        assert result.num_ok == 2
+        assert result.num_pages == 1
+        # incremental update, the original file is unchanged
+        assert pdf_path.read_bytes().startswith(original)
+        reader = PdfFileReader(str(pdf_path))
+        assert reader.numPages == 1
+        with open(pdf_path, 'rb') as f:
+            pdf = PdfFile(f)
+            _, page = pdf.last_page()
+            assert pdf.count_drawn_objects(page) == 3
+
+    @pytest.mark.parametrize(
+        'layout, num_new_pages',
+        (
+            pytest.param((1, 1), 3, id='page full'),
+            pytest.param((2, 2), 0, id='continued'),
+            pytest.param((1, 3), 1, id='other layout'),
+        )
+    )
+    def test_appended_pages(self, pdf_path, layout, num_new_pages):
+        pic_files = ['pics/plots/gauss_2x2.png'] * 3
+        PictureShow(*pic_files).save_pdf(pdf_path, layout=layout,
+                                         append=True)
+
+        assert PdfFileReader(str(pdf_path)).numPages == 1 + num_new_pages
+
+    @pytest.mark.parametrize('streaming', (False, True))
+    def test_layout_recorded(self, tmp_path, streaming):
+        pdf_path = tmp_path / 'foo.pdf'
+        PictureShow('pics/mandelbrot.png').save_pdf(
+            pdf_path, layout=(2, 3), margin=36.5, streaming=streaming
+        )
+
+        with open(pdf_path, 'rb') as f:
+            _, page = PdfFile(f).last_page()
+        assert page[LAYOUT_KEY] == [2, 3, 36.5]
+
+    @pytest.mark.parametrize(
+        'options',
+        (
+            pytest.param(dict(layout=(1, 1)), id='other layout'),
+            pytest.param(dict(layout=(2, 2), margin=36), id='other margin'),
+            pytest.param(dict(layout='auto'), id='auto layout'),
+        )
+    )
+    def test_other_layout_not_continued(self, tmp_path, options):
+        pdf_path = tmp_path / 'foo.pdf'
+        PictureShow('pics/mandelbrot.png').save_pdf(pdf_path, **options)
+        PictureShow('pics/blender/chain_render.jpg').save_pdf(
+            pdf_path, layout=(2, 2), append=True
+        )
+
+        with open(pdf_path, 'rb') as f:
+            pdf = PdfFile(f)
+            _, pages = pdf.pages()
+            first_page, last_page = (pdf.object(ref)
+                                     for ref in pages['Kids'])
+            # pictures do not overlap
+            assert pdf.count_drawn_objects(first_page) == 1
+            assert pdf.count_drawn_objects(last_page) == 1
+
+    def test_page_without_layout_not_continued(self, tmp_path):
+        pdf_path = tmp_path / 'foo.pdf'
+        canvas = Canvas(str(pdf_path), pagesize=A4)
+        canvas.drawImage('pics/mandelbrot.png', 72, 72, 100, 100)
+        canvas.save()
+        PictureShow('pics/mandelbrot.png').save_pdf(pdf_path, layout=(2, 2),
+                                                    append=True)
+
+        assert PdfFileReader(str(pdf_path)).numPages == 2
+
+    def test_different_page_size_not_continued(self, pdf_path):
+        PictureShow('pics/mandelbrot.png').save_pdf(
+            pdf_path, page_size='A5', layout=(2, 2), append=True
+        )
+
+        assert PdfFileReader(str(pdf_path)).numPages == 2
+
+    def test_appended_twice(self, pdf_path):
+        for _ in range(2):
+            PictureShow(*['pics/mandelbrot.png'] * 3).save_pdf(
+                pdf_path, layout=(2, 2), append=True
+            )
+
+        with open(pdf_path, 'rb') as f:
+            pdf = PdfFile(f)
+            _, pages = pdf.pages()
+            assert pages['Count'] == 2
+            assert 'Prev' in pdf.trailer
+        assert PdfFileReader(str(pdf_path)).numPages == 2
+
+    def test_nothing_to_append(self, pdf_path):
+        original = pdf_path.read_bytes()
+        result = PictureShow('pics/not_jpg.jpg').save_pdf(pdf_path,
+                                                          append=True)
+
+        assert result.num_ok == 0
+        assert pdf_path.read_bytes() == original
+
+    def test_missing_file_created(self, tmp_path):
+        pdf_path = tmp_path / 'foo.pdf'
+        PictureShow('pics/mandelbrot.png').save_pdf(pdf_path, append=True)
+
+        assert PdfFileReader(str(pdf_path)).numPages == 1
+
+    def test_xref_stream_raises_error(self, tmp_path):
+        pdf_path = tmp_path / 'foo.pdf'
+        header = b'%PDF-1.5\n'
+        pdf_path.write_bytes(
+            header + b'1 0 obj\n<< /Type /XRef /Size 2 /W [1 2 1] /Length 0'
+            b' >>\nstream\n\nendstream\nendobj\n'
+            b'startxref\n%d\n%%%%EOF\n' % len(header)
+        )
+
+        with pytest.raises(PdfSyntaxError,
+                           match='cross-reference streams not supported'):
+            PictureShow('pics/mandelbrot.png').save_pdf(pdf_path,
+                                                        append=True)
+
+    def test_append_to_shards_raises_error(self, tmp_path):
+        with pytest.raises(ValueError, match='cannot append to split output'):
+            PictureShow('pics/mandelbrot.png').save_pdf(
+                tmp_path / 'foo.pdf', max_pages_per_file=1, append=True
+            )
+
+
+class TestStreamingCanvas:
+    """Test writer.StreamingCanvas"""
+
+    @pytest.mark.parametrize(
+        'pic_file',
+        (
+            pytest.param('pics/blender/chain_render.jpg', id='jpeg'),
+            pytest.param('pics/mandelbrot.png', id='png'),
+            pytest.param('pics/plots/gauss_2x2.png', id='png with alpha'),
+        )
+    )
+    def test_pages_written(self, tmp_path, pic_file):
+        picture = _prepare_picture(Path(pic_file).read_bytes())
+        pdf_path = tmp_path / 'foo.pdf'
+        pdf_canvas = StreamingCanvas(str(pdf_path), pagesize=A4)
+        pdf_canvas.drawPicture(picture, 72, 72, 300, 200)
+        pdf_canvas.showPage()
+        pdf_canvas.drawPicture(picture, 72.5, 0.00001, 300, 200)
+        pdf_canvas.save()
+
+        reader = PdfFileReader(str(pdf_path))
+        assert reader.numPages == 2
+        # the image object is written only once, and shared by both pages
+        first_page, second_page = (
+            dict(page['/Resources']['/XObject'].items())
+            for page in reader.pages
+        )
+        assert len(first_page) == 1
+        assert first_page == second_page
+
+    def test_image_data_released(self, tmp_path):
+        picture = _prepare_picture(png_with_alpha('gradual'))
+        pdf_canvas = StreamingCanvas(str(tmp_path / 'foo.pdf'), pagesize=A4)
+        pdf_canvas.drawPicture(picture, 72, 72, 300, 200)
+
+        assert picture.image.streamContent is None
+        assert picture.image._smask is None
+        pdf_canvas.save()
+
+    @pytest.mark.parametrize('page_compression', (True, False))
+    def test_page_compression(self, tmp_path, page_compression):
+        picture = _prepare_picture(Path('pics/mandelbrot.png').read_bytes())
+        pdf_path = tmp_path / 'foo.pdf'
+        pdf_canvas = StreamingCanvas(str(pdf_path), pagesize=A4,
+                                     pageCompression=page_compression)
+        pdf_canvas.drawPicture(picture, 72, 72, 300, 200)
+        pdf_canvas.save()
+
+        contents = PdfFileReader(str(pdf_path)).pages[0]['/Contents']
+        assert ('/Filter' in contents.get_object()) == page_compression
+        assert contents.get_object().get_data().endswith(b' Do Q')
+
+    def test_nothing_drawn_no_file(self, tmp_path):
+        StreamingCanvas(str(tmp_path / 'foo.pdf'), pagesize=A4)
+
+        assert not (tmp_path / 'foo.pdf').exists()
+
+
 A4_PORTRAIT_MARGIN_72 = (A4_WIDTH - 144, A4_LENGTH - 144)
 A4_LANDSCAPE_MARGIN_72 = (A4_LENGTH - 144, A4_WIDTH - 144)
 
@@ -439,6 +2336,47 @@ class TestPositionAndSize:
         assert new_width / new_height == pytest.approx(original_aspect)
 
 
+class TestDownsampled:
+    """Test core.PictureShow._downsampled"""
+
+    @pytest.mark.parametrize(
+        'size, max_dpi, expected',
+        (
+            pytest.param((100, 50), 72, (100, 50), id='72 dpi'),
+            pytest.param((100, 50), 144, (200, 100), id='144 dpi'),
+            pytest.param((72, 36), 300, (300, 150), id='300 dpi'),
+        )
+    )
+    def test_big_picture_downsampled(self, size, max_dpi, expected):
+        picture = ImageReader(Image.new('RGB', (1000, 500)))
+        result = PictureShow()._downsampled(picture, size, max_dpi)
+
+        assert result is not picture
+        assert result.getSize() == expected
+
+    @pytest.mark.parametrize(
+        'size, max_dpi',
+        (
+            pytest.param((1000, 500), 72, id='same size'),
+            pytest.param((100, 50), 720, id='same resolution'),
+            pytest.param((500, 250), 300, id='lower resolution'),
+        )
+    )
+    def test_small_picture_not_resampled(self, size, max_dpi):
+        picture = ImageReader(Image.new('RGB', (1000, 500)))
+        result = PictureShow()._downsampled(picture, size, max_dpi)
+
+        assert result is picture
+
+    def test_transparent_palette_picture_keeps_alpha(self):
+        image = Image.new('P', (1000, 500))
+        image.info['transparency'] = 0
+        result = PictureShow()._downsampled(ImageReader(image), (100, 50), 72)
+        result.getRGBData()
+
+        assert result._dataA is not None
+
+
 class TestAreas:
     """Test core.PictureShow._areas"""
 
@@ -504,6 +2442,11 @@ class TestAreas:
         for area in areas[6:]:
             assert area.y == margin
 
+    def test_auto_layout(self):
+        areas = list(PictureShow()._areas('auto', A4, 36))
+
+        assert areas == [DrawingArea(36, 36, A4_WIDTH - 72, A4_LENGTH - 72)]
+
     @pytest.mark.parametrize(
         'layout, margin',
         (
@@ -511,8 +2454,150 @@ class TestAreas:
             pytest.param((1, 1), A4_WIDTH/2, id='A4 width/2'),
             pytest.param((1, 2), 300, id='300'),
             pytest.param((1, 2), A4_LENGTH/3, id='A4 length/3'),
+            pytest.param('auto', A4_LENGTH/5, id='auto'),
         )
     )
     def test_high_margin_raises_error(self, layout, margin):
         with pytest.raises(MarginError, match='margin value too high: .+'):
             list(PictureShow()._areas(layout, A4, margin))
+
+
+def sized_pictures(*sizes):
+    """Return (pic_file, picture) pairs of mock pictures of given sizes."""
+    pictures = []
+    for index, size in enumerate(sizes):
+        prepared_picture = picture()
+        prepared_picture.getSize.return_value = size
+        pictures.append((f'{index}.png', prepared_picture))
+    return pictures
+
+
+class TestPackedPages:
+    """Test core.PictureShow._packed_pages"""
+
+    area = DrawingArea(18, 18, A4_WIDTH - 36, A4_LENGTH - 36)
+    mixed_sizes = [(1200, 800), (800, 1200), (1600, 900), (1000, 1000)] * 30
+
+    def pages(self, pictures, spacing=18, stretch_small=True):
+        return list(PictureShow()._packed_pages(pictures, self.area, spacing,
+                                                stretch_small))
+
+    def test_within_area_without_overlap(self):
+        pages = self.pages(sized_pictures(*self.mixed_sizes))
+
+        assert sum(len(page) for page in pages) == len(self.mixed_sizes)
+        for page in pages:
+            for placed in page:
+                assert placed.x >= self.area.x - 1e-6
+                assert placed.y >= self.area.y - 1e-6
+                assert (placed.x + placed.width
+                        <= self.area.x + self.area.width + 1e-6)
+                assert (placed.y + placed.height
+                        <= self.area.y + self.area.height + 1e-6)
+            for first, second in zip(page, page[1:]):
+                # next picture is right of or below the previous one
+                assert (first.x + first.width <= second.x + 1e-6
+                        or second.y + second.height <= first.y + 1e-6)
+
+    def test_full_rows_fill_width(self):
+        page, *_ = self.pages(sized_pictures(*self.mixed_sizes))
+        rows = {}
+        for placed in page:
+            rows.setdefault(round(placed.y, 6), []).append(placed)
+
+        assert len(rows) > 1
+        for row in rows.values():
+            heights = {round(placed.height, 6) for placed in row}
+            assert len(heights) == 1
+            right = row[-1].x + row[-1].width
+            assert right - row[0].x == pytest.approx(self.area.width)
+
+    def test_aspect_ratio_kept(self):
+        pictures = sized_pictures(*self.mixed_sizes)
+        pages = self.pages(pictures)
+        placed = [placed for page in pages for placed in page]
+
+        for (_, picture), placed in zip(pictures, placed):
+            width, height = picture.getSize()
+            assert placed.width / placed.height == pytest.approx(
+                width / height
+            )
+
+    def test_last_row_not_stretched(self):
+        page, = self.pages(sized_pictures((800, 1200)), spacing=0)
+        placed, = page
+
+        assert placed.height == pytest.approx(self.area.height / 4)
+        # centered
+        assert placed.x + placed.width / 2 == pytest.approx(
+            self.area.x + self.area.width / 2
+        )
+
+    def test_small_picture_not_stretched(self):
+        page, = self.pages(sized_pictures((40, 30)), stretch_small=False)
+        placed, = page
+
+        assert (placed.width, placed.height) == (40, 30)
+
+    @pytest.mark.parametrize('layout', ((2, 3), (3, 3)))
+    def test_denser_than_grid(self, layout):
+        pic_show = PictureShow()
+        grid_pages = list(pic_show._pages(
+            sized_pictures(*self.mixed_sizes),
+            tuple(pic_show._areas(layout, A4, 18)), stretch_small=True
+        ))
+        pages = self.pages(sized_pictures(*self.mixed_sizes))
+
+        def area_per_page(pages):
+            return sum(placed.width * placed.height
+                       for page in pages for placed in page) / len(pages)
+
+        assert area_per_page(pages) > 1.15 * area_per_page(grid_pages)
+
+    def test_pictures_placed_hook(self):
+        hooks = RecordingHooks()
+        pic_show = PictureShow()
+        pic_show._hooks = hooks
+        pages = list(pic_show._packed_pages(
+            sized_pictures(*self.mixed_sizes), self.area, 18, True
+        ))
+
+        placed = [event for event in hooks.events if event[0] == 'placed']
+        assert len(placed) == len(self.mixed_sizes)
+        assert placed[-1][3] == len(pages)
+
+    def test_save_pdf(self, tmp_path):
+        pic_files = ['pics/mandelbrot.png', 'pics/blender/chain_render.jpg',
+                     'pics/plots/gauss_2x2.png'] * 3
+        pdf_path = tmp_path / 'foo.pdf'
+        result = PictureShow(*pic_files).save_pdf(pdf_path, layout='auto')
+        plan = PictureShow(*pic_files).plan(layout='auto')
+
+        assert result.num_ok == 9
+        assert result.num_pages == plan.num_pages == 2
+        assert PdfFileReader(str(pdf_path)).numPages == 2
+
+    def test_max_dpi_kept(self, tmp_path):
+        # the wide picture makes the row before it taller than the target
+        pic_files = []
+        for index, size in enumerate([(600, 1000), (600, 1000),
+                                      (10000, 1000), (600, 1000)]):
+            pic_file = tmp_path / f'{index}.png'
+            Image.new('RGB', size).save(pic_file)
+            pic_files.append(pic_file)
+        pdf_path = tmp_path / 'foo.pdf'
+        PictureShow(*pic_files).save_pdf(pdf_path, layout='auto', max_dpi=72)
+
+        reader = PdfFileReader(str(pdf_path))
+        page, = reader.pages
+        images = page['/Resources']['/XObject']
+        num_drawn = 0
+        for operands, operator in ContentStream(page.getContents(),
+                                                reader).operations:
+            if operator == b'cm':
+                placed_width = operands[0]
+            elif operator == b'Do':
+                image = images[operands[0]].get_object()
+                assert image['/Width'] / (placed_width / 72) >= 72 - 1
+                num_drawn += 1
+        assert num_drawn == 4